@@ -0,0 +1,64 @@
+"""Compare per-command latency of separate CLI processes and ``batch`` mode.
+
+Usage::
+
+    python benchmarks/cli_batch.py --commands 200
+
+Logs the same entries once with one ``timesheet.py log`` process per entry
+and once through a single ``timesheet.py batch`` run, each against a fresh
+database.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+SCRIPT = os.path.join(os.path.dirname(__file__), '..', 'timesheet.py')
+
+
+def commands(count):
+    first = date(2023, 1, 1)
+    for i in range(count):
+        day = first + timedelta(days=i % 365)
+        yield ['log', f'emp{i % 50:02d}', f'proj{i % 20:02d}', '1.5',
+               '--date', day.isoformat()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--commands', type=int, default=200)
+    parser.add_argument('--dir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    results = {}
+    path = os.path.join(args.dir, 'bench_cli.db')
+    for mode in ('process', 'batch'):
+        if os.path.exists(path):
+            os.remove(path)
+        subprocess.run([sys.executable, SCRIPT, '--db', path, 'summary'],
+                       check=True, stdout=subprocess.DEVNULL)
+        start = time.perf_counter()
+        if mode == 'process':
+            for argv in commands(args.commands):
+                subprocess.run([sys.executable, SCRIPT, '--db', path] + argv,
+                               check=True, stdout=subprocess.DEVNULL)
+        else:
+            lines = ''.join(subprocess.list2cmdline(argv) + '\n'
+                            for argv in commands(args.commands))
+            subprocess.run([sys.executable, SCRIPT, '--db', path, 'batch'],
+                           input=lines, text=True, check=True,
+                           stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        results[mode] = time.perf_counter() - start
+    os.remove(path)
+
+    print(f'commands: {args.commands}')
+    for mode, secs in results.items():
+        print(f'{mode:8} {secs:7.2f}s  {secs / args.commands * 1000:8.2f} ms per command')
+    print(f"speedup: x{results['process'] / results['batch']:.1f}")
+
+
+if __name__ == '__main__':
+    main()
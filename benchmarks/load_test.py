@@ -0,0 +1,291 @@
+"""Drive the web app with a mix of simulated employees and managers.
+
+Usage::
+
+    python benchmarks/load_test.py --users 50 --threads 8 --duration 30
+    python benchmarks/load_test.py --mode http --mix login=5,timesheet=50,dashboard=45
+
+Builds a synthetic database (the data set of ``storage_format.py`` plus one
+login per simulated user), then has ``--threads`` workers replay weighted
+scenarios for ``--duration`` seconds. Requests go through the Flask test
+client, or with ``--mode http`` over local HTTP to a threaded server started
+in-process. Throughput, latency percentiles and errors are reported per
+scenario; ``locked`` counts failures caused by ``database is locked``.
+"""
+import argparse
+import http.cookiejar
+import logging
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from datetime import date, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from storage_format import EMPLOYEES, PROJECTS, populate  # noqa: E402
+
+DEFAULT_MIX = 'login=10,timesheet=30,dashboard=35,productivity=15,payroll=5'
+PASSWORD = 'load-test'
+LOCKED = b'database is locked'
+
+
+def add_users(path, count):
+    """Give the first ``count`` employees a login; every tenth is a manager."""
+    from werkzeug.security import generate_password_hash
+
+    hashed = generate_password_hash(PASSWORD)
+    users = []
+    for i in range(1, count + 1):
+        if i % 50 == 1:
+            role = 'Admin'
+        elif i % 10 == 1:
+            role = 'Project Manager'
+        else:
+            role = 'Employee'
+        users.append((f'emp{i:04d}', f'emp{i:04d}@example.com', f'emp{i:04d}',
+                      hashed, 'Engineering', role, 'Active'))
+    conn = sqlite3.connect(path)
+    conn.executemany(
+        'INSERT INTO users (full_name, email, username, password, department, '
+        'role, status) VALUES (?, ?, ?, ?, ?, ?, ?)', users)
+    conn.commit()
+    conn.close()
+    return [dict(email=row[1], role=row[5]) for row in users]
+
+
+class ClientDriver:
+    """Send requests through the Flask test client of ``web_app``."""
+
+    def __init__(self, app):
+        self.client = app.test_client()
+
+    def request(self, method, path, params=None, data=None):
+        response = self.client.open(path, method=method, query_string=params, data=data)
+        return response.status_code, response.get_data()
+
+
+class _NoRedirect(urllib.request.HTTPRedirectHandler):
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+
+class HttpDriver:
+    """Send requests over HTTP, keeping the session cookie like a browser."""
+
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.opener = urllib.request.build_opener(
+            urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), _NoRedirect)
+
+    def request(self, method, path, params=None, data=None):
+        url = self.base_url + path
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        body = urllib.parse.urlencode(data, doseq=True).encode() if data else None
+        try:
+            with self.opener.open(urllib.request.Request(url, body, method=method)) as resp:
+                return resp.status, resp.read()
+        except urllib.error.HTTPError as e:
+            return e.code, e.read()
+
+
+class VirtualUser:
+    def __init__(self, driver, email, role, rng, batch):
+        self.driver = driver
+        self.email = email
+        self.role = role
+        self.rng = rng
+        self.batch = batch
+        self.logged_in = False
+
+    def login(self):
+        status, body = self.driver.request(
+            'POST', '/login', data=dict(email=self.email, password=PASSWORD))
+        self.logged_in = status == 302
+        if not self.logged_in:
+            body += b' login failed'
+        return status, body
+
+    def timesheet(self):
+        today = date.today()
+        rows = [(f'proj{self.rng.randint(1, PROJECTS):03d}',
+                 str(self.rng.randint(1, 8) / 2),
+                 (today - timedelta(days=self.rng.randrange(60))).isoformat())
+                for _ in range(self.batch)]
+        return self.driver.request('POST', '/timesheet', data={
+            'project[]': [r[0] for r in rows],
+            'hours[]': [r[1] for r in rows],
+            'entry_date[]': [r[2] for r in rows],
+            'remarks[]': ['' for _ in rows],
+        })
+
+    def dashboard(self):
+        return self.driver.request('GET', '/dashboard')
+
+    def productivity(self):
+        year = self.rng.randint(2019, 2023)
+        month = self.rng.randint(1, 12)
+        start = date(year, month, 1)
+        return self.driver.request('GET', '/reports/productivity', params=dict(
+            employee=f'emp{self.rng.randint(1, EMPLOYEES):04d}',
+            start=start.isoformat(),
+            end=(start + timedelta(days=89)).isoformat(),
+        ))
+
+    def payroll(self):
+        return self.driver.request('GET', '/api/payroll')
+
+
+def classify(status, body):
+    """Return None for a successful response, otherwise an error label."""
+    if LOCKED in body:
+        return 'locked'
+    if status == 503:
+        return 'rejected'
+    if status >= 400:
+        return f'http {status}'
+    if body.endswith(b' login failed'):
+        return 'login failed'
+    if b'Failed to log time' in body:
+        return 'log failed'
+    return None
+
+
+def worker(users, scenarios, weights, deadline, rng, results, lock):
+    samples = {}
+    while time.monotonic() < deadline:
+        user = rng.choice(users)
+        name = rng.choices(scenarios, weights)[0]
+        if name != 'login' and not user.logged_in:
+            name = 'login'
+        start = time.perf_counter()
+        try:
+            status, body = getattr(user, name)()
+            error = classify(status, body)
+        except Exception as e:  # noqa: BLE001 - every failure is a data point
+            error = 'locked' if 'database is locked' in str(e) else type(e).__name__
+        elapsed = time.perf_counter() - start
+        samples.setdefault(name, []).append((elapsed, error))
+    with lock:
+        for name, values in samples.items():
+            results.setdefault(name, []).extend(values)
+
+
+def percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * fraction))]
+
+
+def report(results, elapsed):
+    print(f"{'scenario':13} {'requests':>8} {'req/s':>8} {'p50 ms':>8} {'p90 ms':>8} "
+          f"{'p99 ms':>8} {'max ms':>8} {'errors':>7} {'locked':>7}")
+    total = errors = 0
+    for name in sorted(results):
+        values = results[name]
+        latencies = sorted(v[0] * 1000 for v in values)
+        failed = [v[1] for v in values if v[1]]
+        locked = failed.count('locked')
+        total += len(values)
+        errors += len(failed)
+        print(f'{name:13} {len(values):8} {len(values) / elapsed:8.1f} '
+              f'{percentile(latencies, 0.5):8.1f} {percentile(latencies, 0.9):8.1f} '
+              f'{percentile(latencies, 0.99):8.1f} {latencies[-1]:8.1f} '
+              f'{len(failed):7} {locked:7}')
+        other = sorted({f for f in failed if f != 'locked'})
+        if other:
+            print(f"{'':13} other errors: {', '.join(other)}")
+    print(f'total {total} requests in {elapsed:.1f}s, {total / elapsed:.1f} req/s, '
+          f'error rate {errors / max(total, 1):.2%}')
+
+
+def parse_mix(value):
+    mix = {}
+    for part in value.split(','):
+        name, _, weight = part.partition('=')
+        if name not in ('login', 'timesheet', 'dashboard', 'productivity', 'payroll'):
+            raise argparse.ArgumentTypeError(f'unknown scenario: {name}')
+        mix[name] = float(weight or 1)
+    return mix
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--mode', choices=['client', 'http'], default='client')
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch', type=int, default=5,
+                        help='entries per /timesheet submit')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f'scenario weights (default {DEFAULT_MIX})')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--dir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+    if not 0 < args.users <= EMPLOYEES:
+        parser.error(f'--users must be between 1 and {EMPLOYEES}')
+
+    path = os.path.join(args.dir, 'bench_load.db')
+    if os.path.exists(path):
+        os.remove(path)
+    populate(path, False, args.rows)
+    accounts = add_users(path, args.users)
+    import web_app
+
+    web_app.create_app(path, init=True)
+
+    server = None
+    if args.mode == 'http':
+        from werkzeug.serving import make_server
+
+        logging.getLogger('werkzeug').setLevel(logging.ERROR)
+        server = make_server('127.0.0.1', 0, web_app.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        base_url = f'http://127.0.0.1:{server.server_port}'
+
+        def new_driver():
+            return HttpDriver(base_url)
+    else:
+        web_app.app.config['PROPAGATE_EXCEPTIONS'] = True
+
+        def new_driver():
+            return ClientDriver(web_app.app)
+
+    rng = random.Random(args.seed)
+    users = [VirtualUser(new_driver(), a['email'], a['role'], random.Random(rng.random()),
+                         args.batch) for a in accounts]
+    threads_count = min(args.threads, len(users))
+    scenarios, weights = list(args.mix), list(args.mix.values())
+    results, lock = {}, threading.Lock()
+    deadline = time.monotonic() + args.duration
+    # Each worker owns a disjoint set of users so sessions are never shared.
+    threads = [threading.Thread(target=worker, args=(
+        users[i::threads_count], scenarios, weights, deadline,
+        random.Random(rng.random()), results, lock)) for i in range(threads_count)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if server:
+        server.shutdown()
+
+    roles = {}
+    for user in users:
+        roles[user.role] = roles.get(user.role, 0) + 1
+    print(f'mode: {args.mode}, rows: {args.rows:,}, users: {args.users} '
+          f"({', '.join(f'{n} {r}' for r, n in sorted(roles.items()))}), "
+          f'threads: {threads_count}, cores: {os.cpu_count()}')
+    report(results, elapsed)
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
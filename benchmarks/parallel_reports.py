@@ -0,0 +1,81 @@
+"""Measure the speedup of date-partitioned reports against worker count.
+
+Usage::
+
+    python benchmarks/parallel_reports.py --rows 10000000
+
+Runs a full-history ``summary --period daily`` and an unfiltered
+``top_employees`` with ``jobs`` = 1, 2, 4, ... up to the machine's core
+count on the synthetic data set of ``storage_format.py``.
+"""
+import argparse
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import timesheet  # noqa: E402
+from storage_format import populate  # noqa: E402
+
+
+def timed(func, repeat=3):
+    best = None
+    for _ in range(repeat):
+        timesheet.REPORT_CACHE.clear()
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def job_counts(cores):
+    jobs = 1
+    while jobs < cores:
+        yield jobs
+        jobs *= 2
+    yield cores
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--dir', default=tempfile.gettempdir())
+    parser.add_argument('--max-jobs', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    path = os.path.join(args.dir, 'bench_parallel.db')
+    if os.path.exists(path):
+        os.remove(path)
+    populate(path, False, args.rows)
+    timesheet.DB_FILE = path
+    timesheet.init_db()
+
+    def daily_summary(jobs):
+        summary_args = SimpleNamespace(by='project', period='daily', start=None,
+                                       end=None, jobs=jobs)
+        with contextlib.redirect_stdout(io.StringIO()):
+            timesheet.summary(summary_args)
+
+    reports = {
+        'summary --period daily': daily_summary,
+        'top_employees': lambda jobs: timesheet.top_employees(jobs=jobs),
+    }
+    print(f'rows: {args.rows:,}, cores: {os.cpu_count()}')
+    for name, run in reports.items():
+        print(name)
+        baseline = None
+        for jobs in job_counts(args.max_jobs):
+            secs = timed(lambda: run(jobs))
+            baseline = baseline or secs
+            print(f'    jobs {jobs:3}  {secs * 1000:9.1f} ms  x{baseline / secs:.2f}')
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
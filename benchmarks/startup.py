@@ -0,0 +1,99 @@
+"""Measure how long a fresh web worker takes to serve its first response.
+
+Usage::
+
+    python benchmarks/startup.py --runs 10
+
+Starts ``--runs`` new interpreters per case. Each imports ``web_app`` and
+serves ``GET /login`` through the test client. The time is split into
+interpreter start, ``import web_app`` and the first response, which includes
+the deferred schema check. The cases cover a database whose schema is
+current (the usual worker boot) and a new empty file. ``--eager`` also runs
+each case with the schema set up right after import, as ``web_app`` used to
+do on import. Bytecode caching is enabled for the workers and a warm-up run
+is discarded, so module compilation is not counted.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+WORKER = '''
+import json, time
+started = time.perf_counter()
+import web_app
+imported = time.perf_counter()
+if {eager}:
+    web_app.ensure_db()
+ready = time.perf_counter()
+status = web_app.create_app().test_client().get('/login').status_code
+done = time.perf_counter()
+print(json.dumps(dict(status=status, inprocess=done - started, import_=ready - started,
+                      response=done - ready)))
+'''
+
+
+def run_worker(path, eager):
+    env = dict(os.environ, TIMESHEET_DB=path)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    start = time.perf_counter()
+    out = subprocess.run([sys.executable, '-c', WORKER.format(eager=eager)], cwd=ROOT,
+                         env=env, check=True, capture_output=True, text=True).stdout
+    wall = time.perf_counter() - start
+    result = json.loads(out)
+    if result['status'] != 200:
+        raise SystemExit(f"worker answered {result['status']}")
+    return dict(interpreter=wall - result['inprocess'], import_=result['import_'],
+                response=result['response'], total=wall)
+
+
+def prepare(path, state):
+    """Create the database file for a run in the given ``state``."""
+    if os.path.exists(path):
+        os.remove(path)
+    if state == 'current':
+        subprocess.run([sys.executable, os.path.join(ROOT, 'timesheet.py'), '--db', path,
+                        'init'], check=True, stdout=subprocess.DEVNULL)
+    else:
+        open(path, 'w').close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--eager', action='store_true',
+                        help='Also measure schema setup right after import')
+    parser.add_argument('--dir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    path = os.path.join(args.dir, 'bench_startup.db')
+    modes = [False, True] if args.eager else [False]
+    prepare(path, 'current')
+    run_worker(path, False)
+    print(f'runs: {args.runs}, medians in ms')
+    print(f"{'database':9} {'init':8} {'interpreter':>11} {'import':>8} "
+          f"{'first resp':>10} {'total':>8}")
+    for state in ('current', 'new'):
+        for eager in modes:
+            samples = []
+            for _ in range(args.runs):
+                prepare(path, state)
+                samples.append(run_worker(path, eager))
+
+            def median(key):
+                return statistics.median(s[key] for s in samples) * 1000
+
+            print(f"{state:9} {'import' if eager else 'request':8} "
+                  f"{median('interpreter'):11.1f} {median('import_'):8.1f} "
+                  f"{median('response'):10.1f} {median('total'):8.1f}")
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
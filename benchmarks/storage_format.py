@@ -0,0 +1,126 @@
+"""Compare on-disk size and scan speed of the text and compact storage formats.
+
+Usage::
+
+    python benchmarks/storage_format.py --rows 10000000
+
+Both databases are created with ``timesheet.init_db`` so they carry the
+same indexes the application uses; rows are synthetic (500 employees,
+200 projects, five years of dates, half-hour increments).
+"""
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import timesheet  # noqa: E402
+
+EMPLOYEES = 500
+PROJECTS = 200
+FIRST_DAY = date(2019, 1, 1).toordinal()
+DAYS = 5 * 365
+
+
+def populate(path, compact, rows, batch=100000):
+    timesheet.STORAGE_FORMAT = 'compact' if compact else 'text'
+    timesheet.init_db(path)
+    rng = random.Random(42)
+    conn = sqlite3.connect(path)
+    conn.execute('PRAGMA journal_mode=OFF')
+    conn.execute('PRAGMA synchronous=OFF')
+    conn.executemany('INSERT INTO employees(id, name) VALUES (?, ?)',
+                     [(i, f'emp{i:04d}') for i in range(1, EMPLOYEES + 1)])
+    conn.executemany('INSERT INTO projects(id, name) VALUES (?, ?)',
+                     [(i, f'proj{i:03d}') for i in range(1, PROJECTS + 1)])
+    done = 0
+    while done < rows:
+        chunk = []
+        for _ in range(min(batch, rows - done)):
+            day = FIRST_DAY + rng.randrange(DAYS)
+            units = rng.randint(1, 20)
+            chunk.append((
+                rng.randint(1, EMPLOYEES),
+                rng.randint(1, PROJECTS),
+                day if compact else date.fromordinal(day).isoformat(),
+                units if compact else units / 2,
+            ))
+        conn.executemany(
+            'INSERT INTO timesheets(employee_id, project_id, entry_date, hours) '
+            'VALUES (?, ?, ?, ?)', chunk)
+        done += len(chunk)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+
+def timed(path, query, repeat=3):
+    conn = sqlite3.connect(path)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        conn.execute(query).fetchall()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    conn.close()
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10000000)
+    parser.add_argument('--dir', default=tempfile.gettempdir())
+    args = parser.parse_args()
+
+    queries = {
+        'full SUM(hours)': 'SELECT SUM(hours) FROM timesheets NOT INDEXED',
+        'monthly by project': 'SELECT month_key, project_id, SUM(hours) '
+                              'FROM timesheets GROUP BY month_key, project_id',
+        'employee date range': 'SELECT entry_date, SUM(hours) FROM timesheets '
+                               'WHERE employee_id = 7 GROUP BY entry_date',
+    }
+    results = {}
+    for fmt in ('text', 'compact'):
+        path = os.path.join(args.dir, f'bench_{fmt}.db')
+        if os.path.exists(path):
+            os.remove(path)
+        start = time.perf_counter()
+        populate(path, fmt == 'compact', args.rows)
+        load = time.perf_counter() - start
+        conn = sqlite3.connect(path)
+        page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+        table_pages = conn.execute(
+            "SELECT COUNT(*) FROM dbstat WHERE name = 'timesheets'"
+        ).fetchone()[0] if _has_dbstat(conn) else None
+        conn.close()
+        results[fmt] = dict(
+            size=os.path.getsize(path),
+            table=table_pages * page_size if table_pages is not None else None,
+            load=load,
+            timings={name: timed(path, sql) for name, sql in queries.items()},
+        )
+        os.remove(path)
+
+    print(f'rows: {args.rows:,}')
+    for fmt, res in results.items():
+        table = f", table {res['table'] / 2**20:.1f} MiB" if res['table'] else ''
+        print(f"{fmt:8} file {res['size'] / 2**20:.1f} MiB{table}, load {res['load']:.1f}s")
+        for name, secs in res['timings'].items():
+            print(f'    {name:22} {secs * 1000:9.1f} ms')
+
+
+def _has_dbstat(conn):
+    try:
+        conn.execute('SELECT 1 FROM dbstat LIMIT 1')
+        return True
+    except sqlite3.Error:
+        return False
+
+
+if __name__ == '__main__':
+    main()
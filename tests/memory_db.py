@@ -0,0 +1,41 @@
+"""In-memory databases for the test suite.
+
+``fresh_database()`` gives a test case its own in-memory database, copied
+from a template that is initialised once per run, so the suite writes no
+database files.  Point ``TIMESHEET_TEST_SEED`` at a database file to seed the
+template, for example with the synthetic data set of
+``benchmarks/storage_format.py``, and it is read from disk only once however
+many tests use it.
+"""
+import itertools
+import os
+
+import timesheet
+
+TEMPLATE_DB = ':memory:template'
+_test_databases = itertools.count()
+_template_ready = False
+
+
+def template_database():
+    """Return the template database, initialising it on first use."""
+    global _template_ready
+    if not _template_ready:
+        seed = os.environ.get('TIMESHEET_TEST_SEED')
+        if seed:
+            timesheet.load_database(seed, TEMPLATE_DB)
+        orig_db = timesheet.DB_FILE
+        timesheet.init_db(TEMPLATE_DB)
+        timesheet.DB_FILE = orig_db
+        _template_ready = True
+    return TEMPLATE_DB
+
+
+def fresh_database():
+    """Return a new in-memory copy of the template database.
+
+    Free it with ``timesheet.release_memory_db`` once the test is done.
+    """
+    path = f':memory:test{next(_test_databases)}'
+    timesheet.load_database(template_database(), path)
+    return path
@@ -1,31 +1,49 @@
+import importlib.util
 import os
 import sqlite3
+import sys
 import io
+import json
 import tempfile
 from contextlib import redirect_stdout
+from datetime import date
 from types import SimpleNamespace
 import unittest
+from unittest import mock
 
 import timesheet
+from tests.memory_db import fresh_database
 
 class TimesheetTests(unittest.TestCase):
     def setUp(self):
-        # Use a temporary database file for each test
-        self.db_fd, self.db_path = None, None
-        self.db_fd, self.db_path = tempfile.mkstemp()
+        # Use a fresh in-memory database for each test
         self.orig_db = timesheet.DB_FILE
-        timesheet.DB_FILE = self.db_path
-        timesheet.init_db()
+        self.db_path = fresh_database()
+        timesheet.init_db(self.db_path)
 
     def tearDown(self):
-        if self.db_fd:
-            os.close(self.db_fd)
-        if self.db_path and os.path.exists(self.db_path):
-            os.remove(self.db_path)
+        timesheet.release_memory_db(self.db_path)
         timesheet.DB_FILE = self.orig_db
 
+    def approve_all(self):
+        """Mark every open entry manager-approved, ready for ``close_period``."""
+        def run(cur):
+            cur.execute("UPDATE timesheets SET status = 'manager_approved' "
+                        "WHERE status <> 'locked'")
+            cur.connection.commit()
+        timesheet.fan_out(run)
+
+    def use_database_file(self):
+        """Move the test onto a temporary file, for shards and ``maintain``."""
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        timesheet.release_memory_db(self.db_path)
+        self.db_path = path
+        timesheet.init_db(path)
+
     def test_init_db_creates_tables(self):
-        with sqlite3.connect(self.db_path) as conn:
+        with timesheet.connect_db() as conn:
             cur = conn.cursor()
             cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
             tables = {row[0] for row in cur.fetchall()}
@@ -40,7 +58,7 @@ class TimesheetTests(unittest.TestCase):
 
     def test_init_db_adds_missing_remarks_column(self):
         """Older databases may not have the remarks column."""
-        with sqlite3.connect(self.db_path) as conn:
+        with timesheet.connect_db() as conn:
             cur = conn.cursor()
             cur.execute("DROP TABLE timesheets")
             cur.execute(
@@ -58,7 +76,7 @@ class TimesheetTests(unittest.TestCase):
 
         timesheet.init_db()
 
-        with sqlite3.connect(self.db_path) as conn:
+        with timesheet.connect_db() as conn:
             cur = conn.cursor()
             cur.execute("PRAGMA table_info(timesheets)")
             cols = {row[1] for row in cur.fetchall()}
@@ -70,7 +88,7 @@ class TimesheetTests(unittest.TestCase):
         with redirect_stdout(buf):
             timesheet.log_time(args)
         output = buf.getvalue()
-        with sqlite3.connect(self.db_path) as conn:
+        with timesheet.connect_db() as conn:
             cur = conn.cursor()
             cur.execute("SELECT COUNT(*) FROM timesheets")
             count = cur.fetchone()[0]
@@ -111,6 +129,733 @@ class TimesheetTests(unittest.TestCase):
         self.assertIn('ProjA', output)
         self.assertIn('3.5h', output)
 
+    def test_report_and_summary_machine_formats(self):
+        for emp, dt, hours in [('Alice', '2023-01-01', 2.0), ('Bob', '2023-01-02', 1.5),
+                               ('Alice', '2023-02-03', 3.0)]:
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(SimpleNamespace(employee=emp, project='Proj',
+                                                   hours=hours, date=dt))
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.report(SimpleNamespace(project='Proj', start=None, end=None,
+                                             summary=None, format='csv'))
+        self.assertEqual(buf.getvalue().splitlines(), [
+            'project,employee,date,hours,running_total',
+            'Proj,Alice,2023-01-01,2.0,2.0',
+            'Proj,Bob,2023-01-02,1.5,3.5',
+            'Proj,Alice,2023-02-03,3.0,6.5',
+        ])
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.summary(SimpleNamespace(by='employee', period='monthly', start=None,
+                                              end=None, format='jsonl'))
+        self.assertEqual([json.loads(line) for line in buf.getvalue().splitlines()], [
+            {'employee': 'Alice', 'monthly': '2023-01', 'hours': 2.0, 'running_total': 2.0},
+            {'employee': 'Alice', 'monthly': '2023-02', 'hours': 3.0, 'running_total': 5.0},
+            {'employee': 'Bob', 'monthly': '2023-01', 'hours': 1.5, 'running_total': 1.5},
+        ])
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.report(SimpleNamespace(project='Proj', start='2024-01-01', end=None,
+                                             summary='date', format='tsv'))
+        self.assertEqual(buf.getvalue(), 'date\thours\trunning_total\n')
+
+    def test_summary_quarterly_and_iso_week_periods(self):
+        for emp, hrs, dt in [('Alice', 2.0, '2021-01-03'), ('Bob', 1.0, '2021-01-04')]:
+            args = SimpleNamespace(employee=emp, project='ProjA', hours=hrs, date=dt)
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.summary(SimpleNamespace(by='project', period='isoweekly', start=None, end=None))
+        output = buf.getvalue()
+        self.assertIn('ProjA | 2020-W53 | 2.0h', output)
+        self.assertIn('ProjA | 2021-W01 | 1.0h', output)
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.summary(SimpleNamespace(by='employee', period='quarterly',
+                                              start='2021-01-04', end=None))
+        self.assertEqual(buf.getvalue().strip(), 'Bob | 2021-Q1 | 1.0h')
+
+    def test_init_db_rebuilds_timesheets_with_period_keys(self):
+        with timesheet.connect_db() as conn:
+            cur = conn.cursor()
+            cur.execute("DROP TABLE timesheets")
+            cur.execute(
+                '''CREATE TABLE timesheets (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    employee_id INTEGER NOT NULL,
+                    project_id INTEGER NOT NULL,
+                    entry_date TEXT NOT NULL,
+                    hours REAL NOT NULL,
+                    remarks TEXT
+                )'''
+            )
+            cur.execute(
+                "INSERT INTO timesheets(id, employee_id, project_id, entry_date, hours) "
+                "VALUES (7, 1, 1, '2023-05-17', 4)"
+            )
+            conn.commit()
+
+        timesheet.init_db()
+
+        with timesheet.connect_db() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                'SELECT id, day_ordinal, week_key, iso_week, month_key, quarter_key '
+                'FROM timesheets'
+            )
+            row = cur.fetchone()
+        self.assertEqual(row, (7, 738657, '2023-20', '2023-W20', '2023-05', '2023-Q2'))
+
+    def test_migrate_storage_to_compact_keeps_reports(self):
+        for emp, hrs, dt in [('Alice', 2.5, '2023-01-01'), ('Bob', 1.5, '2023-01-02')]:
+            args = SimpleNamespace(employee=emp, project='Proj', hours=hrs, date=dt)
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+
+        try:
+            with redirect_stdout(io.StringIO()):
+                timesheet.migrate_storage(SimpleNamespace(format='compact'))
+            with timesheet.connect_db() as conn:
+                cur = conn.cursor()
+                cur.execute('SELECT entry_date, hours FROM timesheets ORDER BY id')
+                self.assertEqual(cur.fetchall(), [(738521, 5), (738522, 3)])
+
+            args = SimpleNamespace(employee='Alice', project='Proj', hours=0.5, date='2023-01-02')
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+            buf = io.StringIO()
+            with redirect_stdout(buf):
+                timesheet.report(SimpleNamespace(project='Proj', start='2023-01-02',
+                                                 end=None, summary='date'))
+            self.assertIn('2023-01-02 | 2.0h', buf.getvalue())
+            self.assertEqual(timesheet.top_employees('Proj'), [('Alice', 3.0), ('Bob', 1.5)])
+        finally:
+            timesheet.COMPACT_STORAGE = False
+
+    def test_report_cache_invalidates_only_covering_ranges(self):
+        for dt in ('2023-01-10', '2023-03-10'):
+            args = SimpleNamespace(employee='Alice', project='Proj', hours=2.0, date=dt)
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+
+        january = timesheet.top_employees('Proj', '2023-01-01', '2023-01-31')
+        march = timesheet.top_employees('Proj', '2023-03-01', '2023-03-31')
+        self.assertEqual(january, [('Alice', 2.0)])
+        stats = timesheet.report_cache_stats()
+
+        args = SimpleNamespace(employee='Bob', project='Proj', hours=1.0, date='2023-03-15')
+        with redirect_stdout(io.StringIO()):
+            timesheet.log_time(args)
+
+        self.assertEqual(timesheet.top_employees('Proj', '2023-01-01', '2023-01-31'), january)
+        self.assertEqual(timesheet.report_cache_stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(
+            timesheet.top_employees('Proj', '2023-03-01', '2023-03-31'),
+            march + [('Bob', 1.0)],
+        )
+        self.assertEqual(timesheet.report_cache_stats()['invalidations'],
+                         stats['invalidations'] + 1)
+
+    def test_team_approval_and_lock_blocks_changes(self):
+        with timesheet.connect_db() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                "INSERT INTO users (id, full_name, email, username, password, department, role, status) "
+                "VALUES (1, 'Boss', 'boss@example.com', 'boss', 'x', 'IT', 'Project Manager', 'Active')"
+            )
+            cur.execute(
+                "INSERT INTO users (full_name, email, username, password, department, role, status, reporting_manager) "
+                "VALUES ('Alice', 'alice@example.com', 'alice', 'x', 'IT', 'Employee', 'Active', 1)"
+            )
+            conn.commit()
+        for emp, dt in [('Alice', '2023-01-02'), ('Alice', '2023-02-02'), ('Carol', '2023-01-03')]:
+            args = SimpleNamespace(employee=emp, project='Proj', hours=2.0, date=dt)
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+
+        self.assertEqual(timesheet.pending_approval_counts(), {'submitted': 3})
+        # Without a team filter nothing moves, rather than the whole company.
+        with self.assertRaises(ValueError):
+            timesheet.transition_entries('approve', '2023-01-01', '2023-01-31')
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.bulk_transition(SimpleNamespace(action='approve', start=None, end=None,
+                                                      manager=None, department=None))
+        self.assertEqual(buf.getvalue(), 'A manager or department is required\n')
+        self.assertEqual(timesheet.pending_approval_counts(), {'submitted': 3})
+        self.assertEqual(timesheet.transition_entries('lock', manager_id=1), 0)
+        self.assertEqual(
+            timesheet.transition_entries('approve', '2023-01-01', '2023-01-31', manager_id=1), 1
+        )
+        self.assertEqual(timesheet.transition_entries('lock', manager_id=1), 1)
+        self.assertEqual(timesheet.pending_approval_counts(), {'submitted': 2})
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.update_time(SimpleNamespace(
+                id=None, employee='Alice', project='Proj', entry_date='2023-01-02',
+                new_hours=5.0, new_date=None))
+            timesheet.delete_time(SimpleNamespace(
+                id=None, employee='Alice', project='Proj', entry_date='2023-01-02'))
+        self.assertIn('is locked and cannot be changed', buf.getvalue())
+        self.assertIn('is locked and cannot be deleted', buf.getvalue())
+        self.assertEqual(timesheet.top_employees('Proj', '2023-01-02', '2023-01-02'),
+                         [('Alice', 2.0)])
+
+    def test_closed_period_served_from_snapshot(self):
+        for emp, dt in [('Alice', '2023-01-10'), ('Bob', '2023-02-10')]:
+            args = SimpleNamespace(employee=emp, project='Proj', hours=2.0, date=dt)
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+
+        with self.assertRaisesRegex(ValueError, '1 entries awaiting approval'):
+            timesheet.close_period('2023-01')
+        self.assertEqual(timesheet.pending_approval_counts(), {'submitted': 2})
+        self.approve_all()
+        self.assertEqual(timesheet.close_period('2023-01'), 1)
+        with self.assertRaises(ValueError):
+            timesheet.close_period('2023-01')
+        buf = io.StringIO()
+        with redirect_stdout(buf), self.assertRaises(SystemExit):
+            timesheet.log_time(SimpleNamespace(employee='Bob', project='Proj',
+                                               hours=1.0, date='2023-01-11'))
+        self.assertIn('period is closed', buf.getvalue())
+
+        # Closed months are read from the snapshot, not from the raw rows.
+        with timesheet.connect_db() as conn:
+            conn.execute("UPDATE period_aggregates SET hours = 7 WHERE month_key = '2023-01'")
+        self.assertEqual(timesheet.top_employees('Proj', '2023-01-01', '2023-02-28'),
+                         [('Alice', 7.0), ('Bob', 2.0)])
+        # A range only partly covering the month still aggregates raw rows.
+        self.assertCountEqual(timesheet.top_employees('Proj', '2023-01-05', '2023-02-28'),
+                              [('Alice', 2.0), ('Bob', 2.0)])
+
+    def use_shards(self, count=2):
+        """Move the test onto a database file with ``count`` hash shards."""
+        self.use_database_file()
+        shards = []
+        for _ in range(count):
+            fd, path = tempfile.mkstemp()
+            os.close(fd)
+            self.addCleanup(os.remove, path)
+            shards.append(path)
+        orig = timesheet.SHARDS, timesheet.SHARD_BY
+        self.addCleanup(setattr, timesheet, 'SHARDS', orig[0])
+        self.addCleanup(setattr, timesheet, 'SHARD_BY', orig[1])
+        timesheet.SHARDS, timesheet.SHARD_BY = shards, 'hash'
+        timesheet.init_db()
+        return shards
+
+    def test_sharded_entries_are_routed_and_merged(self):
+        shards = self.use_shards()
+
+        opened = []
+        connect_db = timesheet.connect_db
+
+        def tracking_connect(path=None):
+            conn = connect_db(path)
+            if path in shards:
+                opened.append(conn)
+            return conn
+
+        names = ['Alice', 'Bob', 'Carol', 'Dave']
+        with mock.patch.object(timesheet, 'connect_db', tracking_connect):
+            for name in names:
+                for dt in ('2023-01-10', '2023-01-11'):
+                    args = SimpleNamespace(employee=name, project='Proj', hours=2.0, date=dt)
+                    with redirect_stdout(io.StringIO()):
+                        timesheet.log_time(args)
+        # Every shard connection opened for a write has been closed again.
+        self.assertTrue(opened)
+        for conn in opened:
+            with self.assertRaises(sqlite3.ProgrammingError):
+                conn.execute('SELECT 1')
+
+        counts = []
+        for path in [self.db_path] + shards:
+            with sqlite3.connect(path) as conn:
+                counts.append(conn.execute('SELECT COUNT(*) FROM timesheets').fetchone()[0])
+        self.assertEqual(counts[0], 0)
+        self.assertEqual(sum(counts), 8)
+        self.assertTrue(all(counts[1:]))
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.summary(SimpleNamespace(by='project', period=None, start=None, end=None))
+        self.assertEqual(buf.getvalue(), 'Proj | 16.0h\n')
+        self.assertCountEqual(timesheet.top_employees('Proj'),
+                              [(name, 4.0) for name in names])
+
+        # Entry ids carry their shard, so updates go straight to it.
+        with sqlite3.connect(shards[1]) as conn:
+            entry_id = conn.execute('SELECT MIN(id) FROM timesheets').fetchone()[0]
+        self.assertGreaterEqual(entry_id, 2 * timesheet.SHARD_ID_SPAN)
+        with redirect_stdout(io.StringIO()):
+            timesheet.update_time(SimpleNamespace(id=entry_id, employee=None, project=None,
+                                                  entry_date=None, new_hours=5.0,
+                                                  new_date=None))
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.report(SimpleNamespace(project='Proj', start=None, end=None,
+                                             summary=None))
+        self.assertIn('Total hours for Proj: 19.0', buf.getvalue())
+        self.approve_all()
+        self.assertEqual(timesheet.close_period('2023-01'), 4)
+        self.assertEqual(timesheet.pending_approval_counts(), {})
+
+    def test_sharded_close_checks_every_shard_and_resumes(self):
+        shards = self.use_shards()
+        for name in ('Alice', 'Bob', 'Carol', 'Dave'):
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(SimpleNamespace(employee=name, project='Proj',
+                                                   hours=2.0, date='2023-01-10'))
+
+        def closed():
+            return [sqlite3.connect(path).execute(
+                'SELECT COUNT(*) FROM closed_periods').fetchone()[0] for path in shards]
+
+        # One shard still awaiting approval keeps every shard open.
+        with sqlite3.connect(shards[0]) as conn:
+            conn.execute("UPDATE timesheets SET status = 'manager_approved'")
+        with self.assertRaisesRegex(ValueError, 'entries awaiting approval'):
+            timesheet.close_period('2023-01')
+        self.assertEqual(closed(), [0, 0])
+
+        # A retry after only the first shard closed finishes the others.
+        self.approve_all()
+        with sqlite3.connect(shards[0]) as conn:
+            conn.execute("INSERT INTO closed_periods VALUES ('2023-01', '2024-01-01')")
+        with sqlite3.connect(shards[1]) as conn:
+            aggregates = conn.execute(
+                'SELECT COUNT(DISTINCT employee_id) FROM timesheets').fetchone()[0]
+        self.assertEqual(timesheet.close_period('2023-01'), aggregates)
+        self.assertEqual(closed(), [1, 1])
+        with self.assertRaisesRegex(ValueError, 'already closed'):
+            timesheet.close_period('2023-01')
+
+
+    def test_partitioned_reports_match_single_query(self):
+        self.assertEqual(timesheet.date_partitions('2023-01-01', '2023-06-30', 3), [
+            ('2023-01-01', '2023-02-28'),
+            ('2023-03-01', '2023-04-30'),
+            ('2023-05-01', '2023-06-30'),
+        ])
+        for emp, dt, hours in [('Alice', '2023-01-10', 10.0), ('Bob', '2023-02-20', 3.0),
+                               ('Alice', '2023-03-05', 10.0), ('Bob', '2023-05-01', 4.0),
+                               ('Alice', '2023-06-30', 10.0)]:
+            args = SimpleNamespace(employee=emp, project='Proj', hours=hours, date=dt)
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+        self.approve_all()
+        timesheet.close_period('2023-01')
+
+        outputs = []
+        for jobs in (1, 3):
+            buf = io.StringIO()
+            with redirect_stdout(buf):
+                timesheet.summary(SimpleNamespace(by='employee', period='weekly',
+                                                  start=None, end=None, jobs=jobs))
+            outputs.append(buf.getvalue())
+        self.assertEqual(outputs[0], outputs[1])
+        self.assertEqual(timesheet.top_employees('Proj', limit=1, jobs=3), [('Alice', 30.0)])
+        self.assertEqual(timesheet.overworked_employees(jobs=3), ['Alice'])
+
+
+    def test_maintain_backs_up_and_vacuums_live_database(self):
+        self.use_database_file()
+        with redirect_stdout(io.StringIO()):
+            timesheet.log_time(SimpleNamespace(employee='Alice', project='Proj',
+                                               hours=1.0, date='2023-01-05'))
+        with timesheet.connect_db() as conn:
+            conn.executemany(
+                'INSERT INTO timesheets (employee_id, project_id, entry_date, hours, remarks) '
+                "VALUES (1, 1, '2023-01-06', 1, ?)", [('x' * 1000,) for _ in range(200)])
+            conn.execute("DELETE FROM timesheets WHERE entry_date = '2023-01-06'")
+
+        backup_tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(backup_tmp.cleanup)
+        backup_dir = backup_tmp.name
+        args = timesheet.parse_args(['maintain', '--backup', backup_dir, '--pages', '8',
+                                     '--sleep', '0'])
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.maintain(args)
+        output = buf.getvalue()
+        backup = os.path.join(backup_dir, os.path.basename(self.db_path))
+        self.assertEqual([line.split()[0] for line in output.splitlines()],
+                         ['backup', 'analyze', 'vacuum', 'check'])
+        self.assertIn(f'{backup}: ok', output)
+        with timesheet.connect_db() as conn:
+            self.assertEqual(conn.execute('PRAGMA freelist_count').fetchone()[0], 0)
+            self.assertTrue(timesheet._schema_current(conn.cursor()))
+        with sqlite3.connect(backup) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM timesheets').fetchone()[0], 1)
+
+    def test_memory_database_snapshot_and_load(self):
+        self.addCleanup(timesheet.release_memory_db, ':memory:a')
+        self.addCleanup(timesheet.release_memory_db, ':memory:b')
+        timesheet.init_db(':memory:a')
+        with redirect_stdout(io.StringIO()):
+            timesheet.log_time(SimpleNamespace(employee='Alice', project='Proj',
+                                               hours=2.0, date='2023-01-05'))
+        # Every connection of the process sees the same database.
+        conn = timesheet.connect_db()
+        self.assertEqual(conn.execute('SELECT COUNT(*) FROM timesheets').fetchone()[0], 1)
+        conn.close()
+        self.assertFalse(os.path.exists(':memory:a'))
+
+        fd, snapshot = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, snapshot)
+        timesheet.snapshot_database(snapshot)
+        timesheet.load_database(snapshot, ':memory:b')
+        timesheet.init_db(':memory:b')
+        with redirect_stdout(io.StringIO()):
+            timesheet.log_time(SimpleNamespace(employee='Bob', project='Proj',
+                                               hours=1.0, date='2023-01-06'))
+        self.assertEqual(timesheet.top_employees('Proj'), [('Alice', 2.0), ('Bob', 1.0)])
+
+        timesheet.release_memory_db(':memory:a')
+        timesheet.init_db(':memory:a')
+        self.assertEqual(timesheet.top_employees('Proj'), [])
+        with sqlite3.connect(snapshot) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM timesheets').fetchone()[0], 1)
+
+    def test_batch_runs_commands_and_rolls_back_failures(self):
+        with redirect_stdout(io.StringIO()):
+            timesheet.log_time(SimpleNamespace(employee='Alice', project='Proj',
+                                               hours=1.0, date='2023-01-05'))
+        self.approve_all()
+        timesheet.close_period('2023-01')
+        fd, path = tempfile.mkstemp()
+        self.addCleanup(os.remove, path)
+        with os.fdopen(fd, 'w') as fh:
+            fh.write('add-employee Bob\n'
+                     '["log", "Bob", "New Project", "2", "--date", "2023-02-01"]\n'
+                     'log Carol Proj 1 --date 2023-01-06\n')
+        with redirect_stdout(io.StringIO()), self.assertRaises(SystemExit):
+            timesheet.run_batch(SimpleNamespace(file=path, group=2))
+        self.assertIsNone(timesheet._BATCH_CONNECTION)
+        with timesheet.connect_db() as conn:
+            names = [r[0] for r in conn.execute('SELECT name FROM employees ORDER BY name')]
+            hours = conn.execute('SELECT SUM(hours) FROM timesheets').fetchone()[0]
+        # The closed-period insert failed, taking Carol's creation with it.
+        self.assertEqual(names, ['Alice', 'Bob'])
+        self.assertEqual(hours, 3.0)
+
+
+    def test_bulk_update_and_delete_by_filter(self):
+        for emp, proj, dt in [('Alice', 'Wrong', '2023-03-01'), ('Alice', 'Wrong', '2023-03-02'),
+                              ('Alice', 'Wrong', '2023-04-01'), ('Bob', 'Wrong', '2023-03-01'),
+                              ('Alice', 'Right', '2023-02-01')]:
+            args = SimpleNamespace(employee=emp, project=proj, hours=2.0, date=dt)
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+        with timesheet.connect_db() as conn:
+            conn.execute("UPDATE timesheets SET status = 'locked' WHERE entry_date = ?",
+                         (timesheet.to_storage_date('2023-03-02'),))
+
+        march = dict(employee='Alice', project='Wrong', start='2023-03-01', end='2023-03-31')
+        self.assertEqual(timesheet.bulk_change('update', new_project='Right', dry_run=True,
+                                               **march), (1, 1))
+        self.assertEqual(timesheet.bulk_change('update', new_project='Right', **march), (1, 1))
+        self.assertEqual(timesheet.top_employees('Right'), [('Alice', 4.0)])
+        with self.assertRaises(ValueError):
+            timesheet.bulk_change('delete')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.bulk_edit(SimpleNamespace(action='delete', employee=None, project='Wrong',
+                                                start=None, end=None, ids=None, dry_run=False))
+        self.assertEqual(buf.getvalue(), '2 entries deleted\n1 locked entries skipped\n')
+
+
+    def test_get_or_create_is_atomic_and_cached(self):
+        with timesheet.connect_db() as conn:
+            cur = conn.cursor()
+            self.assertEqual(timesheet.get_or_create(cur, 'projects', 'Race')[1], True)
+            conn.commit()
+            race_id = timesheet.lookup_id(cur, 'projects', 'Race')
+            self.assertIn((self.db_path, 'projects', 'Race'), timesheet._NAME_CACHE)
+
+            # A concurrent writer added the name after our lookup missed.
+            with mock.patch.object(timesheet, 'lookup_id', side_effect=[None, race_id]):
+                self.assertEqual(timesheet.get_or_create(cur, 'projects', 'Race'),
+                                 (race_id, False))
+            with self.assertRaises(ValueError):
+                timesheet.get_or_create(cur, 'users', 'Race')
+        timesheet.init_db()
+        self.assertEqual(timesheet._NAME_CACHE, {})
+
+
+    def test_duplicate_policies_upsert_on_natural_key(self):
+        def log(hours, employee='Alice'):
+            buf = io.StringIO()
+            with redirect_stdout(buf):
+                timesheet.log_time(SimpleNamespace(employee=employee, project='Proj',
+                                                   hours=hours, date='2023-01-02'))
+            return buf.getvalue()
+
+        def rows():
+            with timesheet.connect_db() as conn:
+                return conn.execute('SELECT employee_id, hours FROM timesheets').fetchall()
+
+        log(2.0)
+        log(2.0)
+        with self.assertRaises(ValueError):
+            timesheet.set_duplicate_policy('add')
+        with timesheet.connect_db() as conn:
+            conn.execute('DELETE FROM timesheets WHERE id = 2')
+
+        timesheet.set_duplicate_policy('add')
+        log(3.0)
+        self.assertEqual(rows(), [(1, 5.0)])
+        timesheet.set_duplicate_policy('replace')
+        timesheet.init_db()
+        self.assertEqual(timesheet.DUPLICATE_POLICY, 'replace')
+        log(1.5)
+        self.assertEqual(rows(), [(1, 1.5)])
+        with redirect_stdout(io.StringIO()):
+            timesheet.migrate_storage(SimpleNamespace(format='compact'))
+        with timesheet.connect_db() as conn:
+            self.assertTrue(conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE name = 'idx_timesheets_natural_key'"
+            ).fetchone())
+        timesheet.set_duplicate_policy('reject')
+        buf = io.StringIO()
+        with redirect_stdout(buf), self.assertRaises(SystemExit):
+            timesheet.log_time(SimpleNamespace(employee='Alice', project='Proj',
+                                               hours=1.0, date='2023-01-02'))
+        self.assertIn('already exists', buf.getvalue())
+        self.assertEqual(log(1.0, employee='Bob'), 'Time entry recorded\n')
+        timesheet.set_duplicate_policy('off')
+        log(1.0)
+        self.assertEqual(len(rows()), 3)
+
+
+    def test_user_hierarchy_team_rollups(self):
+        org = [('VP', None), ('Director', 1), ('Manager', 2), ('Alice', 3), ('Bob', 2),
+               ('Carol', None)]
+        with timesheet.connect_db() as conn:
+            for name, manager in org:
+                conn.execute(
+                    'INSERT INTO users (full_name, email, username, password, department, '
+                    'role, status, reporting_manager) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (name, f'{name}@example.com', name, 'x', 'IT', 'Employee', 'Active',
+                     manager),
+                )
+        for name in ('Alice', 'Bob', 'Carol'):
+            args = SimpleNamespace(employee=name, project='Proj', hours=2.0, date='2023-01-02')
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+
+        self.assertCountEqual(timesheet.top_employees(under=1), [('Alice', 2.0), ('Bob', 2.0)])
+        self.assertEqual(timesheet.top_employees(under=3), [('Alice', 2.0)])
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.summary(SimpleNamespace(by='project', period=None, start=None,
+                                              end=None, under=2))
+        self.assertEqual(buf.getvalue(), 'Proj | 4.0h\n')
+
+        # Moving the manager moves Alice with them and refreshes cached rollups.
+        with timesheet.connect_db() as conn:
+            conn.execute('UPDATE users SET reporting_manager = 6 WHERE id = 3')
+            with self.assertRaises(sqlite3.IntegrityError):
+                conn.execute('UPDATE users SET reporting_manager = 4 WHERE id = 6')
+        self.assertEqual(timesheet.top_employees(under=1), [('Bob', 2.0)])
+        with timesheet.connect_db() as conn:
+            conn.execute('DROP TABLE user_hierarchy')
+        timesheet.init_db()
+        with timesheet.connect_db() as conn:
+            depth = conn.execute('SELECT depth FROM user_hierarchy '
+                                 'WHERE ancestor = 6 AND descendant = 4').fetchone()
+        self.assertEqual(depth, (2,))
+        self.assertEqual(timesheet.top_employees(under=6), [('Alice', 2.0)])
+
+
+    def test_assigned_projects_are_cached_per_user(self):
+        with timesheet.connect_db() as conn:
+            for name in ('Alice', 'Bob'):
+                conn.execute(
+                    'INSERT INTO users (full_name, email, username, password, department, '
+                    'role, status) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (name, f'{name}@example.com', name, 'x', 'IT', 'Employee', 'Active'),
+                )
+            for code in ('Apollo', 'Zephyr'):
+                conn.execute('INSERT INTO project_master (project_name, project_code) '
+                             'VALUES (?, ?)', (code, code[:3]))
+        timesheet.assign_projects(2, [1])
+        self.assertEqual(timesheet.assigned_projects('Alice'), ['Zephyr'])
+        self.assertEqual(timesheet.assigned_projects('Bob'), [])
+
+        # Writes from another process bump the data generation, which
+        # invalidates the cached sets well before their TTL.
+        timesheet.ASSIGNMENT_CACHE_TTL = 3600
+        self.addCleanup(setattr, timesheet, 'ASSIGNMENT_CACHE_TTL', 60)
+        self.assertEqual(timesheet.assigned_projects('Bob'), [])
+        with timesheet.connect_db() as conn:
+            conn.execute('INSERT INTO project_assignments VALUES (1, 2)')
+        self.assertEqual(timesheet.assigned_projects('Bob'), ['Apollo'])
+        timesheet.assign_projects(1, [1, 2])
+        self.assertEqual(timesheet.assigned_projects('Alice'), ['Apollo', 'Zephyr'])
+        self.assertEqual(timesheet.assigned_projects('Bob'), ['Apollo'])
+
+        self.assertFalse(timesheet.RESTRICT_PROJECTS)
+        with redirect_stdout(io.StringIO()):
+            timesheet.restrict_projects_cmd(SimpleNamespace(mode='on'))
+        timesheet.RESTRICT_PROJECTS = False
+        timesheet.init_db()
+        self.assertTrue(timesheet.RESTRICT_PROJECTS)
+        with redirect_stdout(io.StringIO()):
+            timesheet.restrict_projects_cmd(SimpleNamespace(mode='off'))
+        self.assertFalse(timesheet.RESTRICT_PROJECTS)
+
+    def test_overwork_alerts_follow_writes(self):
+        def log(day, hours, employee='Alice'):
+            args = SimpleNamespace(employee=employee, project='Proj', hours=hours,
+                                   date=f'2023-01-{day:02d}')
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(args)
+
+        def streaks():
+            with timesheet.connect_db() as conn:
+                return conn.execute('SELECT day_ordinal - ?, streak FROM overwork_alerts '
+                                    'ORDER BY day_ordinal',
+                                    (date(2023, 1, 1).toordinal() - 1,)).fetchall()
+
+        for day in (1, 2, 4, 5):
+            log(day, 10)
+        log(3, 6)
+        log(9, 8)
+        self.assertEqual(streaks(), [(1, 1), (2, 2), (4, 1), (5, 2)])
+        # Filling the gap joins the runs; a second entry pushes day 9 over.
+        log(3, 4)
+        log(9, 2)
+        self.assertEqual(streaks(), [(1, 1), (2, 2), (3, 3), (4, 4), (5, 5), (9, 1)])
+        self.assertEqual(timesheet.overwork_alerts(),
+                         [('Alice', 6, 5, '2023-01-09')])
+
+        with timesheet.connect_db() as conn:
+            conn.execute("DELETE FROM timesheets WHERE entry_date = '2023-01-02'")
+            conn.execute("UPDATE timesheets SET hours = 1 WHERE entry_date = '2023-01-09'")
+        self.assertEqual(streaks(), [(1, 1), (3, 1), (4, 2), (5, 3)])
+        self.assertEqual(timesheet.overworked_employees(), ['Alice'])
+        self.assertEqual(timesheet.overworked_employees('2023-01-04'), [])
+        self.assertEqual(timesheet.overworked_employees(threshold=9.5, days=4), ['Alice'])
+        for day in (10, 11, 12, 13, 14):
+            log(day, 10, employee='Bob')
+        self.assertEqual(timesheet.overwork_alerts()[0][0], 'Bob')
+        self.assertEqual(timesheet.overworked_employees(), ['Alice', 'Bob'])
+        with timesheet.connect_db() as conn:
+            conn.execute("DELETE FROM timesheets WHERE employee_id = "
+                         "(SELECT id FROM employees WHERE name = 'Bob')")
+
+        # Rebuilding from scratch gives the same alerts as the incremental path.
+        with timesheet.connect_db() as conn:
+            conn.execute('DROP TABLE daily_totals')
+        timesheet.init_db()
+        self.assertEqual(streaks(), [(1, 1), (3, 1), (4, 2), (5, 3)])
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.show_alerts(SimpleNamespace(start=None, end=None, days=4, under=None))
+        self.assertEqual(buf.getvalue(), 'Alice | 4 days over 9h | longest streak 3 | last 2023-01-05\n')
+
+
+    def test_missing_timesheets_anti_join(self):
+        people = [('Alice', 'IT', 'Active', '2023-01-04'), ('Bob', 'Ops', 'Active', None),
+                  ('Carol', 'IT', 'Inactive', None)]
+        with timesheet.connect_db() as conn:
+            for name, dept, status, joined in people:
+                conn.execute(
+                    'INSERT INTO users (full_name, email, username, password, department, '
+                    'role, status, date_of_joining) VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                    (name, f'{name}@example.com', name, 'x', dept, 'Employee', status, joined),
+                )
+        entries = [('Alice', 2, '2023-01-05'), ('Alice', 8, '2023-01-06'),
+                   ('Bob', 8, '2023-01-02'), ('Bob', 4, '2023-01-03'), ('Bob', 4, '2023-01-03')]
+        for name, hours, day in entries:
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(SimpleNamespace(employee=name, project='Proj',
+                                                   hours=hours, date=day))
+
+        # Monday 2 to Sunday 8; Alice joined on Wednesday 4.
+        week = ('2023-01-02', '2023-01-08')
+        self.assertEqual(timesheet.missing_timesheets(*week), [
+            ('Alice', '2023-01-04'),
+            ('Bob', '2023-01-04'), ('Bob', '2023-01-05'), ('Bob', '2023-01-06'),
+        ])
+        self.assertEqual(timesheet.missing_timesheets(*week, min_hours=8, department='IT'),
+                         [('Alice', '2023-01-04'), ('Alice', '2023-01-05')])
+        with self.assertRaises(ValueError):
+            timesheet.missing_timesheets('2023-13-01')
+
+        buf = io.StringIO()
+        with redirect_stdout(buf):
+            timesheet.compliance_report(SimpleNamespace(
+                start='2023-01-02', end='2023-01-04', min_hours=8, department=None,
+                under=None))
+        self.assertEqual(buf.getvalue(), 'Alice | 1 missing | 2023-01-04\n'
+                                         'Bob | 1 missing | 2023-01-04\n')
+
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_utilization_matrix_pivots_hours_per_period(self):
+        entries = [('Bob', '2023-01-02', 8), ('Alice', '2023-01-03', 4),
+                   ('Alice', '2023-01-03', 4), ('Alice', '2023-01-10', 6),
+                   ('Bob', '2023-01-15', 2)]
+        for name, day, hours in entries:
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(SimpleNamespace(employee=name, project='Proj',
+                                                   hours=hours, date=day))
+
+        employees, periods, hours, available, utilization = timesheet.utilization_matrix(
+            '2023-01-02', '2023-01-15')
+        self.assertEqual(employees, ('Alice', 'Bob'))
+        self.assertEqual(periods, ('2023-W01', '2023-W02'))
+        self.assertEqual(hours.tolist(), [[8, 6], [8, 2]])
+        self.assertEqual(available.tolist(), [40, 40])
+        self.assertEqual(utilization.tolist(), [[0.2, 0.15], [0.2, 0.05]])
+        self.assertFalse(hours.flags.writeable)
+
+        # Open ranges stop at the first and last entry: 10 workdays from
+        # 2023-01-02 to 2023-01-15.
+        matrix = timesheet.utilization_matrix(period='monthly', capacity=5)
+        self.assertEqual(matrix[3].tolist(), [50])
+        self.assertEqual(''.join(timesheet.utilization_csv(matrix, 'hours')),
+                         'employee,2023-01\r\nAlice,14\r\nBob,10\r\n')
+        buf = io.BytesIO()
+        self.assertEqual(timesheet.utilization_npy(matrix, buf), (2, 1))
+
+        with mock.patch.dict(sys.modules, {'numpy': None}):
+            with self.assertRaises(RuntimeError):
+                timesheet.utilization_matrix('2023-01-01', '2023-02-01')
+
+    def test_utilization_matrix_daily_under_compact_storage(self):
+        for name, day, hours in [('Alice', '2023-01-02', 4), ('Bob', '2023-01-03', 6),
+                                 ('Alice', '2023-01-04', 2)]:
+            with redirect_stdout(io.StringIO()):
+                timesheet.log_time(SimpleNamespace(employee=name, project='Proj',
+                                                   hours=hours, date=day))
+        try:
+            with redirect_stdout(io.StringIO()):
+                timesheet.migrate_storage(SimpleNamespace(format='compact'))
+            employees, periods, hours, available, _ = timesheet.utilization_matrix(
+                '2023-01-02', '2023-01-03', 'daily')
+            self.assertEqual(employees, ('Alice', 'Bob'))
+            self.assertEqual(periods, ('2023-01-02', '2023-01-03'))
+            self.assertEqual(hours.tolist(), [[4, 0], [0, 6]])
+            self.assertEqual(available.tolist(), [8, 8])
+        finally:
+            timesheet.COMPACT_STORAGE = False
+
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,7 +1,35 @@
+import importlib.util
+import io
+import os
+import sqlite3
+import subprocess
+import sys
+import tempfile
 import unittest
+from unittest import mock
+from contextlib import redirect_stdout
+from datetime import date, datetime
+from types import SimpleNamespace
+import web_app
 from web_app import app
 import timesheet
 from flask import session
+from tests.memory_db import fresh_database
+
+
+def setUpModule():
+    # The tests share one in-memory database. Its schema is set up now
+    # rather than by the first request, as several tests write to the
+    # database before making one.
+    global _orig_db
+    _orig_db = timesheet.DB_FILE
+    web_app.create_app(fresh_database(), init=True)
+
+
+def tearDownModule():
+    timesheet.release_memory_db(timesheet.DB_FILE)
+    timesheet.DB_FILE = _orig_db
+
 
 class LogoutTests(unittest.TestCase):
     def setUp(self):
@@ -111,5 +139,350 @@ class TimesheetDropdownTests(unittest.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertIn(b'Dropdown Project', response.data)
 
+class ConditionalGetTests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_payroll_returns_304_until_data_changes(self):
+        first = self.client.get('/api/payroll')
+        self.assertEqual(first.status_code, 200)
+        etag = first.headers['ETag']
+
+        again = self.client.get('/api/payroll', headers={'If-None-Match': etag})
+        self.assertEqual(again.status_code, 304)
+
+        web_app.log_time_entry('Etag Tester', 'Etag Project', 1.0, '2023-01-01')
+        changed = self.client.get('/api/payroll', headers={'If-None-Match': etag})
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed.headers['ETag'], etag)
+        self.assertIn(b'Etag Project', changed.data)
+
+class ApprovalApiTests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with timesheet.connect_db() as conn:
+            for name, role, manager in [('Approval Ann', 'Project Manager', None),
+                                        ('Approval Ben', 'Project Manager', None),
+                                        ('Ann Report', 'Employee', 'Approval Ann'),
+                                        ('Ben Report', 'Employee', 'Approval Ben')]:
+                conn.execute(
+                    "INSERT OR IGNORE INTO users (full_name, email, username, password, "
+                    "department, role, status, reporting_manager) VALUES (?, ?, ?, 'x', "
+                    "'Approvals', ?, 'Active', (SELECT id FROM users WHERE full_name = ?))",
+                    (name, name.lower().replace(' ', '.') + '@example.com', name, role, manager),
+                )
+            conn.commit()
+            self.ids = dict(conn.execute(
+                "SELECT full_name, id FROM users WHERE full_name LIKE 'Approval %'"))
+
+    def login(self, name, role='Project Manager'):
+        with self.client.session_transaction() as sess:
+            sess['employee'] = name
+            sess['role'] = role
+
+    def test_lock_requires_admin(self):
+        self.login('Approval Ann')
+        response = self.client.post('/api/timesheets/lock', json={'department': 'IT'})
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.post('/api/timesheets/approve',
+                                    json={'department': 'Approvals', 'start': '2000-01-01',
+                                          'end': '2000-01-01'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['updated'], 0)
+
+    def test_managers_only_approve_their_own_team(self):
+        for name in ('Ann Report', 'Ben Report'):
+            web_app.log_time_entry(name, 'Approval Project', 2.0, '2023-05-02')
+        self.login('Approval Ann')
+        response = self.client.post('/api/timesheets/approve',
+                                    json={'department': 'Engineering'})
+        self.assertEqual(response.status_code, 403)
+        self.login('Nobody')
+        response = self.client.post('/api/timesheets/approve',
+                                    json={'manager_id': self.ids['Approval Ben']})
+        self.assertEqual(response.status_code, 403)
+
+        # Another manager's id in the body is replaced by the caller's own.
+        self.login('Approval Ann')
+        body = {'manager_id': self.ids['Approval Ben'], 'start': '2023-05-02',
+                'end': '2023-05-02'}
+        response = self.client.post('/api/timesheets/approve', json=body)
+        self.assertEqual(response.get_json()['updated'], 1)
+        with timesheet.connect_db() as conn:
+            approved = conn.execute(
+                "SELECT e.name FROM timesheets t JOIN employees e ON e.id = t.employee_id "
+                "WHERE t.status = 'manager_approved' AND e.name LIKE '% Report'").fetchall()
+        self.assertEqual(approved, [('Ann Report',)])
+        self.login('Approval Ben')
+        response = self.client.post('/api/timesheets/approve', json={
+            'department': 'Approvals', 'start': '2023-05-02', 'end': '2023-05-02'})
+        self.assertEqual(response.get_json()['updated'], 1)
+
+    def test_transition_requires_a_team(self):
+        with self.client.session_transaction() as sess:
+            sess['employee'] = 'Manager'
+            sess['role'] = 'Admin'
+        for path in ('/api/timesheets/approve', '/api/timesheets/lock'):
+            self.assertEqual(self.client.post(path, json={}).status_code, 400)
+            self.assertEqual(self.client.post(path).status_code, 400)
+
+    def test_bulk_change_requires_admin_and_a_filter(self):
+        with self.client.session_transaction() as sess:
+            sess['employee'] = 'Manager'
+            sess['role'] = 'Project Manager'
+        response = self.client.post('/api/timesheets/bulk', json={'action': 'delete'})
+        self.assertEqual(response.status_code, 403)
+
+        with self.client.session_transaction() as sess:
+            sess['role'] = 'Admin'
+        response = self.client.post('/api/timesheets/bulk', json={'action': 'delete'})
+        self.assertEqual(response.status_code, 400)
+        response = self.client.post('/api/timesheets/bulk', json={
+            'action': 'update', 'employee': 'Nobody', 'new_hours': 2, 'dry_run': True,
+        })
+        self.assertEqual(response.get_json(),
+                         {'action': 'update', 'dry_run': True, 'affected': 0, 'locked': 0})
+
+
+class SuggestApiTests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        web_app.SUGGEST_REFRESH_INTERVAL = 0
+        self.addCleanup(setattr, web_app, 'SUGGEST_REFRESH_INTERVAL', 1.0)
+        with timesheet.connect_db() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO users (full_name, email, username, password, department, "
+                "role, status) VALUES ('Suggest Smithers', 'smithers@example.com', 'smithers', "
+                "'x', 'IT', 'Employee', 'Active')"
+            )
+            for name in ('Zulu Alpha', 'Zulu Beta', 'Zulu Gamma'):
+                timesheet.get_or_create(conn.cursor(), 'projects', name)
+            conn.commit()
+
+    def test_suggestions_match_word_prefixes(self):
+        response = self.client.get('/api/projects/suggest?q=zULu&limit=2')
+        self.assertEqual(response.get_json(), {'projects': ['Zulu Alpha', 'Zulu Beta']})
+        response = self.client.get('/api/projects/suggest?q=gam')
+        self.assertEqual(response.get_json(), {'projects': ['Zulu Gamma']})
+
+        users = self.client.get('/api/users/suggest?q=smither').get_json()['users']
+        self.assertEqual([u['name'] for u in users], ['Suggest Smithers'])
+
+    def test_index_ignores_timesheet_writes(self):
+        web_app.PROJECT_INDEX.options()
+        generation = timesheet.directory_generation()
+        with redirect_stdout(io.StringIO()):
+            timesheet.log_time(SimpleNamespace(employee='Suggest Smithers', project='Zulu Alpha',
+                                               hours=1.0, date='2023-01-02'))
+        self.assertEqual(timesheet.directory_generation(), generation)
+        with timesheet.connect_db() as conn:
+            timesheet.get_or_create(conn.cursor(), 'projects', 'Zulu Delta')
+            conn.commit()
+        self.assertIn(('Zulu Delta', 'Zulu Delta'), web_app.PROJECT_INDEX.options())
+
+    def test_large_lists_are_lazy_loaded(self):
+        with self.client.session_transaction() as sess:
+            sess['employee'] = 'Suggest Smithers'
+            sess['role'] = 'Employee'
+        web_app.INLINE_OPTIONS_LIMIT = 0
+        try:
+            response = self.client.get('/timesheet')
+        finally:
+            web_app.INLINE_OPTIONS_LIMIT = 200
+        self.assertIn(b'data-suggest="/api/projects/suggest"', response.data)
+        self.assertNotIn(b'<option value="Zulu Alpha">', response.data)
+
+
+class AdmissionTests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_saturated_report_lane_rejects_only_reports(self):
+        lane = web_app.ADMISSION_LANES['report']
+        rejected = lane.rejected
+        held = 0
+        timeout, lane.timeout = lane.timeout, 0
+        try:
+            while lane.acquire():
+                held += 1
+            response = self.client.get('/api/payroll')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], str(lane.retry_after))
+            self.assertEqual(self.client.get('/api/projects/suggest?q=a').status_code, 200)
+        finally:
+            lane.timeout = timeout
+            for _ in range(held):
+                lane.release()
+        self.assertEqual(held, lane.slots)
+        self.assertEqual(self.client.get('/api/payroll').status_code, 200)
+
+        stats = self.client.get('/api/admission/stats').get_json()
+        self.assertEqual(stats['report']['rejected'], rejected + 2)
+        self.assertEqual(stats['report']['active'], 0)
+        self.assertGreater(stats['read']['admitted'], 0)
+
+
+class ComplianceReportTests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+        with timesheet.connect_db() as conn:
+            conn.execute(
+                "INSERT OR IGNORE INTO users (full_name, email, username, password, department, "
+                "role, status) VALUES ('Compliance Carl', 'carl@example.com', 'carl', 'x', "
+                "'Audit', 'Employee', 'Active')"
+            )
+            conn.commit()
+
+    def test_compliance_report_lists_missing_days(self):
+        response = self.client.get('/reports/compliance?start=2023-01-06&end=2023-01-09'
+                                   '&department=Audit')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'<td>Compliance Carl</td>', response.data)
+        self.assertIn(b'2023-01-06, 2023-01-09', response.data)
+
+    def test_default_range_is_not_cached_across_days(self):
+        with self.client.session_transaction() as sess:
+            sess['employee'] = 'Compliance Carl'
+            sess['role'] = 'Admin'
+        etag = self.client.get('/reports/compliance?department=Audit').headers['ETag']
+        headers = {'If-None-Match': etag}
+        response = self.client.get('/reports/compliance?department=Audit', headers=headers)
+        self.assertEqual(response.status_code, 304)
+
+        class Tomorrow(date):
+            @classmethod
+            def today(cls):
+                return date.fromordinal(date.today().toordinal() + 1)
+
+        with mock.patch.object(web_app, 'date', Tomorrow):
+            response = self.client.get('/reports/compliance?department=Audit',
+                                       headers=headers)
+        self.assertEqual(response.status_code, 200)
+
+
+class SchedulerTests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    def test_cron_schedule_next_after(self):
+        schedule = web_app.CronSchedule('45 7 * * 1-5')
+        # Friday after the warm-up runs again on Monday.
+        self.assertEqual(schedule.next_after(datetime(2024, 1, 5, 8, 0)),
+                         datetime(2024, 1, 8, 7, 45))
+        self.assertEqual(web_app.CronSchedule('*/20 9-10 * * *').next_after(
+            datetime(2024, 1, 5, 10, 40)), datetime(2024, 1, 6, 9, 0))
+        # Restricted day and weekday fields match either one.
+        self.assertEqual(web_app.CronSchedule('0 0 13 * 5').next_after(
+            datetime(2024, 1, 1)), datetime(2024, 1, 5))
+        for expression in ('* * *', '60 * * * *', '0 0 30 2 *'):
+            with self.assertRaises(ValueError):
+                web_app.CronSchedule(expression).next_after(datetime(2024, 1, 1))
+
+    def test_only_the_lease_holder_runs_jobs(self):
+        calls = []
+
+        def job(name):
+            return web_app.ScheduledJob('test-job', '0 8 * * *', lambda: calls.append(name))
+
+        first = web_app.Scheduler([job('first')])
+        second = web_app.Scheduler([job('second')])
+        start = datetime(2024, 1, 8, 7, 0)
+        self.assertEqual(first.run_pending(start), [])
+        due = datetime(2024, 1, 8, 8, 0, 30)
+        self.assertEqual(first.run_pending(due), ['test-job'])
+        self.assertEqual(second.run_pending(start), [])
+        self.assertEqual(second.run_pending(due), [])
+        self.assertEqual(calls, ['first'])
+
+        # Once the leader lets go, the follower runs the next due time.
+        timesheet.release_lease(first.LEASE, first.owner)
+        self.assertEqual(second.run_pending(datetime(2024, 1, 9, 8, 1)), ['test-job'])
+        self.assertEqual(calls, ['first', 'second'])
+        timesheet.release_lease(second.LEASE, second.owner)
+
+        runs = timesheet.job_runs('test-job')
+        self.assertEqual([row[1] for row in runs], [second.owner, first.owner])
+        self.assertTrue(all(row[4] is None for row in runs))
+
+        stats = self.client.get('/api/scheduler/stats').get_json()
+        self.assertEqual(set(stats['jobs']),
+                         {'warm-dashboard', 'warm-productivity', 'analyze'})
+        self.assertIn('test-job', [run['job'] for run in stats['history']])
+
+    def test_unleased_jobs_run_in_every_process(self):
+        calls = []
+        schedulers = [web_app.Scheduler([web_app.ScheduledJob(
+            'test-warm', '0 8 * * *', lambda name=name: calls.append(name), leased=False)])
+            for name in ('first', 'second')]
+        for scheduler in schedulers:
+            scheduler.run_pending(datetime(2024, 1, 8, 7, 0))
+        self.assertTrue(timesheet.acquire_lease(web_app.Scheduler.LEASE, 'elsewhere', 60))
+        try:
+            for scheduler in schedulers:
+                self.assertEqual(scheduler.run_pending(datetime(2024, 1, 8, 8, 0, 30)),
+                                 ['test-warm'])
+                self.assertFalse(scheduler.leader)
+        finally:
+            timesheet.release_lease(web_app.Scheduler.LEASE, 'elsewhere')
+        self.assertEqual(calls, ['first', 'second'])
+
+    def test_warm_up_jobs_run(self):
+        for job in web_app.SCHEDULER.jobs:
+            started, duration, error = job.run()
+            self.assertIsNone(error, job.name)
+
+
+class StartupTests(unittest.TestCase):
+    def test_import_leaves_database_alone(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'startup.db')
+            subprocess.run([sys.executable, '-c', 'import web_app'], check=True,
+                           env=dict(os.environ, TIMESHEET_DB=path),
+                           cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+            self.assertFalse(os.path.exists(path))
+
+    def test_schema_is_set_up_on_first_request(self):
+        orig_db = timesheet.DB_FILE
+        self.addCleanup(web_app.create_app, orig_db, init=True)
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+        client = web_app.create_app(path).test_client()
+        with sqlite3.connect(path) as conn:
+            self.assertEqual(conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()[0], 0)
+        self.assertEqual(client.get('/login').status_code, 200)
+        with sqlite3.connect(path) as conn:
+            tables = {row[0] for row in conn.execute("SELECT name FROM sqlite_master")}
+        self.assertIn('timesheets', tables)
+
+
+class UtilizationApiTests(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.client = app.test_client()
+
+    @unittest.skipUnless(importlib.util.find_spec('numpy'), 'numpy is not installed')
+    def test_utilization_formats(self):
+        web_app.log_time_entry('Util Tester', 'Util Project', 4.0, '2023-01-04')
+        query = '/api/utilization?start=2023-01-02&end=2023-01-08&period=isoweekly'
+        data = self.client.get(query).get_json()
+        self.assertEqual(data['periods'], ['2023-W01'])
+        row = data['employees'].index('Util Tester')
+        self.assertEqual(data['utilization'][row], [0.1])
+
+        csv = self.client.get(query + '&format=csv&values=hours')
+        self.assertEqual(csv.mimetype, 'text/csv')
+        self.assertIn(b'Util Tester,4\r\n', csv.data)
+        npy = self.client.get(query + '&format=npy')
+        self.assertTrue(npy.data.startswith(b'\x93NUMPY'))
+        self.assertEqual(self.client.get(query + '&format=xml').status_code, 400)
+
 if __name__ == '__main__':
     unittest.main()
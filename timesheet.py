@@ -1,30 +1,815 @@
 import sqlite3
-import argparse
+import heapq
+import itertools
 import os
 import sys
-from datetime import date, datetime
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import date, datetime, timedelta, timezone
+from functools import wraps
 
 # Default database file path
 DB_FILE = os.environ.get('TIMESHEET_DB', 'timesheet.db')
 
+# Optional timesheet shards.  When set, ``DB_FILE`` remains the directory of
+# users, employees and projects while timesheet rows are spread over these
+# files, routed per employee by department or by hashed employee id.
+SHARDS = [p for p in os.environ.get('TIMESHEET_SHARDS', '').split(',') if p]
+SHARD_BY = os.environ.get('TIMESHEET_SHARD_BY', 'department')
 
-def connect_db():
-    """Return a connection to the SQLite database or exit on failure."""
+# Bump whenever init_db creates or migrates anything new, so existing
+# databases are upgraded instead of taking the skip-init fast path.
+SCHEMA_REVISION = 7
+
+# Each shard numbers its timesheet ids from its own multiple of this span,
+# so an entry id identifies the shard holding it.
+SHARD_ID_SPAN = 10 ** 12
+
+
+class _BatchConnection(sqlite3.Connection):
+    """Connection shared by every command of a ``batch`` run.
+
+    Commands keep their usual ``with connect_db()``, ``commit()`` and
+    ``close()`` calls; :func:`run_batch` owns the transaction instead.
+    """
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def commit(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# Set while ``run_batch`` executes commands over a single connection.
+_BATCH_CONNECTION = None
+
+# A database path of ``:memory:`` or ``:memory:<name>`` selects an
+# in-memory database shared by every connection of the process.  It lives in
+# SQLite's memdb VFS (a shared-cache memory database before SQLite 3.36),
+# pinned by a connection kept in ``_MEMORY_DBS`` with its URI.
+MEMORY_PREFIX = ':memory:'
+_MEMORY_DBS = {}
+_MEMORY_LOCK = threading.Lock()
+_MEMORY_SERIAL = itertools.count(1)
+
+# Database file copied into an in-memory ``DB_FILE`` when it is created, and
+# file it is written back to when the process exits.
+MEMORY_LOAD = os.environ.get('TIMESHEET_DB_LOAD')
+MEMORY_SNAPSHOT = os.environ.get('TIMESHEET_DB_SNAPSHOT')
+
+
+def is_memory_db(path):
+    return path.startswith(MEMORY_PREFIX)
+
+
+def _memory_uri(path):
+    """Return the URI of in-memory database ``path``, creating it if needed."""
+    with _MEMORY_LOCK:
+        if path in _MEMORY_DBS:
+            return _MEMORY_DBS[path][0]
+        from urllib.parse import quote
+        # A serial number keeps a released database's lingering connections
+        # from being shared with the next database of that name.
+        name = f"{quote(path[len(MEMORY_PREFIX):] or 'timesheet')}-{next(_MEMORY_SERIAL)}"
+        if sqlite3.sqlite_version_info >= (3, 36, 0):
+            uri = f'file:/{name}?vfs=memdb'
+        else:
+            uri = f'file:{name}?mode=memory&cache=shared'
+        keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        _MEMORY_DBS[path] = (uri, keeper)
+        if path == DB_FILE and MEMORY_LOAD:
+            source = sqlite3.connect(_read_only_uri(MEMORY_LOAD), uri=True)
+            try:
+                source.backup(keeper)
+            finally:
+                source.close()
+        if path == DB_FILE and MEMORY_SNAPSHOT:
+            import atexit
+            atexit.register(snapshot_database, MEMORY_SNAPSHOT, path)
+        return uri
+
+
+def _open(path, **kwargs):
+    """Open ``path``; an in-memory database is created on first use."""
+    if is_memory_db(path):
+        return sqlite3.connect(_memory_uri(path), uri=True, **kwargs)
+    # Opened as a URI so ATTACH can name an in-memory directory.
+    return sqlite3.connect(path, uri=True, **kwargs)
+
+
+def release_memory_db(path):
+    """Forget the in-memory database ``path``.
+
+    Its memory is freed once connections still open to it are closed; the
+    next use of ``path`` starts an empty database.
+    """
+    with _MEMORY_LOCK:
+        entry = _MEMORY_DBS.pop(path, None)
+    if entry is not None:
+        entry[1].close()
+
+
+def connect_db(path=None):
+    """Return a connection to the SQLite database or exit on failure.
+
+    ``path`` selects a timesheet shard; the directory database is attached
+    to shard connections so queries can still join employees and projects.
+    """
+    path = path or DB_FILE
+    if _BATCH_CONNECTION is not None and path == DB_FILE:
+        return _BATCH_CONNECTION
     try:
-        return sqlite3.connect(DB_FILE)
+        conn = _open(path)
+        if path != DB_FILE:
+            directory = _memory_uri(DB_FILE) if is_memory_db(DB_FILE) else DB_FILE
+            conn.execute('ATTACH DATABASE ? AS directory', (directory,))
+        return conn
     except sqlite3.Error as e:
-        print(f"Could not open database '{DB_FILE}': {e}")
+        print(f"Could not open database '{path}': {e}")
         sys.exit(1)
 
 
+# Storage format used when a database is created.  ``compact`` keeps
+# entry_date as a day ordinal and hours as integer half-hour units; existing
+# databases are converted with ``migrate-storage``.
+STORAGE_FORMAT = os.environ.get('TIMESHEET_STORAGE', 'text')
+
+# Set by ``init_db`` from the schema of the open database.
+COMPACT_STORAGE = False
+
+# Offset between a Julian day number and ``date.toordinal()``.
+_ORDINAL_EPOCH = 1721424.5
+
+_TIMESHEETS_DDL = '''CREATE TABLE IF NOT EXISTS timesheets (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    employee_id INTEGER NOT NULL,
+    project_id INTEGER NOT NULL,
+    entry_date {date_type} NOT NULL,
+    hours {hours_type} NOT NULL,
+    remarks TEXT,
+    status TEXT NOT NULL DEFAULT 'submitted',
+    day_ordinal INTEGER GENERATED ALWAYS AS
+        ({day_ordinal}) {generated},
+    week_key TEXT GENERATED ALWAYS AS
+        (strftime('%Y-%W', {day})) {generated},
+    iso_week TEXT GENERATED ALWAYS AS
+        (strftime('%Y', {iso_thursday}) || '-W' ||
+         printf('%02d', (CAST(strftime('%j', {iso_thursday}) AS INTEGER) - 1) / 7 + 1)) {generated},
+    month_key TEXT GENERATED ALWAYS AS
+        (strftime('%Y-%m', {day})) {generated},
+    quarter_key TEXT GENERATED ALWAYS AS
+        (strftime('%Y', {day}) || '-Q' ||
+         ((CAST(strftime('%m', {day}) AS INTEGER) + 2) / 3)) {generated},
+    FOREIGN KEY (employee_id) REFERENCES employees(id),
+    FOREIGN KEY (project_id) REFERENCES projects(id)
+)'''
+
+
+def timesheets_ddl(compact=False):
+    """Return the CREATE TABLE statement for the timesheets table.
+
+    In the compact format the period keys are virtual columns: only the
+    indexes built on them store their values.
+    """
+    if compact:
+        day = f'(entry_date + {_ORDINAL_EPOCH})'
+        fmt = dict(date_type='INTEGER', hours_type='INTEGER',
+                   day_ordinal='entry_date', generated='VIRTUAL')
+    else:
+        day = 'entry_date'
+        fmt = dict(date_type='TEXT', hours_type='REAL',
+                   day_ordinal=f'CAST(julianday(entry_date) - {_ORDINAL_EPOCH} AS INTEGER)',
+                   generated='STORED')
+    # The ISO 8601 Thursday of the week containing the entry; its year and
+    # day-of-year determine the ISO week number.
+    iso_thursday = (
+        f"julianday({day}) - (CAST(strftime('%w', {day}) AS INTEGER) + 6) % 7 + 3"
+    )
+    return _TIMESHEETS_DDL.format(day=day, iso_thursday=iso_thursday, **fmt)
+
+
+def to_storage_date(value):
+    """Convert an ISO date string to the stored entry_date representation."""
+    if COMPACT_STORAGE and value is not None:
+        return datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+    return value
+
+
+def to_storage_hours(value):
+    """Convert hours to the stored representation (half-hour units if compact)."""
+    if COMPACT_STORAGE and value is not None:
+        units = value * 2
+        return int(units) if units == int(units) else units
+    return value
+
+
+def date_sql(column):
+    """Return SQL rendering a stored entry_date column as an ISO date."""
+    if COMPACT_STORAGE:
+        return f'date({column} + {_ORDINAL_EPOCH})'
+    return column
+
+
+def hours_sql(expr):
+    """Return SQL converting stored hours (or a SUM of them) to hours."""
+    if COMPACT_STORAGE:
+        return f'({expr}) / 2.0'
+    return expr
+
+
+# Covering indexes: per-dimension lookups ordered by date, and one index per
+# stored period key so period summaries can group in index order.
+TIMESHEETS_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_project_date '
+    'ON timesheets(project_id, entry_date, hours)',
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_employee_date '
+    'ON timesheets(employee_id, entry_date, hours)',
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_date '
+    'ON timesheets(entry_date, project_id, employee_id, hours)',
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_week '
+    'ON timesheets(week_key, project_id, employee_id, hours)',
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_iso_week '
+    'ON timesheets(iso_week, project_id, employee_id, hours)',
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_month '
+    'ON timesheets(month_key, project_id, employee_id, hours)',
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_quarter '
+    'ON timesheets(quarter_key, project_id, employee_id, hours)',
+    # Locked rows are the bulk of history and never change again, so the
+    # approval workflow only indexes the open states.
+    'CREATE INDEX IF NOT EXISTS idx_timesheets_open_status '
+    "ON timesheets(status, employee_id, entry_date) WHERE status <> 'locked'",
+]
+
+# Optional unique index on the natural key of an entry, created by the
+# ``unique-entries`` command.  The stored policy decides what a second entry
+# for the same employee, project and date does.
+NATURAL_KEY_INDEX = (
+    'CREATE UNIQUE INDEX IF NOT EXISTS idx_timesheets_natural_key '
+    'ON timesheets(employee_id, project_id, entry_date)'
+)
+DUPLICATE_POLICIES = ('off', 'reject', 'replace', 'add')
+DUPLICATE_POLICY = 'off'
+
+# Stored setting limiting web timesheet entry to assigned projects.
+RESTRICT_PROJECTS = False
+
+# Approval workflow: each bulk action moves entries from one state to the
+# next.  Locked entries are final and cannot be updated or deleted.
+TIMESHEET_STATUSES = ('draft', 'submitted', 'manager_approved', 'locked')
+STATUS_TRANSITIONS = {
+    'submit': ('draft', 'submitted'),
+    'approve': ('submitted', 'manager_approved'),
+    'lock': ('manager_approved', 'locked'),
+}
+
+# Tables whose writes bump the data generation counter used by the web
+# app to validate ETags and cached responses.
+GENERATION_TABLES = (
+    'employees',
+    'projects',
+    'timesheets',
+    'users',
+    'project_master',
+    'project_assignments',
+)
+
+# Tables whose writes bump the directory generation, which keys the web
+# app's project and user pickers; timesheet writes leave it unchanged.
+DIRECTORY_TABLES = (
+    'projects',
+    'project_master',
+    'users',
+)
+
+# Number of rows kept in the timesheet_changes log; a reader that falls
+# further behind drops its whole report cache instead.
+CHANGE_LOG_LIMIT = 10000
+
+# Logged in timesheet_changes when the org chart changes, which can alter
+# any cached team report whatever its date range.
+ORG_CHANGE_DAY = -1
+
+# Days on which an employee logs more than OVERWORK_THRESHOLD hours raise
+# alerts as they are written; OVERWORK_DAYS of them flag the employee as
+# overworked.
+OVERWORK_THRESHOLD = 9
+OVERWORK_DAYS = 3
+
+# Output formats of report and summary, and the rows read per fetchmany
+# call when streaming them.
+OUTPUT_FORMATS = ('text', 'csv', 'tsv', 'jsonl')
+FETCH_SIZE = 1000
+
+# Throttling of ``maintain``: pages copied or freed per step, the pause
+# between steps, and the backup restarts tolerated before the rest of the
+# copy is taken in one step.
+MAINTAIN_PAGES = 1024
+MAINTAIN_PAUSE = 0.01
+BACKUP_RESTARTS = 3
+# Rows ANALYZE samples per index; 0 reads them all.
+ANALYSIS_LIMIT = 1000
+
+# Runs of each scheduled job kept in ``job_runs``.
+JOB_RUNS_LIMIT = 100
+
+# Upper bound on the memory held by cached report results.
+REPORT_CACHE_MAX_BYTES = 8 * 1024 * 1024
+
+# Stored column holding the grouping key for each ``summary --period``.
+PERIOD_COLUMNS = {
+    'daily': 'entry_date',
+    'weekly': 'week_key',
+    'isoweekly': 'iso_week',
+    'monthly': 'month_key',
+    'quarterly': 'quarter_key',
+}
+
+
+def period_key(period, value):
+    """Return the stored period key for an ISO date string or a date.
+
+    The keys sort chronologically, so ``period_key(p, start)`` and
+    ``period_key(p, end)`` bound the keys of every date in between.
+    """
+    day = value if isinstance(value, date) else datetime.strptime(value, '%Y-%m-%d').date()
+    if period == 'daily':
+        return day.isoformat()
+    if period == 'weekly':
+        return day.strftime('%Y-%W')
+    if period == 'isoweekly':
+        iso_year, iso_week, _ = day.isocalendar()
+        return f'{iso_year:04d}-W{iso_week:02d}'
+    if period == 'monthly':
+        return day.strftime('%Y-%m')
+    if period == 'quarterly':
+        return f'{day.year:04d}-Q{(day.month + 2) // 3}'
+    raise ValueError(f'Unknown period: {period}')
+
+
+def _is_compact(cur):
+    """Return True if the timesheets table uses the compact storage format."""
+    cur.execute('PRAGMA table_info(timesheets)')
+    types = {row[1]: row[2].upper() for row in cur.fetchall()}
+    return types.get('entry_date') == 'INTEGER'
+
+
+def _create_triggers(cur):
+    """Create the triggers that keep derived tables in step with writes."""
+    cur.execute("SELECT name FROM main.sqlite_master WHERE type = 'table'")
+    existing = {row[0] for row in cur.fetchall()}
+    for table in GENERATION_TABLES:
+        if table not in existing:
+            continue
+        for op in ('INSERT', 'UPDATE', 'DELETE'):
+            cur.execute(
+                f'CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()}_generation '
+                f'AFTER {op} ON {table} BEGIN '
+                'UPDATE data_generation SET value = value + 1 WHERE id = 1; END'
+            )
+    if 'directory_generation' in existing:
+        for table in DIRECTORY_TABLES:
+            if table not in existing:
+                continue
+            for op in ('INSERT', 'UPDATE', 'DELETE'):
+                cur.execute(
+                    f'CREATE TRIGGER IF NOT EXISTS trg_{table}_{op.lower()}_directory '
+                    f'AFTER {op} ON {table} BEGIN '
+                    'UPDATE directory_generation SET value = value + 1 WHERE id = 1; END'
+                )
+    # Every day touched by a timesheet write is logged so cached report
+    # results covering that day can be invalidated in every process.
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_insert_changes '
+        'AFTER INSERT ON timesheets BEGIN '
+        'INSERT INTO timesheet_changes(day_ordinal) VALUES (NEW.day_ordinal); END'
+    )
+    # Status changes do not alter any report, so only data columns count.
+    cur.execute('DROP TRIGGER IF EXISTS trg_timesheets_update_changes')
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_update_data_changes '
+        'AFTER UPDATE OF employee_id, project_id, entry_date, hours ON timesheets BEGIN '
+        'INSERT INTO timesheet_changes(day_ordinal) VALUES (OLD.day_ordinal); '
+        'INSERT INTO timesheet_changes(day_ordinal) VALUES (NEW.day_ordinal); END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_delete_changes '
+        'AFTER DELETE ON timesheets BEGIN '
+        'INSERT INTO timesheet_changes(day_ordinal) VALUES (OLD.day_ordinal); END'
+    )
+    # Closed payroll periods are frozen: their snapshots in period_aggregates
+    # must stay equal to the rows they were taken from.
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_insert_closed '
+        'BEFORE INSERT ON timesheets WHEN EXISTS '
+        '(SELECT 1 FROM closed_periods WHERE month_key = NEW.month_key) BEGIN '
+        "SELECT RAISE(ABORT, 'period is closed'); END"
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_update_closed '
+        'BEFORE UPDATE OF employee_id, project_id, entry_date, hours ON timesheets '
+        'WHEN EXISTS (SELECT 1 FROM closed_periods '
+        'WHERE month_key IN (OLD.month_key, NEW.month_key)) BEGIN '
+        "SELECT RAISE(ABORT, 'period is closed'); END"
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_delete_closed '
+        'BEFORE DELETE ON timesheets WHEN EXISTS '
+        '(SELECT 1 FROM closed_periods WHERE month_key = OLD.month_key) BEGIN '
+        "SELECT RAISE(ABORT, 'period is closed'); END"
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheet_changes_prune '
+        'AFTER INSERT ON timesheet_changes BEGIN '
+        f'DELETE FROM timesheet_changes WHERE id <= NEW.id - {CHANGE_LOG_LIMIT}; END'
+    )
+    _create_overwork_triggers(cur)
+
+
+def _create_overwork_triggers(cur):
+    """Create the triggers maintaining ``daily_totals`` and ``overwork_alerts``.
+
+    Every timesheet write adjusts the employee's total for the day. A total
+    crossing ``OVERWORK_THRESHOLD`` adds or removes that day's alert, and
+    ``streak`` (the alert's position in its run of consecutive alert days)
+    is renumbered from the changed day to the end of the run.
+    """
+    scale = ' / 2.0' if _is_compact(cur) else ''
+    add = (
+        'INSERT INTO daily_totals(employee_id, day_ordinal, hours, entries) '
+        f'VALUES (NEW.employee_id, NEW.day_ordinal, NEW.hours{scale}, 1) '
+        'ON CONFLICT(employee_id, day_ordinal) DO UPDATE SET '
+        'hours = hours + excluded.hours, entries = entries + 1;'
+    )
+    remove = (
+        f'UPDATE daily_totals SET hours = hours - OLD.hours{scale}, entries = entries - 1 '
+        'WHERE employee_id = OLD.employee_id AND day_ordinal = OLD.day_ordinal; '
+        'DELETE FROM daily_totals WHERE employee_id = OLD.employee_id '
+        'AND day_ordinal = OLD.day_ordinal AND entries = 0;'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_insert_daily '
+        f'AFTER INSERT ON timesheets BEGIN {add} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_update_daily '
+        'AFTER UPDATE OF employee_id, entry_date, hours ON timesheets '
+        f'BEGIN {remove} {add} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_timesheets_delete_daily '
+        f'AFTER DELETE ON timesheets BEGIN {remove} END'
+    )
+
+    def run_end(row, first_day):
+        return (
+            '(SELECT MIN(o.day_ordinal) FROM overwork_alerts o '
+            f'WHERE o.employee_id = {row}.employee_id AND o.day_ordinal >= {first_day} '
+            'AND NOT EXISTS (SELECT 1 FROM overwork_alerts n '
+            'WHERE n.employee_id = o.employee_id AND n.day_ordinal = o.day_ordinal + 1))'
+        )
+
+    raise_alert = (
+        'INSERT INTO overwork_alerts(employee_id, day_ordinal, hours, streak) '
+        'VALUES (NEW.employee_id, NEW.day_ordinal, NEW.hours, 1); '
+        'UPDATE overwork_alerts SET streak = day_ordinal - NEW.day_ordinal + 1 + COALESCE('
+        '(SELECT p.streak FROM overwork_alerts p WHERE p.employee_id = NEW.employee_id '
+        'AND p.day_ordinal = NEW.day_ordinal - 1), 0) '
+        'WHERE employee_id = NEW.employee_id AND day_ordinal >= NEW.day_ordinal '
+        f"AND day_ordinal <= {run_end('NEW', 'NEW.day_ordinal')};"
+    )
+    clear_alert = (
+        'DELETE FROM overwork_alerts WHERE employee_id = OLD.employee_id '
+        'AND day_ordinal = OLD.day_ordinal; '
+        'UPDATE overwork_alerts SET streak = day_ordinal - OLD.day_ordinal '
+        'WHERE employee_id = OLD.employee_id AND day_ordinal > OLD.day_ordinal '
+        f"AND day_ordinal <= {run_end('OLD', 'OLD.day_ordinal + 1')} "
+        'AND EXISTS (SELECT 1 FROM overwork_alerts n WHERE n.employee_id = OLD.employee_id '
+        'AND n.day_ordinal = OLD.day_ordinal + 1);'
+    )
+    limit = OVERWORK_THRESHOLD
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_daily_totals_insert_alert '
+        f'AFTER INSERT ON daily_totals WHEN NEW.hours > {limit} BEGIN {raise_alert} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_daily_totals_raise_alert '
+        'AFTER UPDATE OF hours ON daily_totals '
+        f'WHEN OLD.hours <= {limit} AND NEW.hours > {limit} BEGIN {raise_alert} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_daily_totals_update_alert '
+        'AFTER UPDATE OF hours ON daily_totals '
+        f'WHEN OLD.hours > {limit} AND NEW.hours > {limit} BEGIN '
+        'UPDATE overwork_alerts SET hours = NEW.hours '
+        'WHERE employee_id = NEW.employee_id AND day_ordinal = NEW.day_ordinal; END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_daily_totals_clear_alert '
+        'AFTER UPDATE OF hours ON daily_totals '
+        f'WHEN OLD.hours > {limit} AND NEW.hours <= {limit} BEGIN {clear_alert} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_daily_totals_delete_alert '
+        f'AFTER DELETE ON daily_totals WHEN OLD.hours > {limit} BEGIN {clear_alert} END'
+    )
+
+
+def _init_user_hierarchy(cur):
+    """Create the ``user_hierarchy`` closure table and its triggers.
+
+    The table holds one ``(ancestor, descendant, depth)`` row for every user
+    and each of their direct or indirect managers, plus a depth 0 row per
+    user, so everyone under a manager is a single index range.  Triggers on
+    ``users`` keep it current; an empty table is filled from the users.
+    """
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS user_hierarchy (
+            ancestor INTEGER NOT NULL,
+            descendant INTEGER NOT NULL,
+            depth INTEGER NOT NULL,
+            PRIMARY KEY (ancestor, descendant)
+        ) WITHOUT ROWID'''
+    )
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS idx_user_hierarchy_descendant '
+        'ON user_hierarchy(descendant, ancestor)'
+    )
+    cur.execute('SELECT EXISTS (SELECT 1 FROM user_hierarchy)')
+    if not cur.fetchone()[0]:
+        # Depth is capped so a cycle in old data cannot recurse forever.
+        cur.execute(
+            '''INSERT INTO user_hierarchy(ancestor, descendant, depth)
+               WITH RECURSIVE tree(ancestor, descendant, depth) AS (
+                   SELECT id, id, 0 FROM users
+                   UNION ALL
+                   SELECT t.ancestor, u.id, t.depth + 1 FROM tree t
+                   JOIN users u ON u.reporting_manager = t.descendant
+                   WHERE t.depth < 64
+               )
+               SELECT ancestor, descendant, MIN(depth) FROM tree
+               GROUP BY ancestor, descendant'''
+        )
+    org_change = (
+        f'INSERT INTO timesheet_changes(day_ordinal) VALUES ({ORG_CHANGE_DAY});'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_users_insert_hierarchy '
+        'AFTER INSERT ON users BEGIN '
+        'INSERT INTO user_hierarchy(ancestor, descendant, depth) '
+        'SELECT NEW.id, NEW.id, 0 UNION ALL '
+        'SELECT ancestor, NEW.id, depth + 1 FROM user_hierarchy '
+        f'WHERE descendant = NEW.reporting_manager; {org_change} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_users_manager_cycle '
+        'BEFORE UPDATE OF reporting_manager ON users '
+        'WHEN EXISTS (SELECT 1 FROM user_hierarchy '
+        'WHERE ancestor = NEW.id AND descendant = NEW.reporting_manager) '
+        "BEGIN SELECT RAISE(ABORT, 'reporting cycle'); END"
+    )
+    # Moving a user moves their whole subtree: links from the old managers
+    # into the subtree are replaced by links from the new ones.
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_users_update_hierarchy '
+        'AFTER UPDATE OF reporting_manager ON users '
+        'WHEN NEW.reporting_manager IS NOT OLD.reporting_manager BEGIN '
+        'DELETE FROM user_hierarchy '
+        'WHERE descendant IN (SELECT descendant FROM user_hierarchy WHERE ancestor = NEW.id) '
+        'AND ancestor NOT IN (SELECT descendant FROM user_hierarchy WHERE ancestor = NEW.id); '
+        'INSERT INTO user_hierarchy(ancestor, descendant, depth) '
+        'SELECT up.ancestor, down.descendant, up.depth + down.depth + 1 '
+        'FROM user_hierarchy up, user_hierarchy down '
+        f'WHERE up.descendant = NEW.reporting_manager AND down.ancestor = NEW.id; {org_change} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_users_rename_hierarchy '
+        'AFTER UPDATE OF full_name ON users '
+        f'WHEN NEW.full_name IS NOT OLD.full_name BEGIN {org_change} END'
+    )
+    cur.execute(
+        'CREATE TRIGGER IF NOT EXISTS trg_users_delete_hierarchy '
+        'AFTER DELETE ON users BEGIN '
+        'DELETE FROM user_hierarchy WHERE ancestor = OLD.id OR descendant = OLD.id; '
+        f'{org_change} END'
+    )
+
+
+def _rebuild_timesheets(cur, compact):
+    """Recreate the timesheets table in the given format, keeping rows."""
+    was_compact = _is_compact(cur)
+    if compact and not was_compact:
+        entry_date = f'CAST(julianday(entry_date) - {_ORDINAL_EPOCH} AS INTEGER)'
+        hours = 'CAST(round(hours * 2) AS INTEGER)'
+    elif was_compact and not compact:
+        entry_date = f'date(entry_date + {_ORDINAL_EPOCH})'
+        hours = 'hours / 2.0'
+    else:
+        entry_date, hours = 'entry_date', 'hours'
+    # Keep the id sequence, which carries a shard's id offset.
+    cur.execute("SELECT seq FROM sqlite_sequence WHERE name = 'timesheets'")
+    sequence = cur.fetchone()
+    cur.execute(
+        "SELECT 1 FROM main.sqlite_master WHERE name = 'idx_timesheets_natural_key'"
+    )
+    natural_key = cur.fetchone()
+    cur.execute('ALTER TABLE timesheets RENAME TO timesheets_old')
+    cur.execute(timesheets_ddl(compact))
+    cur.execute(
+        'INSERT INTO timesheets(id, employee_id, project_id, entry_date, hours, remarks, status) '
+        f'SELECT id, employee_id, project_id, {entry_date}, {hours}, remarks, status '
+        'FROM timesheets_old'
+    )
+    # Dropping the old table also drops its indexes and triggers; they are
+    # rebuilt once the rows are in place.
+    cur.execute('DROP TABLE timesheets_old')
+    if sequence:
+        cur.execute("DELETE FROM sqlite_sequence WHERE name = 'timesheets'")
+        cur.execute(
+            "INSERT INTO sqlite_sequence(name, seq) SELECT 'timesheets', "
+            'MAX(?, COALESCE(MAX(id), 0)) FROM timesheets',
+            (sequence[0],),
+        )
+    for index_sql in TIMESHEETS_INDEXES:
+        cur.execute(index_sql)
+    if natural_key:
+        cur.execute(NATURAL_KEY_INDEX)
+    _create_triggers(cur)
+
+
+def _init_timesheet_tables(cur):
+    """Create or upgrade the timesheet tables, returning the compact flag.
+
+    These are the tables that live in every timesheet shard.
+    """
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS data_generation (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            value INTEGER NOT NULL
+        )'''
+    )
+    cur.execute('INSERT OR IGNORE INTO data_generation(id, value) VALUES (1, 0)')
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS timesheet_changes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            day_ordinal INTEGER NOT NULL
+        )'''
+    )
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS closed_periods (
+            month_key TEXT PRIMARY KEY,
+            closed_at TEXT NOT NULL
+        )'''
+    )
+    # Hours here are always plain hours, whatever the storage format.
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS period_aggregates (
+            month_key TEXT NOT NULL,
+            employee_id INTEGER NOT NULL,
+            project_id INTEGER NOT NULL,
+            hours REAL NOT NULL,
+            PRIMARY KEY (month_key, employee_id, project_id)
+        ) WITHOUT ROWID'''
+    )
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS idx_period_aggregates_project '
+        'ON period_aggregates(month_key, project_id, hours)'
+    )
+    # Per employee and day totals and the days over OVERWORK_THRESHOLD,
+    # kept by triggers in plain hours whatever the storage format.
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS daily_totals (
+            employee_id INTEGER NOT NULL,
+            day_ordinal INTEGER NOT NULL,
+            hours REAL NOT NULL,
+            entries INTEGER NOT NULL,
+            PRIMARY KEY (employee_id, day_ordinal)
+        ) WITHOUT ROWID'''
+    )
+    cur.execute(
+        '''CREATE TABLE IF NOT EXISTS overwork_alerts (
+            employee_id INTEGER NOT NULL,
+            day_ordinal INTEGER NOT NULL,
+            hours REAL NOT NULL,
+            streak INTEGER NOT NULL,
+            raised_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (employee_id, day_ordinal)
+        ) WITHOUT ROWID'''
+    )
+    cur.execute(
+        'CREATE INDEX IF NOT EXISTS idx_overwork_alerts_day '
+        'ON overwork_alerts(day_ordinal, employee_id, streak)'
+    )
+    cur.execute(timesheets_ddl(STORAGE_FORMAT == 'compact'))
+    # Ensure the remarks column exists for databases created
+    # with older versions of the schema.
+    cur.execute("PRAGMA table_info(timesheets)")
+    cols = [row[1] for row in cur.fetchall()]
+    if 'remarks' not in cols:
+        cur.execute('ALTER TABLE timesheets ADD COLUMN remarks TEXT')
+    if 'status' not in cols:
+        cur.execute(
+            "ALTER TABLE timesheets ADD COLUMN status TEXT NOT NULL DEFAULT 'submitted'"
+        )
+    # Stored generated columns cannot be added with ALTER TABLE, so
+    # older timesheets tables are rebuilt to gain the period keys.
+    cur.execute("PRAGMA table_xinfo(timesheets)")
+    cols = [row[1] for row in cur.fetchall()]
+    compact = _is_compact(cur)
+    if 'quarter_key' not in cols:
+        _rebuild_timesheets(cur, compact)
+    for index_sql in TIMESHEETS_INDEXES:
+        cur.execute(index_sql)
+    _create_triggers(cur)
+    cur.execute('SELECT 1 FROM daily_totals LIMIT 1')
+    if cur.fetchone() is None:
+        # Inserting in day order lets the alert triggers number each streak
+        # from the day before without renumbering later days.
+        scale = ' / 2.0' if compact else ''
+        cur.execute('DELETE FROM overwork_alerts')
+        cur.execute(
+            'INSERT INTO daily_totals(employee_id, day_ordinal, hours, entries) '
+            f'SELECT employee_id, day_ordinal, SUM(hours){scale}, COUNT(*) FROM timesheets '
+            'GROUP BY employee_id, day_ordinal ORDER BY employee_id, day_ordinal'
+        )
+    return compact
+
+
+def _init_shard(path, index):
+    """Create the timesheet tables in shard ``index`` stored at ``path``."""
+    with connect_db(path) as conn:
+        cur = conn.cursor()
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        _init_timesheet_tables(cur)
+        cur.execute(
+            "INSERT INTO sqlite_sequence(name, seq) SELECT 'timesheets', ? "
+            "WHERE NOT EXISTS (SELECT 1 FROM sqlite_sequence WHERE name = 'timesheets')",
+            ((index + 1) * SHARD_ID_SPAN,),
+        )
+        conn.commit()
+        _stamp_schema(cur)
+
+
+def _shard_current(path):
+    if not is_memory_db(path) and not os.path.exists(path):
+        return False
+    with connect_db(path) as conn:
+        return _schema_current(conn.cursor())
+
+
+def _schema_stamp(cur):
+    """Return the ``user_version`` marking a schema ``init_db`` has checked.
+
+    It combines ``SCHEMA_REVISION`` with SQLite's schema cookie, which
+    changes on any DDL, so a schema altered by anything else is rechecked.
+    """
+    cur.execute('PRAGMA main.schema_version')
+    cookie = cur.fetchone()[0]
+    return zlib.crc32(f'{SCHEMA_REVISION}:{cookie}'.encode()) & 0x7FFFFFFF
+
+
+def _stamp_schema(cur):
+    cur.execute(f'PRAGMA main.user_version = {_schema_stamp(cur)}')
+
+
+def _schema_current(cur):
+    cur.execute('PRAGMA main.user_version')
+    return cur.fetchone()[0] == _schema_stamp(cur)
+
+
 def init_db(db_file=None):
-    """Create required tables in the database and upgrade schema if needed."""
-    global DB_FILE
+    """Create required tables in the database and upgrade schema if needed.
+
+    Databases whose schema is unchanged since the last run are only checked
+    for their storage format.
+    """
+    global DB_FILE, COMPACT_STORAGE
     if db_file:
         DB_FILE = db_file
+    if SHARDS and any(is_memory_db(path) for path in [DB_FILE] + SHARDS):
+        # Shard connections attach the directory while it may be mid-write,
+        # which an in-memory database does not allow.
+        print('In-memory databases cannot be combined with shards')
+        sys.exit(1)
     try:
         with connect_db() as conn:
             cur = conn.cursor()
+            if _schema_current(cur) and all(_shard_current(p) for p in SHARDS):
+                COMPACT_STORAGE = _is_compact(cur)
+                _load_settings(cur)
+                _reset_caches()
+                return
+            # Only takes effect on a new file; lets ``maintain`` return free
+            # pages to the filesystem without a full VACUUM.
+            cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
             cur.execute(
                 '''CREATE TABLE IF NOT EXISTS employees (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -89,369 +874,2233 @@ def init_db(db_file=None):
                 )'''
             )
             cur.execute(
-                '''CREATE TABLE IF NOT EXISTS timesheets (
+                'CREATE INDEX IF NOT EXISTS idx_users_reporting_manager '
+                'ON users(reporting_manager)'
+            )
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS idx_users_department ON users(department)'
+            )
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS idx_users_full_name ON users(full_name)'
+            )
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS idx_project_assignments_user '
+                'ON project_assignments(user_id, project_id)'
+            )
+            cur.execute(
+                '''CREATE TABLE IF NOT EXISTS settings (
+                    key TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                )'''
+            )
+            cur.execute(
+                '''CREATE TABLE IF NOT EXISTS leases (
+                    name TEXT PRIMARY KEY,
+                    owner TEXT NOT NULL,
+                    expires_at REAL NOT NULL
+                )'''
+            )
+            cur.execute(
+                '''CREATE TABLE IF NOT EXISTS job_runs (
                     id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    employee_id INTEGER NOT NULL,
-                    project_id INTEGER NOT NULL,
-                    entry_date TEXT NOT NULL,
-                    hours REAL NOT NULL,
-                    remarks TEXT,
-                    FOREIGN KEY (employee_id) REFERENCES employees(id),
-                    FOREIGN KEY (project_id) REFERENCES projects(id)
+                    job TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    started_at TEXT NOT NULL,
+                    duration REAL NOT NULL,
+                    error TEXT
+                )'''
+            )
+            cur.execute('CREATE INDEX IF NOT EXISTS idx_job_runs_job ON job_runs(job, id)')
+            cur.execute(
+                '''CREATE TABLE IF NOT EXISTS directory_generation (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    value INTEGER NOT NULL
+                )'''
+            )
+            cur.execute(
+                'INSERT OR IGNORE INTO directory_generation(id, value) VALUES (1, 0)'
+            )
+            cur.execute(
+                '''CREATE TABLE IF NOT EXISTS employee_shards (
+                    employee_id INTEGER PRIMARY KEY,
+                    shard INTEGER NOT NULL
                 )'''
             )
-            # Ensure the remarks column exists for databases created
-            # with older versions of the schema.
-            cur.execute("PRAGMA table_info(timesheets)")
-            cols = [row[1] for row in cur.fetchall()]
-            if 'remarks' not in cols:
-                cur.execute('ALTER TABLE timesheets ADD COLUMN remarks TEXT')
+            COMPACT_STORAGE = _init_timesheet_tables(cur)
+            _init_user_hierarchy(cur)
+            _load_settings(cur)
+            conn.commit()
+            _stamp_schema(cur)
+        for index, path in enumerate(SHARDS):
+            _init_shard(path, index)
+    except sqlite3.Error as e:
+        print(f"Database initialization failed: {e}")
+        sys.exit(1)
+    _reset_caches()
+
+
+def _load_settings(cur):
+    global DUPLICATE_POLICY, RESTRICT_PROJECTS
+    cur.execute('SELECT key, value FROM settings')
+    settings = dict(cur.fetchall())
+    DUPLICATE_POLICY = settings.get('duplicate_policy', 'off')
+    RESTRICT_PROJECTS = settings.get('restrict_projects') == 'on'
+
+
+def _store_setting(key, value):
+    with connect_db() as conn:
+        conn.execute('INSERT OR REPLACE INTO settings(key, value) VALUES (?, ?)', (key, value))
+        conn.commit()
+
+
+def acquire_lease(name, owner, ttl):
+    """Take or renew the lease ``name`` for ``ttl`` seconds; return if held.
+
+    A lease held by another owner is only taken over once it has expired,
+    so one of the processes sharing the database holds it at a time.
+    """
+    now = time.time()
+    with connect_db() as conn:
+        cur = conn.execute(
+            'INSERT INTO leases(name, owner, expires_at) VALUES (?, ?, ?) '
+            'ON CONFLICT(name) DO UPDATE SET owner = excluded.owner, '
+            'expires_at = excluded.expires_at '
+            'WHERE leases.owner = excluded.owner OR leases.expires_at < ?',
+            (name, owner, now + ttl, now),
+        )
+        conn.commit()
+        return cur.rowcount == 1
+
+
+def release_lease(name, owner):
+    with connect_db() as conn:
+        conn.execute('DELETE FROM leases WHERE name = ? AND owner = ?', (name, owner))
+        conn.commit()
+
+
+def record_job_run(job, owner, started, duration, error=None):
+    """Store one run of a scheduled job, keeping its last ``JOB_RUNS_LIMIT``."""
+    started_at = datetime.fromtimestamp(started, timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+    with connect_db() as conn:
+        conn.execute(
+            'INSERT INTO job_runs(job, owner, started_at, duration, error) '
+            'VALUES (?, ?, ?, ?, ?)', (job, owner, started_at, duration, error))
+        conn.execute(
+            'DELETE FROM job_runs WHERE job = ? AND id <= (SELECT id FROM job_runs '
+            'WHERE job = ? ORDER BY id DESC LIMIT 1 OFFSET ?)', (job, job, JOB_RUNS_LIMIT))
+        conn.commit()
+
+
+def job_runs(job=None, limit=20):
+    """Return the latest runs as (job, owner, started_at, duration, error) rows."""
+    query = 'SELECT job, owner, started_at, duration, error FROM job_runs'
+    params = []
+    if job is not None:
+        query += ' WHERE job = ?'
+        params.append(job)
+    query += ' ORDER BY id DESC LIMIT ?'
+    params.append(limit)
+    with connect_db() as conn:
+        return conn.execute(query, params).fetchall()
+
+
+def restrict_projects_cmd(args):
+    global RESTRICT_PROJECTS
+    try:
+        _store_setting('restrict_projects', args.mode)
+    except sqlite3.Error as e:
+        print(f"Failed to change the project restriction: {e}")
+        sys.exit(1)
+    RESTRICT_PROJECTS = args.mode == 'on'
+    if RESTRICT_PROJECTS:
+        print('Timesheet entry is limited to assigned projects')
+    else:
+        print('Timesheet entry is open to all projects')
+
+
+def set_duplicate_policy(policy):
+    """Store the duplicate entry ``policy`` and add or drop the unique index.
+
+    Raises ``ValueError`` when duplicates already exist, as the index
+    cannot be built until they are merged or deleted.
+    """
+    global DUPLICATE_POLICY
+    if policy not in DUPLICATE_POLICIES:
+        raise ValueError(f'Unknown duplicate policy: {policy}')
+    for path in [DB_FILE] + SHARDS:
+        with connect_db(path) as conn:
+            cur = conn.cursor()
+            if policy == 'off':
+                cur.execute('DROP INDEX IF EXISTS main.idx_timesheets_natural_key')
+                continue
+            cur.execute(
+                'SELECT COUNT(*) FROM (SELECT 1 FROM main.timesheets '
+                'GROUP BY employee_id, project_id, entry_date HAVING COUNT(*) > 1)'
+            )
+            duplicates = cur.fetchone()[0]
+            if duplicates:
+                raise ValueError(
+                    f'{duplicates} employee/project/date combinations have more than '
+                    'one entry; merge or delete them before enabling unique entries'
+                )
+            cur.execute(NATURAL_KEY_INDEX)
             conn.commit()
+    _store_setting('duplicate_policy', policy)
+    DUPLICATE_POLICY = policy
+
+
+def unique_entries_cmd(args):
+    try:
+        set_duplicate_policy(args.policy)
+    except ValueError as e:
+        print(e)
+        return
+    except sqlite3.Error as e:
+        print(f"Failed to change the duplicate policy: {e}")
+        sys.exit(1)
+    print(f'Duplicate entry policy set to {args.policy}')
+
+
+def insert_entry(conn, emp_id, proj_id, entry_date, hours, remarks=None):
+    """Insert a timesheet entry, applying the duplicate entry policy.
+
+    ``entry_date`` and ``hours`` are ISO date and plain hours.  Under
+    ``replace`` and ``add`` an existing entry for the same employee, project
+    and date is updated in place; a locked one, or one that would exceed 24
+    hours, is left alone and 0 is returned.  Under ``reject`` a duplicate
+    raises ``sqlite3.IntegrityError``.  Returns the number of rows written.
+    """
+    query = (
+        'INSERT INTO timesheets(employee_id, project_id, entry_date, hours, remarks) '
+        'VALUES (?, ?, ?, ?, ?)'
+    )
+    if DUPLICATE_POLICY == 'replace':
+        query += (
+            ' ON CONFLICT(employee_id, project_id, entry_date) DO UPDATE '
+            'SET hours = excluded.hours, remarks = excluded.remarks '
+            "WHERE status <> 'locked'"
+        )
+    elif DUPLICATE_POLICY == 'add':
+        query += (
+            ' ON CONFLICT(employee_id, project_id, entry_date) DO UPDATE '
+            'SET hours = hours + excluded.hours, '
+            'remarks = COALESCE(excluded.remarks, remarks) '
+            f"WHERE status <> 'locked' AND hours + excluded.hours <= {to_storage_hours(24)}"
+        )
+    cur = conn.execute(
+        query,
+        (emp_id, proj_id, to_storage_date(entry_date), to_storage_hours(hours), remarks),
+    )
+    return cur.rowcount
+
+
+def is_duplicate_entry(error):
+    """Return whether ``error`` came from the natural-key unique index."""
+    return (isinstance(error, sqlite3.IntegrityError)
+            and 'UNIQUE constraint failed: timesheets.' in str(error))
+
+
+def _reset_caches():
+    """Forget cached results and ids, which may belong to another database."""
+    REPORT_CACHE.clear()
+    with _NAME_CACHE_LOCK:
+        _NAME_CACHE.clear()
+    with _ASSIGNMENT_CACHE_LOCK:
+        _ASSIGNMENT_CACHE.clear()
+
+
+def timesheet_databases():
+    """Return the database files holding timesheet rows."""
+    return list(SHARDS) or [DB_FILE]
+
+
+def fan_out(func, *args):
+    """Return ``[func(cur, *args), ...]`` for every timesheet database.
+
+    Shards are queried in parallel threads (sqlite3 releases the GIL while
+    a statement runs), each with its own connection.
+    """
+    def run(path):
+        conn = connect_db(path)
+        try:
+            return func(conn.cursor(), *args)
+        finally:
+            conn.close()
+
+    paths = timesheet_databases()
+    if len(paths) == 1:
+        return [run(paths[0])]
+    from concurrent.futures import ThreadPoolExecutor
+    with ThreadPoolExecutor(max_workers=len(paths)) as pool:
+        return list(pool.map(run, paths))
+
+
+def merge_sums(results, key=None):
+    """Merge per-database ``(*labels, hours)`` rows by summing hours.
+
+    A single result is returned unchanged, keeping its SQL ordering;
+    merged rows are sorted by ``key`` (the labels by default).
+    """
+    if len(results) == 1:
+        return results[0]
+    totals = {}
+    for rows in results:
+        for *labels, hours in rows:
+            labels = tuple(labels)
+            totals[labels] = totals.get(labels, 0) + hours
+    merged = [(*labels, hours) for labels, hours in totals.items()]
+    return sorted(merged, key=key or (lambda row: row[:-1]))
+
+
+def _entry_date_bounds():
+    """Return the ISO dates of the oldest and newest entry, or two Nones."""
+    bounds = [
+        row for row in fan_out(lambda cur: cur.execute(
+            f"SELECT {date_sql('MIN(entry_date)')}, {date_sql('MAX(entry_date)')} "
+            'FROM timesheets'
+        ).fetchone()) if row[0]
+    ]
+    return (min((row[0] for row in bounds), default=None),
+            max((row[1] for row in bounds), default=None))
+
+
+def date_partitions(start, end, jobs):
+    """Split ``start``..``end`` into at most ``jobs`` contiguous date ranges.
+
+    Open ends are resolved against the data on disk for splitting but stay
+    open in the first and last range.  Ranges spanning more than a month
+    are cut on month starts so closed months stay whole and keep being read
+    from their snapshots.
+    """
+    lo, hi = _entry_date_bounds()
+    lo, hi = start or lo, end or hi
+    if jobs <= 1 or not lo or not hi or lo >= hi:
+        return [(start, end)]
+    first, last = date.fromisoformat(lo).toordinal(), date.fromisoformat(hi).toordinal()
+    step = -(-(last - first + 1) // jobs)
+    cuts = []
+    for ordinal in range(first + step, last + 1, step):
+        cut = date.fromordinal(ordinal)
+        if step > 31:
+            cut = cut.replace(day=1)
+        if cut.toordinal() > first and (not cuts or cut > cuts[-1]):
+            cuts.append(cut)
+    starts = [start] + [cut.isoformat() for cut in cuts]
+    ends = [(cut - timedelta(days=1)).isoformat() for cut in cuts] + [end]
+    return list(zip(starts, ends))
+
+
+def _init_worker(db_file, shards, compact):
+    """Copy the parent's database settings into a report worker process."""
+    global DB_FILE, SHARDS, COMPACT_STORAGE
+    DB_FILE, SHARDS, COMPACT_STORAGE = db_file, shards, compact
+
+
+def _read_only_uri(path):
+    if is_memory_db(path):
+        return _memory_uri(path)
+    from urllib.parse import quote
+    return 'file:' + quote(os.path.abspath(path)) + '?mode=ro'
+
+
+def _run_partition(path, func, start, end, args):
+    """Run one partial aggregation on a read-only connection to ``path``."""
+    conn = sqlite3.connect(_read_only_uri(path), uri=True)
+    try:
+        if path != DB_FILE:
+            conn.execute('ATTACH DATABASE ? AS directory', (_read_only_uri(DB_FILE),))
+        return func(conn.cursor(), start, end, *args)
+    finally:
+        conn.close()
+
+
+def partitioned(func, start, end, jobs=1, *args):
+    """Return ``func(cur, lo, hi, *args)`` results over date partitions.
+
+    With ``jobs`` above one the range is split with :func:`date_partitions`
+    and every partition of every timesheet database runs in a pool of
+    ``jobs`` worker processes; ``func`` must be a module level function so
+    it can be sent to the workers.  Otherwise this is :func:`fan_out` over
+    the whole range.
+    """
+    databases = timesheet_databases()
+    # Worker processes cannot see this process's in-memory databases.
+    if jobs <= 1 or any(is_memory_db(path) for path in databases + [DB_FILE]):
+        return fan_out(func, start, end, *args)
+    from concurrent.futures import ProcessPoolExecutor
+    tasks = [
+        (path, lo, hi)
+        for path in databases
+        for lo, hi in date_partitions(start, end, jobs)
+    ]
+    with ProcessPoolExecutor(max_workers=min(jobs, len(tasks)),
+                             initializer=_init_worker,
+                             initargs=(DB_FILE, SHARDS, COMPACT_STORAGE)) as pool:
+        futures = [pool.submit(_run_partition, path, func, lo, hi, args)
+                   for path, lo, hi in tasks]
+        return [future.result() for future in futures]
+
+
+def shard_for_employee(cur, emp_id):
+    """Return the database file that stores ``emp_id``'s timesheet rows.
+
+    Assignments are recorded in ``employee_shards`` on first use so that an
+    employee's rows always share one shard, even if their department later
+    changes; per-employee aggregates are therefore complete in each shard.
+    """
+    if not SHARDS:
+        return DB_FILE
+    cur.execute('SELECT shard FROM employee_shards WHERE employee_id = ?', (emp_id,))
+    row = cur.fetchone()
+    if row is None:
+        key = ''
+        if SHARD_BY == 'department':
+            cur.execute(
+                'SELECT u.department FROM users u JOIN employees e ON e.name = u.full_name '
+                'WHERE e.id = ?',
+                (emp_id,),
+            )
+            found = cur.fetchone()
+            key = found[0] if found else ''
+        key = key or str(emp_id)
+        cur.execute(
+            'INSERT OR IGNORE INTO employee_shards(employee_id, shard) VALUES (?, ?)',
+            (emp_id, zlib.crc32(key.encode()) % len(SHARDS)),
+        )
+        cur.execute('SELECT shard FROM employee_shards WHERE employee_id = ?', (emp_id,))
+        row = cur.fetchone()
+    return SHARDS[row[0] % len(SHARDS)]
+
+
+@contextmanager
+def entry_connection(conn, emp_id):
+    """Yield the connection to write ``emp_id``'s timesheet rows through.
+
+    A shard connection opened for the write is closed on exit; ``conn``
+    itself is left open.
+    """
+    path = shard_for_employee(conn.cursor(), emp_id)
+    if path == DB_FILE:
+        yield conn
+        return
+    target = connect_db(path)
+    try:
+        yield target
+    finally:
+        target.close()
+
+
+def _entry_database(entry_id=None, employee=None):
+    """Return the database holding an entry given its id or employee."""
+    if not SHARDS:
+        return DB_FILE
+    if entry_id:
+        index = entry_id // SHARD_ID_SPAN - 1
+        return SHARDS[index] if 0 <= index < len(SHARDS) else DB_FILE
+    with connect_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT s.shard FROM employee_shards s '
+            'JOIN employees e ON e.id = s.employee_id WHERE e.name = ?',
+            (employee,),
+        )
+        row = cur.fetchone()
+    return SHARDS[row[0] % len(SHARDS)] if row else DB_FILE
+
+
+def data_generation():
+    """Return the counter bumped by every write to ``GENERATION_TABLES``.
+
+    Equal values mean no tracked table has changed in between, in this or
+    any other process sharing the database file.
+    """
+    total = 0
+    for path in [DB_FILE] + SHARDS:
+        with connect_db(path) as conn:
+            cur = conn.cursor()
+            cur.execute('SELECT value FROM main.data_generation WHERE id = 1')
+            row = cur.fetchone()
+            total += row[0] if row else 0
+    return total
+
+
+def directory_generation():
+    """Return the counter bumped by every write to ``DIRECTORY_TABLES``.
+
+    Unlike :func:`data_generation` it stays put while time is logged.
+    """
+    with connect_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT value FROM main.directory_generation WHERE id = 1')
+        row = cur.fetchone()
+    return row[0] if row else 0
+
+
+def _ordinal_bound(value, default):
+    """Return the day ordinal of an ISO date, or ``default`` if not a date."""
+    if not value:
+        return default
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date().toordinal()
+    except (TypeError, ValueError):
+        return default
+
+
+def _estimate_size(value):
+    """Return an approximate memory footprint of a report result."""
+    size = sys.getsizeof(value)
+    if isinstance(value, (list, tuple)):
+        size += sum(_estimate_size(item) for item in value)
+    return size
+
+
+class ReportCache:
+    """LRU cache of report results with TTLs and date-range invalidation.
+
+    Each entry remembers the day-ordinal range it was computed over.  Before
+    serving a result the cache reads the ``timesheet_changes`` rows written
+    since its last check and evicts only the entries whose range covers a
+    changed day, so writes from any process are honoured.
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.stats = dict(hits=0, misses=0, evictions=0, invalidations=0, expirations=0)
+        self._items = OrderedDict()
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self._seen.clear()
+            self.size = 0
+
+    def _drop(self, key):
+        entry = self._items.pop(key)
+        self.size -= entry['size']
+
+    def sync(self, db_file):
+        """Evict entries for ``db_file`` covering days changed since last sync."""
+        # The directory logs org chart changes even when shards hold the rows.
+        for source in [DB_FILE] + SHARDS:
+            self._sync_source(db_file, source)
+
+    def _sync_source(self, db_file, source):
+        """Apply the change log of one timesheet database ``source``."""
+        seen_key = (db_file, source)
+        with connect_db(source) as conn:
+            cur = conn.cursor()
+            cur.execute(
+                'SELECT (SELECT MIN(id) FROM timesheet_changes), '
+                '(SELECT MAX(id) FROM timesheet_changes)'
+            )
+            low, high = (value or 0 for value in cur.fetchone())
+            last = self._seen.get(seen_key)
+            if last is None or last == high:
+                self._seen[seen_key] = high
+                return
+            # A log that went backwards (recreated database) or was pruned
+            # past our last check cannot tell which days changed.
+            overrun = high < last or low > last + 1
+            changes = []
+            if not overrun:
+                cur.execute(
+                    'SELECT day_ordinal FROM timesheet_changes WHERE id > ?', (last,)
+                )
+                changes = [row[0] for row in cur.fetchall()]
+                overrun = ORG_CHANGE_DAY in changes
+        with self._lock:
+            self._seen[seen_key] = high
+            for key in [k for k in self._items if k[0] == db_file]:
+                entry = self._items[key]
+                if overrun or any(entry['lo'] <= day <= entry['hi'] for day in changes):
+                    self._drop(key)
+                    self.stats['invalidations'] += 1
+
+    def get(self, key):
+        with self._lock:
+            entry = self._items.get(key)
+            if entry is None:
+                self.stats['misses'] += 1
+                return None
+            if entry['expires'] < time.monotonic():
+                self._drop(key)
+                self.stats['expirations'] += 1
+                self.stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self.stats['hits'] += 1
+            return entry
+
+    def put(self, key, value, lo, hi, ttl):
+        size = _estimate_size(value)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._items:
+                self._drop(key)
+            self._items[key] = dict(value=value, lo=lo, hi=hi, size=size,
+                                    expires=time.monotonic() + ttl)
+            self.size += size
+            while self.size > self.max_bytes:
+                self._drop(next(iter(self._items)))
+                self.stats['evictions'] += 1
+
+    def info(self):
+        with self._lock:
+            return dict(self.stats, entries=len(self._items), bytes=self.size,
+                        max_bytes=self.max_bytes)
+
+
+REPORT_CACHE = ReportCache(REPORT_CACHE_MAX_BYTES)
+
+
+def cached_report(ttl=300, start_arg='start', end_arg='end'):
+    """Memoize a report function in ``REPORT_CACHE``.
+
+    Results are keyed by database file, function and bound arguments, expire
+    after ``ttl`` seconds and are invalidated when a timesheet entry dated
+    within ``start_arg``..``end_arg`` changes.  List results are copied so
+    callers cannot modify the cached value.
+    """
+    def decorator(func):
+        signature = None
+
+        def lookup(args, kwargs, refresh):
+            nonlocal signature
+            if signature is None:
+                # Imported on first use to keep CLI startup short.
+                import inspect
+                signature = inspect.signature(func)
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            key = (DB_FILE, func.__qualname__, tuple(arguments.items()))
+            REPORT_CACHE.sync(DB_FILE)
+            entry = None if refresh else REPORT_CACHE.get(key)
+            if entry is not None:
+                value = entry['value']
+            else:
+                value = func(*args, **kwargs)
+                REPORT_CACHE.put(
+                    key,
+                    value,
+                    _ordinal_bound(arguments.get(start_arg), float('-inf')),
+                    _ordinal_bound(arguments.get(end_arg), float('inf')),
+                    ttl,
+                )
+            return list(value) if isinstance(value, list) else value
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return lookup(args, kwargs, False)
+
+        def refresh(*args, **kwargs):
+            """Recompute and cache the result, restarting its ``ttl``."""
+            return lookup(args, kwargs, True)
+
+        wrapper.cache = REPORT_CACHE
+        wrapper.refresh = refresh
+        return wrapper
+    return decorator
+
+
+# Tables with a unique ``name`` column that get_or_create may resolve.
+NAME_TABLES = ('employees', 'projects')
+NAME_CACHE_SIZE = 4096
+_NAME_CACHE = OrderedDict()
+_NAME_CACHE_LOCK = threading.Lock()
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+# Per-user sets of assigned projects kept by assigned_projects.
+ASSIGNMENT_CACHE_SIZE = 1024
+ASSIGNMENT_CACHE_TTL = 60
+_ASSIGNMENT_CACHE = OrderedDict()
+_ASSIGNMENT_CACHE_LOCK = threading.Lock()
+
+
+def assigned_projects(full_name):
+    """Return the sorted ``project_master`` names assigned to a user.
+
+    Sets are cached per user together with the data generation they were
+    read at.  Assignments in any process bump the generation, so a changed
+    generation is a miss; ``ASSIGNMENT_CACHE_TTL`` only bounds how long an
+    entry lives otherwise.
+    """
+    key = (DB_FILE, full_name)
+    now = time.monotonic()
+    with connect_db() as conn:
+        cur = conn.cursor()
+        cur.execute('SELECT value FROM main.data_generation WHERE id = 1')
+        generation = cur.fetchone()[0]
+        with _ASSIGNMENT_CACHE_LOCK:
+            entry = _ASSIGNMENT_CACHE.get(key)
+            if entry and entry[0] > now and entry[1] == generation:
+                _ASSIGNMENT_CACHE.move_to_end(key)
+                return list(entry[2])
+        cur.execute(
+            'SELECT pm.project_name FROM users u '
+            'JOIN project_assignments pa ON pa.user_id = u.id '
+            'JOIN project_master pm ON pm.id = pa.project_id '
+            'WHERE u.full_name = ? ORDER BY pm.project_name',
+            (full_name,),
+        )
+        names = tuple(row[0] for row in cur.fetchall())
+    with _ASSIGNMENT_CACHE_LOCK:
+        _ASSIGNMENT_CACHE[key] = (now + ASSIGNMENT_CACHE_TTL, generation, names)
+        while len(_ASSIGNMENT_CACHE) > ASSIGNMENT_CACHE_SIZE:
+            _ASSIGNMENT_CACHE.popitem(last=False)
+    return list(names)
+
+
+def assign_projects(project_id, user_ids):
+    """Assign users to a ``project_master`` project and refresh their sets."""
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    with connect_db() as conn:
+        cur = conn.cursor()
+        cur.executemany(
+            'INSERT OR IGNORE INTO project_assignments(project_id, user_id) VALUES (?, ?)',
+            [(project_id, user_id) for user_id in user_ids],
+        )
+        conn.commit()
+        cur.execute(
+            f'SELECT full_name FROM users WHERE id IN {_placeholders(user_ids)}', user_ids
+        )
+        names = [row[0] for row in cur.fetchall()]
+    with _ASSIGNMENT_CACHE_LOCK:
+        for name in names:
+            _ASSIGNMENT_CACHE.pop((DB_FILE, name), None)
+
+
+def report_cache_stats():
+    """Return hit/miss/eviction counters and the size of the report cache."""
+    return REPORT_CACHE.info()
+
+
+def _check_name_table(table):
+    if table not in NAME_TABLES:
+        raise ValueError(f'Unknown name table: {table}')
+
+
+def lookup_id(cursor, table, name):
+    """Return the id of ``name`` in ``table`` or ``None`` if it is missing.
+
+    Ids of existing rows are kept in a bounded process-wide cache keyed by
+    database file.  Rows are never renamed or deleted, so cached ids stay
+    valid until ``init_db`` clears the cache.
+    """
+    _check_name_table(table)
+    key = (DB_FILE, table, name)
+    with _NAME_CACHE_LOCK:
+        if key in _NAME_CACHE:
+            _NAME_CACHE.move_to_end(key)
+            return _NAME_CACHE[key]
+    cursor.execute(f"SELECT id FROM {table} WHERE name = ?", (name,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    with _NAME_CACHE_LOCK:
+        _NAME_CACHE[key] = row[0]
+        while len(_NAME_CACHE) > NAME_CACHE_SIZE:
+            _NAME_CACHE.popitem(last=False)
+    return row[0]
+
+
+def get_or_create(cursor, table, name):
+    """Return the id for the given name, inserting a new row if needed.
+
+    The function returns a tuple ``(id, created)`` where ``created`` is
+    ``True`` when a new row was inserted and ``False`` when an existing
+    row was found.  This allows callers to distinguish between the two
+    cases without relying on catching an ``IntegrityError``.
+
+    The insert skips names another connection added first, so concurrent
+    callers both get the same id.  Newly created ids are not cached until
+    they are found again, as the caller's transaction may still roll back.
+    """
+    row_id = lookup_id(cursor, table, name)
+    if row_id is not None:
+        return row_id, False
+    if _HAS_RETURNING:
+        cursor.execute(
+            f"INSERT INTO {table}(name) VALUES (?) ON CONFLICT(name) DO NOTHING RETURNING id",
+            (name,),
+        )
+        row = cursor.fetchone()
+        if row:
+            return row[0], True
+    else:
+        cursor.execute(f"INSERT OR IGNORE INTO {table}(name) VALUES (?)", (name,))
+        if cursor.rowcount == 1:
+            return cursor.lastrowid, True
+    return lookup_id(cursor, table, name), False
+
+
+def add_employee(args):
+    with connect_db() as conn:
+        cur = conn.cursor()
+        try:
+            _, created = get_or_create(cur, 'employees', args.name)
+            if created:
+                conn.commit()
+                print(f"Employee '{args.name}' added")
+            else:
+                print(f"Employee '{args.name}' already exists")
+        except sqlite3.Error as e:
+            print(f"Failed to add employee: {e}")
+            sys.exit(1)
+
+
+def add_project(args):
+    with connect_db() as conn:
+        cur = conn.cursor()
+        try:
+            _, created = get_or_create(cur, 'projects', args.name)
+            if created:
+                conn.commit()
+                print(f"Project '{args.name}' added")
+            else:
+                print(f"Project '{args.name}' already exists")
+        except sqlite3.Error as e:
+            print(f"Failed to add project: {e}")
+            sys.exit(1)
+
+
+def log_time(args):
+    # Validate hours value
+    if args.hours <= 0 or args.hours > 24:
+        print('Hours must be greater than 0 and no more than 24.')
+        return
+    if args.hours * 2 != int(args.hours * 2):
+        print('Hours must be in 0.5 hour increments.')
+        return
+
+    # Validate date format and ensure it's not in the future
+    try:
+        entry_date = datetime.strptime(args.date, '%Y-%m-%d').date()
+    except ValueError:
+        print('Date must be in YYYY-MM-DD format.')
+        return
+    if entry_date > date.today():
+        print('Date cannot be in the future.')
+        return
+
+    remarks = getattr(args, 'remarks', None)
+
+    with connect_db() as conn:
+        cur = conn.cursor()
+        emp_id, _ = get_or_create(cur, 'employees', args.employee)
+        proj_id, _ = get_or_create(cur, 'projects', args.project)
+        try:
+            with entry_connection(conn, emp_id) as target:
+                written = insert_entry(target, emp_id, proj_id, entry_date.isoformat(),
+                                       args.hours, remarks)
+                conn.commit()
+                target.commit()
+            if written:
+                print('Time entry recorded')
+            else:
+                print('The existing entry for that day is locked or would exceed 24 hours')
+        except sqlite3.Error as e:
+            if is_duplicate_entry(e):
+                print('An entry for that employee, project and date already exists')
+            else:
+                print(f"Failed to log time: {e}")
+            sys.exit(1)
+
+
+def _report_query(cur, start, end, project, summary):
+    """Return the report query and parameters for one database and range."""
+    params = [project]
+    total_hours = hours_sql('SUM(t.hours)')
+    if summary == 'employee':
+        query = f'''SELECT e.name, {total_hours}
+                   FROM timesheets t
+                   JOIN employees e ON e.id = t.employee_id
+                   JOIN projects p ON p.id = t.project_id
+                   WHERE p.name = ?'''
+    elif summary == 'date':
+        # Served in entry_date order by idx_timesheets_project_date.
+        query = f'''SELECT {date_sql('t.entry_date')}, {total_hours}
+                   FROM timesheets t
+                   JOIN projects p ON p.id = t.project_id
+                   WHERE p.name = ?'''
+    else:
+        query = f'''SELECT p.name, e.name, {date_sql('t.entry_date')}, {hours_sql('t.hours')}
+                   FROM timesheets t
+                   JOIN employees e ON e.id = t.employee_id
+                   JOIN projects p ON p.id = t.project_id
+                   WHERE p.name = ?'''
+    if start:
+        query += ' AND t.entry_date >= ?'
+        params.append(to_storage_date(start))
+    if end:
+        query += ' AND t.entry_date <= ?'
+        params.append(to_storage_date(end))
+    if summary == 'employee':
+        query += ' GROUP BY e.name ORDER BY e.name'
+    elif summary == 'date':
+        query += ' GROUP BY t.entry_date ORDER BY t.entry_date'
+    else:
+        query += ' ORDER BY t.entry_date, e.name'
+    return query, params
+
+
+def _report_rows(cur, start, end, project, summary):
+    """Return the report rows of one database and date range."""
+    return cur.execute(*_report_query(cur, start, end, project, summary)).fetchall()
+
+
+def stream_rows(build, *args, key=None):
+    """Yield the rows of ``build(cur, *args)``'s query from every database.
+
+    ``build`` returns ``(query, params)``. Each cursor is read
+    ``FETCH_SIZE`` rows at a time and the ordered streams of several shards
+    are merged by ``key``, so memory stays flat however many rows match.
+    """
+    def rows(path):
+        conn = connect_db(path)
+        try:
+            cur = conn.cursor()
+            cur.execute(*build(cur, *args))
+            while True:
+                batch = cur.fetchmany(FETCH_SIZE)
+                if not batch:
+                    return
+                yield from batch
+        finally:
+            conn.close()
+
+    streams = [rows(path) for path in timesheet_databases()]
+    return streams[0] if len(streams) == 1 else heapq.merge(*streams, key=key)
+
+
+def _sum_runs(rows):
+    """Merge adjacent rows with equal labels by summing their last column."""
+    labels, hours = None, 0
+    for *row_labels, row_hours in rows:
+        if row_labels == labels:
+            hours += row_hours
+            continue
+        if labels is not None:
+            yield (*labels, hours)
+        labels, hours = row_labels, row_hours
+    if labels is not None:
+        yield (*labels, hours)
+
+
+def _running_totals(rows, group=False):
+    """Append the running total of the last column to each row.
+
+    With ``group`` the total restarts whenever the first column changes.
+    """
+    first, total = object(), 0
+    for row in rows:
+        if group and row[0] != first:
+            first, total = row[0], 0
+        total += row[-1]
+        yield (*row, total)
+
+
+def write_records(rows, fields, fmt):
+    """Write ``rows`` to stdout as they arrive, as CSV, TSV or JSON lines."""
+    out = sys.stdout
+    if fmt == 'jsonl':
+        import json
+        for row in rows:
+            out.write(json.dumps(dict(zip(fields, row))) + '\n')
+        return
+    import csv
+    writer = csv.writer(out, delimiter='\t' if fmt == 'tsv' else ',', lineterminator='\n')
+    writer.writerow(fields)
+    writer.writerows(rows)
+
+
+def report(args):
+    """Print a project's entries, or their totals per employee or date.
+
+    Rows are streamed from the cursor unless ``--jobs`` splits the range
+    over worker processes. ``--format`` other than ``text`` writes CSV, TSV
+    or JSON lines with a running total column.
+    """
+    summary = getattr(args, 'summary', None)
+    jobs = getattr(args, 'jobs', 1)
+    fmt = getattr(args, 'format', 'text')
+    key = (lambda row: row[0]) if summary else (lambda row: (row[2], row[1]))
+    try:
+        if jobs > 1:
+            results = partitioned(_report_rows, args.start, args.end, jobs,
+                                  args.project, summary)
+            rows = merge_sums(results) if summary else heapq.merge(*results, key=key)
+        else:
+            rows = stream_rows(_report_query, args.start, args.end, args.project,
+                               summary, key=key)
+            if summary:
+                rows = _sum_runs(rows)
+        if fmt != 'text':
+            fields = [summary, 'hours'] if summary else ['project', 'employee', 'date', 'hours']
+            write_records(_running_totals(rows), fields + ['running_total'], fmt)
+            return
+        total = None
+        for row in rows:
+            *labels, hours = row
+            if not summary:
+                labels = [labels[2], labels[1]]
+            print(' | '.join(labels) + f' | {hours}h')
+            total = (total or 0) + hours
+    except sqlite3.Error as e:
+        print(f"Failed to run report: {e}")
+        sys.exit(1)
+    if total is None:
+        print('No entries found')
+        return
+    print(f"Total hours for {args.project}: {total}")
+
+
+def _find_entry(cur, entry_id=None, employee=None, project=None, entry_date=None):
+    """Return the id of the entry matching the given criteria."""
+    if entry_id:
+        cur.execute('SELECT id FROM timesheets WHERE id = ?', (entry_id,))
+        row = cur.fetchone()
+        return row[0] if row else None
+    if employee and project and entry_date:
+        where, params = _entry_filter(employee, project, entry_date, entry_date)
+        cur.execute(f'SELECT id FROM timesheets WHERE {where}', params)
+        row = cur.fetchone()
+        return row[0] if row else None
+    return None
+
+
+def update_time(args):
+    with connect_db(_entry_database(args.id, args.employee)) as conn:
+        cur = conn.cursor()
+        entry_id = _find_entry(
+            cur, args.id, args.employee, args.project, args.entry_date
+        )
+        if not entry_id:
+            print('Entry not found')
+            return
+        updates = []
+        params = []
+        if args.new_hours is not None:
+            updates.append('hours = ?')
+            params.append(to_storage_hours(args.new_hours))
+        if args.new_date:
+            updates.append('entry_date = ?')
+            params.append(to_storage_date(args.new_date))
+        if not updates:
+            print('No updates specified')
+            return
+        params.append(entry_id)
+        try:
+            cur.execute(
+                f'UPDATE timesheets SET {", ".join(updates)} '
+                "WHERE id = ? AND status <> 'locked'",
+                params,
+            )
+        except sqlite3.Error as e:
+            if is_duplicate_entry(e):
+                print('An entry for that employee, project and date already exists')
+            else:
+                print(f"Failed to update entry: {e}")
+            return
+        if not cur.rowcount:
+            print(f'Entry {entry_id} is locked and cannot be changed')
+            return
+        conn.commit()
+        print(f'Entry {entry_id} updated')
+
+
+def delete_time(args):
+    with connect_db(_entry_database(args.id, args.employee)) as conn:
+        cur = conn.cursor()
+        entry_id = _find_entry(
+            cur, args.id, args.employee, args.project, args.entry_date
+        )
+        if not entry_id:
+            print('Entry not found')
+            return
+        cur.execute(
+            "DELETE FROM timesheets WHERE id = ? AND status <> 'locked'", (entry_id,)
+        )
+        if not cur.rowcount:
+            print(f'Entry {entry_id} is locked and cannot be deleted')
+            return
+        conn.commit()
+        print(f'Entry {entry_id} deleted')
+
+
+def _team_filter(manager_id=None, department=None):
+    """Return an SQL condition and params selecting a team's timesheet rows.
+
+    Users are matched to timesheet employees by name.  ``manager_id`` selects
+    the user's direct reports, ``department`` everyone in that department.
+    The condition is empty when neither is given.
+    """
+    conditions, params = [], []
+    if manager_id is not None:
+        conditions.append('u.reporting_manager = ?')
+        params.append(manager_id)
+    if department:
+        conditions.append('u.department = ?')
+        params.append(department)
+    if not conditions:
+        return '', []
+    return (
+        'employee_id IN (SELECT e.id FROM users u '
+        'JOIN employees e ON e.name = u.full_name WHERE '
+        + ' AND '.join(conditions) + ')',
+        params,
+    )
+
+
+def transition_entries(action, start=None, end=None, manager_id=None, department=None):
+    """Apply an approval ``action`` to a team's entries in one UPDATE.
+
+    Only entries in the action's source state move; the number of updated
+    rows is returned.  Raises ``ValueError`` unless ``manager_id`` or
+    ``department`` narrows the team.
+    """
+    from_status, to_status = STATUS_TRANSITIONS[action]
+    team_sql, params = _team_filter(manager_id, department)
+    if not team_sql:
+        raise ValueError('A manager or department is required')
+    # The literal ``status <> 'locked'`` lets SQLite use the partial index.
+    query = (
+        'UPDATE timesheets SET status = ? '
+        f"WHERE status <> 'locked' AND status = ? AND {team_sql}"
+    )
+    params = [to_status, from_status] + params
+    if start:
+        query += ' AND entry_date >= ?'
+        params.append(to_storage_date(start))
+    if end:
+        query += ' AND entry_date <= ?'
+        params.append(to_storage_date(end))
+
+    def run(cur):
+        cur.execute(query, params)
+        cur.connection.commit()
+        return cur.rowcount
+
+    return sum(fan_out(run))
+
+
+def pending_approval_counts():
+    """Return a mapping of open status to entry count.
+
+    Served entirely from the partial ``idx_timesheets_open_status`` index.
+    """
+    counts = {}
+    for rows in fan_out(lambda cur: cur.execute(
+        "SELECT status, COUNT(*) FROM timesheets WHERE status <> 'locked' "
+        'GROUP BY status'
+    ).fetchall()):
+        for status, count in rows:
+            counts[status] = counts.get(status, 0) + count
+    return counts
+
+
+def bulk_transition(args):
+    try:
+        count = transition_entries(
+            args.action, args.start, args.end, args.manager, args.department
+        )
+    except ValueError as e:
+        print(e)
+        return
+    except sqlite3.Error as e:
+        print(f"Failed to {args.action} entries: {e}")
+        sys.exit(1)
+    _, to_status = STATUS_TRANSITIONS[args.action]
+    print(f'{count} entries marked {to_status}')
+
+
+def _entry_filter(employee=None, project=None, start=None, end=None, ids=None):
+    """Return an SQL condition and params selecting timesheet rows.
+
+    Names are resolved by scalar subqueries on their unique indexes, so the
+    rows themselves are found through the employee/project date indexes.
+    """
+    conditions, params = [], []
+    if employee:
+        conditions.append('employee_id = (SELECT id FROM employees WHERE name = ?)')
+        params.append(employee)
+    if project:
+        conditions.append('project_id = (SELECT id FROM projects WHERE name = ?)')
+        params.append(project)
+    if start and start == end:
+        conditions.append('entry_date = ?')
+        params.append(to_storage_date(start))
+    else:
+        if start:
+            conditions.append('entry_date >= ?')
+            params.append(to_storage_date(start))
+        if end:
+            conditions.append('entry_date <= ?')
+            params.append(to_storage_date(end))
+    if ids:
+        conditions.append(f'id IN {_placeholders(ids)}')
+        params.extend(ids)
+    return ' AND '.join(conditions), params
+
+
+def bulk_change(action, employee=None, project=None, start=None, end=None, ids=None,
+                new_hours=None, new_date=None, new_project=None, dry_run=False):
+    """Update or delete every unlocked entry matching the filters at once.
+
+    ``action`` is ``'update'`` or ``'delete'``.  Each database runs a single
+    UPDATE or DELETE in one transaction.  Returns ``(affected, locked)``:
+    the rows changed (or, with ``dry_run``, that would be) and the matching
+    locked rows left alone.  Raises ``ValueError`` for missing filters or
+    invalid new values.
+    """
+    where, params = _entry_filter(employee, project, start, end, ids)
+    if not where:
+        raise ValueError('At least one filter is required')
+    assignments, values = [], []
+    if action == 'update':
+        if new_hours is not None:
+            if new_hours <= 0 or new_hours > 24:
+                raise ValueError('Hours must be greater than 0 and no more than 24.')
+            if new_hours * 2 != int(new_hours * 2):
+                raise ValueError('Hours must be in 0.5 hour increments.')
+            assignments.append('hours = ?')
+            values.append(to_storage_hours(new_hours))
+        if new_date:
+            try:
+                datetime.strptime(new_date, '%Y-%m-%d')
+            except ValueError:
+                raise ValueError('Date must be in YYYY-MM-DD format.') from None
+            assignments.append('entry_date = ?')
+            values.append(to_storage_date(new_date))
+        if new_project:
+            with connect_db() as conn:
+                project_id = lookup_id(conn.cursor(), 'projects', new_project)
+            if project_id is None:
+                raise ValueError(f"Project '{new_project}' not found")
+            assignments.append('project_id = ?')
+            values.append(project_id)
+        if not assignments:
+            raise ValueError('No updates specified')
+
+    def run(cur):
+        if not dry_run:
+            if action == 'delete':
+                cur.execute(
+                    f"DELETE FROM timesheets WHERE status <> 'locked' AND {where}", params
+                )
+            else:
+                cur.execute(
+                    f"UPDATE timesheets SET {', '.join(assignments)} "
+                    f"WHERE status <> 'locked' AND {where}",
+                    values + params,
+                )
+            changed = cur.rowcount
+        cur.execute(
+            f"SELECT TOTAL(status <> 'locked'), TOTAL(status = 'locked') "
+            f'FROM timesheets WHERE {where}',
+            params,
+        )
+        unlocked, locked = (int(value) for value in cur.fetchone())
+        cur.connection.commit()
+        return (unlocked if dry_run else changed), locked
+
+    results = fan_out(run)
+    return sum(r[0] for r in results), sum(r[1] for r in results)
+
+
+def bulk_edit(args):
+    new_values = {}
+    if args.action == 'update':
+        new_values = dict(new_hours=args.new_hours, new_date=args.new_date,
+                          new_project=args.new_project)
+    try:
+        affected, locked = bulk_change(
+            args.action, args.employee, args.project, args.start, args.end,
+            args.ids, dry_run=args.dry_run, **new_values,
+        )
+    except ValueError as e:
+        print(e)
+        return
+    except sqlite3.Error as e:
+        print(f"Failed to {args.action} entries: {e}")
+        sys.exit(1)
+    verb = 'updated' if args.action == 'update' else 'deleted'
+    if args.dry_run:
+        print(f'{affected} entries would be {verb}')
+    else:
+        print(f'{affected} entries {verb}')
+    if locked:
+        print(f'{locked} locked entries skipped')
+
+
+def _month_bounds(month):
+    """Return the first and last ISO dates of a ``YYYY-MM`` month."""
+    first = datetime.strptime(month, '%Y-%m').date()
+    if first.strftime('%Y-%m') != month:
+        raise ValueError(f'Month must be in YYYY-MM format: {month}')
+    following = (first.replace(day=28) + timedelta(days=4)).replace(day=1)
+    return first.isoformat(), (following - timedelta(days=1)).isoformat()
+
+
+def _split_closed(cur, start=None, end=None):
+    """Split a date range into closed months and live date ranges.
+
+    Returns ``(months, ranges)``: the closed months lying entirely inside
+    ``start``..``end``, to be read from ``period_aggregates``, and the
+    ``(lo, hi)`` ISO date ranges (``None`` meaning unbounded) that remain to
+    be aggregated from raw rows.
+    """
+    try:
+        for value in (start, end):
+            if value:
+                datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        return [], [(start, end)]
+    cur.execute(
+        'SELECT month_key FROM closed_periods WHERE month_key BETWEEN ? AND ? '
+        'ORDER BY month_key',
+        (start[:7] if start else '0000-00', end[:7] if end else '9999-99'),
+    )
+    months, ranges, lo = [], [], start or None
+    for (month,) in cur.fetchall():
+        first, last = _month_bounds(month)
+        if (start and first < start) or (end and last > end):
+            continue
+        months.append(month)
+        if lo is None or lo < first:
+            day_before = date.fromisoformat(first) - timedelta(days=1)
+            ranges.append((lo, day_before.isoformat()))
+        lo = (date.fromisoformat(last) + timedelta(days=1)).isoformat()
+    if not (lo and end and lo > end):
+        ranges.append((lo, end or None))
+    return months, ranges
+
+
+def _live_condition(ranges, column='t.entry_date'):
+    """Return SQL and params restricting ``column`` to the live ranges."""
+    terms, params = [], []
+    for lo, hi in ranges:
+        parts = []
+        if lo:
+            parts.append(f'{column} >= ?')
+            params.append(to_storage_date(lo))
+        if hi:
+            parts.append(f'{column} <= ?')
+            params.append(to_storage_date(hi))
+        terms.append('(' + ' AND '.join(parts) + ')' if parts else '1=1')
+    if not terms:
+        return '0', []
+    return '(' + ' OR '.join(terms) + ')', params
+
+
+def _placeholders(values):
+    """Return an SQL ``IN`` list of placeholders for ``values``."""
+    return '(' + ', '.join('?' * len(values)) + ')'
+
+
+def _under_filter(manager_id):
+    """Return a ``{0}``-aliased condition and params for a manager's org.
+
+    Selects rows of everyone reporting to user ``manager_id`` directly or
+    indirectly, through one range of the ``user_hierarchy`` closure table.
+    Users are matched to timesheet employees by name.
+    """
+    if manager_id is None:
+        return '', []
+    return (
+        ' AND {0}.employee_id IN (SELECT e.id FROM user_hierarchy h '
+        'JOIN users u ON u.id = h.descendant JOIN employees e ON e.name = u.full_name '
+        'WHERE h.ancestor = ? AND h.depth > 0)',
+        [manager_id],
+    )
+
+
+def totals_subquery(cur, dim_col, start=None, end=None, project=None, under=None):
+    """Return SQL and params for ``(dim_col, hours)`` totals over a range.
+
+    Closed months inside the range come from ``period_aggregates`` and only
+    the open remainder is aggregated from timesheet rows, so long ranges
+    cost about as much as their open tail.  ``under`` limits the totals to
+    the org below that user id.
+    """
+    months, ranges = _split_closed(cur, start, end)
+    live_sql, params = _live_condition(ranges)
+    filter_sql, filter_params = _under_filter(under)
+    if project:
+        filter_sql += ' AND {0}.project_id = (SELECT id FROM projects WHERE name = ?)'
+        filter_params.append(project)
+    params.extend(filter_params)
+    query = (
+        f"SELECT t.{dim_col} AS {dim_col}, {hours_sql('SUM(t.hours)')} AS hours "
+        f'FROM timesheets t WHERE {live_sql}{filter_sql.format("t")} '
+        f'GROUP BY t.{dim_col}'
+    )
+    if months:
+        query += (
+            f' UNION ALL SELECT a.{dim_col}, SUM(a.hours) FROM period_aggregates a '
+            f'WHERE a.month_key IN {_placeholders(months)}{filter_sql.format("a")} '
+            f'GROUP BY a.{dim_col}'
+        )
+        params.extend(months)
+        params.extend(filter_params)
+    return query, params
+
+
+def close_period(month):
+    """Close a payroll month: lock its entries and snapshot their totals.
+
+    Every unlocked entry of the month must be ``manager_approved``, so the
+    close completes the approval workflow instead of bypassing it.  All
+    databases are checked before any is written.  Each closes in its own
+    transaction, and databases already closed by an earlier, partly failed
+    call are skipped, so the call can simply be retried.  Returns the number
+    of employee x project aggregates written.  Raises ``ValueError`` for
+    malformed, unfinished or already closed months, and for months with
+    entries still awaiting approval.
+    """
+    first, last = _month_bounds(month)
+    if last >= date.today().isoformat():
+        raise ValueError(f'Month {month} has not ended yet')
+
+    def is_closed(cur):
+        cur.execute('SELECT 1 FROM closed_periods WHERE month_key = ?', (month,))
+        return cur.fetchone() is not None
+
+    def unapproved(cur):
+        cur.execute(
+            "SELECT COUNT(*) FROM timesheets WHERE status <> 'locked' "
+            "AND status <> 'manager_approved' AND month_key = ?",
+            (month,),
+        )
+        return cur.fetchone()[0]
+
+    def check(cur):
+        if is_closed(cur):
+            return True, 0
+        return False, unapproved(cur)
+
+    states = fan_out(check)
+    if all(closed for closed, _ in states):
+        raise ValueError(f'Month {month} is already closed')
+    pending = sum(count for _, count in states)
+    if pending:
+        raise ValueError(f'Month {month} has {pending} entries awaiting approval')
+
+    def close(cur):
+        if is_closed(cur):
+            return 0
+        # Entries may have been logged since the check; refuse them too.
+        pending = unapproved(cur)
+        if pending:
+            raise ValueError(f'Month {month} has {pending} entries awaiting approval')
+        cur.execute(
+            "UPDATE timesheets SET status = 'locked' "
+            "WHERE status <> 'locked' AND status = 'manager_approved' AND month_key = ?",
+            (month,),
+        )
+        cur.execute(
+            'INSERT INTO period_aggregates(month_key, employee_id, project_id, hours) '
+            f"SELECT month_key, employee_id, project_id, {hours_sql('SUM(hours)')} "
+            'FROM timesheets WHERE month_key = ? GROUP BY employee_id, project_id',
+            (month,),
+        )
+        count = cur.rowcount
+        cur.execute(
+            'INSERT INTO closed_periods(month_key, closed_at) VALUES (?, ?)',
+            (month, datetime.utcnow().isoformat(timespec='seconds')),
+        )
+        cur.connection.commit()
+        return count
+
+    return sum(fan_out(close))
+
+
+def close_period_cmd(args):
+    try:
+        count = close_period(args.month)
+    except ValueError as e:
+        print(e)
+        return
+    except sqlite3.Error as e:
+        print(f"Failed to close period: {e}")
+        sys.exit(1)
+    print(f'Closed {args.month} with {count} aggregates')
+
+
+# Periods that closed-month snapshots can serve, with the SQL deriving the
+# period key from a snapshot's month_key.
+SNAPSHOT_PERIODS = {
+    None: None,
+    'monthly': 'a.month_key',
+    'quarterly': "substr(a.month_key, 1, 4) || '-Q' || "
+                 "((CAST(substr(a.month_key, 6, 2) AS INTEGER) + 2) / 3)",
+}
+
+
+def _summary_query(cur, start, end, by, period, under=None):
+    """Return the summary query and parameters for one database and range."""
+    if by == 'project':
+        dim_col, name_table = 'project_id', 'projects'
+    else:
+        dim_col, name_table = 'employee_id', 'employees'
+    period_col = PERIOD_COLUMNS.get(period) if period else None
+    # The daily key is entry_date itself, already bounded by the range.
+    key_filter = period_col and period_col != 'entry_date'
+
+    months, ranges = [], [(start, end)]
+    if period in SNAPSHOT_PERIODS:
+        months, ranges = _split_closed(cur, start, end)
+    live_sql, params = _live_condition(ranges)
+    under_sql, under_params = _under_filter(under)
+    params.extend(under_params)
+
+    group_fields = [f't.{dim_col}']
+    if period_col:
+        group_fields.insert(0, f't.{period_col}')
+
+    inner = (
+        f"SELECT {', '.join(group_fields)}, {hours_sql('SUM(t.hours)')} AS hours "
+        f"FROM timesheets t WHERE {live_sql}{under_sql.format('t')}"
+    )
+    if key_filter and start:
+        inner += f' AND t.{period_col} >= ?'
+        params.append(period_key(period, start))
+    if key_filter and end:
+        inner += f' AND t.{period_col} <= ?'
+        params.append(period_key(period, end))
+    inner += ' GROUP BY ' + ', '.join(group_fields)
+
+    if months:
+        snap_fields = [f'a.{dim_col}']
+        if period_col:
+            snap_fields.insert(0, SNAPSHOT_PERIODS[period])
+        inner = (
+            f'{inner} UNION ALL '
+            f"SELECT {', '.join(snap_fields)}, SUM(a.hours) FROM period_aggregates a "
+            f"WHERE a.month_key IN {_placeholders(months)}{under_sql.format('a')} "
+            f"GROUP BY {', '.join(snap_fields)}"
+        )
+        params.extend(months)
+        params.extend(under_params)
+        keys = [f.split('.')[1] for f in group_fields]
+        inner = (
+            f"SELECT {', '.join(keys)}, SUM(hours) AS hours FROM ({inner}) "
+            f"GROUP BY {', '.join(keys)}"
+        )
+
+    if period_col:
+        label = date_sql('s.entry_date') if period_col == 'entry_date' else f's.{period_col}'
+        query = (
+            f'SELECT n.name, {label}, s.hours FROM ({inner}) s '
+            f'JOIN {name_table} n ON n.id = s.{dim_col} '
+            f'ORDER BY n.name, s.{period_col}'
+        )
+    else:
+        query = (
+            f'SELECT n.name, s.hours FROM ({inner}) s '
+            f'JOIN {name_table} n ON n.id = s.{dim_col} ORDER BY n.name'
+        )
+    return query, params
+
+
+def _summary_rows(cur, start, end, by, period, under=None):
+    """Return the summary rows of one database and date range."""
+    return cur.execute(*_summary_query(cur, start, end, by, period, under)).fetchall()
+
+
+def summary(args):
+    """Print aggregated hours grouped by project or employee.
+
+    Totals are aggregated by id and stored period key first, which lets
+    SQLite group in index order; names are joined onto the grouped rows.
+    Monthly, quarterly and overall totals read closed months from their
+    snapshots and only aggregate the open remainder of the range.  Rows
+    are streamed from each shard's cursor and merged in order; with
+    ``--jobs`` date partitions are summarised in parallel and their totals
+    merged.  ``--format`` other than ``text`` writes CSV, TSV or JSON lines
+    with a running total per project or employee.
+    """
+    jobs = getattr(args, 'jobs', 1)
+    under = getattr(args, 'under', None)
+    fmt = getattr(args, 'format', 'text')
+    try:
+        if jobs > 1:
+            rows = merge_sums(partitioned(_summary_rows, args.start, args.end, jobs,
+                                          args.by, args.period, under))
+        else:
+            rows = _sum_runs(stream_rows(_summary_query, args.start, args.end, args.by,
+                                         args.period, under, key=lambda row: row[:-1]))
+        if fmt != 'text':
+            fields = [args.by] + ([args.period] if args.period else [])
+            write_records(_running_totals(rows, group=True),
+                          fields + ['hours', 'running_total'], fmt)
+            return
+        empty = True
+        for row in rows:
+            *labels, hours = row
+            print(' | '.join(labels) + f' | {hours}h')
+            empty = False
     except sqlite3.Error as e:
-        print(f"Database initialization failed: {e}")
+        print(f"Failed to run summary: {e}")
         sys.exit(1)
+    if empty:
+        print('No entries found')
 
 
-def get_or_create(cursor, table, name):
-    """Return the id for the given name, inserting a new row if needed.
+def _distribution_rows(cur, start, end, employee):
+    query = (
+        f"SELECT p.name, {hours_sql('SUM(t.hours)')} FROM timesheets t "
+        'JOIN employees e ON e.id = t.employee_id '
+        'JOIN projects p ON p.id = t.project_id '
+        'WHERE e.name = ?'
+    )
+    params = [employee]
+    if start:
+        query += ' AND t.entry_date >= ?'
+        params.append(to_storage_date(start))
+    if end:
+        query += ' AND t.entry_date <= ?'
+        params.append(to_storage_date(end))
+    query += ' GROUP BY p.name ORDER BY p.name'
+    cur.execute(query, params)
+    return cur.fetchall()
 
-    The function returns a tuple ``(id, created)`` where ``created`` is
-    ``True`` when a new row was inserted and ``False`` when an existing
-    row was found.  This allows callers to distinguish between the two
-    cases without relying on catching an ``IntegrityError``.
+
+@cached_report(ttl=300)
+def employee_work_distribution(employee, start=None, end=None, jobs=1):
+    """Return list of (project, hours) tuples for the given employee."""
+    return merge_sums(partitioned(_distribution_rows, start, end, jobs, employee))
+
+
+def _top_employee_rows(cur, start, end, project, limit, under=None):
+    totals, params = totals_subquery(cur, 'employee_id', start, end, project, under)
+    query = (
+        f'SELECT e.name, SUM(s.hours) AS total FROM ({totals}) s '
+        'JOIN employees e ON e.id = s.employee_id '
+        'GROUP BY e.name ORDER BY total DESC LIMIT ?'
+    )
+    params.append(limit)
+    cur.execute(query, params)
+    return cur.fetchall()
+
+
+@cached_report(ttl=300)
+def top_employees(project=None, start=None, end=None, limit=10, jobs=1, under=None):
+    """Return top employees by hours for the given project.
+
+    ``under`` ranks only the org below that user id.  Employees never span
+    shards, so each shard's top ``limit`` suffices; date partitions split
+    employees and return all of their totals.
     """
+    partial_limit = limit if jobs <= 1 else -1
+    results = partitioned(_top_employee_rows, start, end, jobs, project, partial_limit,
+                          under)
+    return merge_sums(results, key=lambda row: -row[1])[:limit]
 
-    cursor.execute(f"SELECT id FROM {table} WHERE name = ?", (name,))
-    row = cursor.fetchone()
-    if row:
-        return row[0], False
-    cursor.execute(f"INSERT INTO {table}(name) VALUES(?)", (name,))
-    return cursor.lastrowid, True
 
+def _overworked_rows(cur, start, end, threshold, under=None):
+    under_sql, params = _under_filter(under)
+    query = (
+        'SELECT e.name, t.entry_date, SUM(t.hours) FROM timesheets t '
+        f"JOIN employees e ON e.id = t.employee_id WHERE 1=1{under_sql.format('t')}"
+    )
+    if start:
+        query += ' AND t.entry_date >= ?'
+        params.append(to_storage_date(start))
+    if end:
+        query += ' AND t.entry_date <= ?'
+        params.append(to_storage_date(end))
+    query += ' GROUP BY e.name, t.entry_date HAVING SUM(t.hours) > ?'
+    params.append(to_storage_hours(threshold))
+    cur.execute(query, params)
+    return cur.fetchall()
 
-def add_employee(args):
-    with connect_db() as conn:
-        cur = conn.cursor()
-        try:
-            _, created = get_or_create(cur, 'employees', args.name)
-            if created:
-                conn.commit()
-                print(f"Employee '{args.name}' added")
-            else:
-                print(f"Employee '{args.name}' already exists")
-        except sqlite3.Error as e:
-            print(f"Failed to add employee: {e}")
-            sys.exit(1)
 
+def _alert_rows(cur, start, end, under=None):
+    under_sql, params = _under_filter(under)
+    cur.execute(
+        'SELECT e.name, COUNT(*), MAX(a.streak), MAX(a.day_ordinal) '
+        'FROM overwork_alerts a JOIN employees e ON e.id = a.employee_id '
+        f"WHERE a.day_ordinal BETWEEN ? AND ?{under_sql.format('a')} GROUP BY e.name",
+        [_ordinal_bound(start, 0), _ordinal_bound(end, date.max.toordinal())] + params,
+    )
+    return cur.fetchall()
 
-def add_project(args):
-    with connect_db() as conn:
-        cur = conn.cursor()
-        try:
-            _, created = get_or_create(cur, 'projects', args.name)
-            if created:
-                conn.commit()
-                print(f"Project '{args.name}' added")
-            else:
-                print(f"Project '{args.name}' already exists")
-        except sqlite3.Error as e:
-            print(f"Failed to add project: {e}")
-            sys.exit(1)
 
+def overwork_alerts(start=None, end=None, min_days=1, under=None):
+    """Return ``(name, days, longest streak, last day)`` per alerted employee.
 
-def log_time(args):
-    # Validate hours value
-    if args.hours <= 0 or args.hours > 24:
-        print('Hours must be greater than 0 and no more than 24.')
+    Reads the alerts raised by the write triggers, so the cost depends on
+    the number of alerts in range rather than on the number of entries.
+    Employees with fewer than ``min_days`` alert days are left out.
+    """
+    merged = {}
+    for rows in fan_out(_alert_rows, start, end, under):
+        for name, count, streak, last in rows:
+            if name in merged:
+                count += merged[name][0]
+                streak = max(streak, merged[name][1])
+                last = max(last, merged[name][2])
+            merged[name] = (count, streak, last)
+    return sorted(
+        ((name, count, streak, date.fromordinal(last).isoformat())
+         for name, (count, streak, last) in merged.items() if count >= min_days),
+        key=lambda row: (-row[1], row[0]),
+    )
+
+
+def show_alerts(args):
+    """Print the current overwork alerts."""
+    rows = overwork_alerts(args.start, args.end, args.days, args.under)
+    if not rows:
+        print('No overwork alerts')
         return
-    if args.hours * 2 != int(args.hours * 2):
-        print('Hours must be in 0.5 hour increments.')
+    for name, count, streak, last in rows:
+        print(f'{name} | {count} days over {OVERWORK_THRESHOLD}h | '
+              f'longest streak {streak} | last {last}')
+
+
+def _require_numpy():
+    """Import numpy, which only the utilization matrix needs."""
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError(
+            'The utilization matrix needs numpy: pip install numpy'
+        ) from None
+    return numpy
+
+
+def _utilization_rows(cur, start, end, period):
+    column = PERIOD_COLUMNS[period]
+    # The daily key is entry_date itself, already bounded by the range; under
+    # compact storage it is an ordinal and is rendered as an ISO date.
+    key_filter = column != 'entry_date'
+    key_sql = f't.{column}' if key_filter else date_sql('t.entry_date')
+    # Grouping by period key first lets the covering period index drive the
+    # scan; names are looked up once per group afterwards.
+    inner = f"SELECT {key_sql} AS key, t.employee_id, {hours_sql('SUM(t.hours)')} AS hours " \
+            'FROM timesheets t WHERE 1=1'
+    params = []
+    if start:
+        inner += ' AND t.entry_date >= ?'
+        params.append(to_storage_date(start))
+        if key_filter:
+            inner += f' AND t.{column} >= ?'
+            params.append(period_key(period, start))
+    if end:
+        inner += ' AND t.entry_date <= ?'
+        params.append(to_storage_date(end))
+        if key_filter:
+            inner += f' AND t.{column} <= ?'
+            params.append(period_key(period, end))
+    cur.execute(
+        f'SELECT e.name, g.key, g.hours FROM ({inner} GROUP BY t.{column}, t.employee_id) g '
+        'JOIN employees e ON e.id = g.employee_id',
+        params,
+    )
+    return cur.fetchall()
+
+
+@cached_report(ttl=600)
+def _utilization_hours(start, end, period, capacity):
+    np = _require_numpy()
+    if period not in PERIOD_COLUMNS:
+        raise ValueError(f'Unknown period: {period}')
+    lo, hi = _entry_date_bounds()
+    first = datetime.strptime(start or lo or date.today().isoformat(), '%Y-%m-%d').date()
+    last = datetime.strptime(end or hi or date.today().isoformat(), '%Y-%m-%d').date()
+    workdays = {}
+    for ordinal in range(first.toordinal(), last.toordinal() + 1):
+        day = date.fromordinal(ordinal)
+        key = period_key(period, day)
+        workdays[key] = workdays.get(key, 0) + (day.weekday() < 5)
+    periods = np.array(list(workdays), dtype=str)
+    available = np.array(list(workdays.values()), dtype=float) * capacity
+
+    rows = [row for rows in fan_out(_utilization_rows, start, end, period) for row in rows]
+    names = np.array([row[0] for row in rows], dtype=str)
+    employees, row_index = np.unique(names, return_inverse=True)
+    column_index = np.searchsorted(periods, np.array([row[1] for row in rows], dtype=str))
+    hours = np.zeros((len(employees), len(periods)))
+    # Rows of one employee and period from several shards are summed.
+    np.add.at(hours, (row_index, column_index),
+              np.array([row[2] for row in rows], dtype=float))
+    for array in (hours, available):
+        array.flags.writeable = False
+    return tuple(employees.tolist()), tuple(periods.tolist()), hours, available
+
+
+def utilization_matrix(start=None, end=None, period='isoweekly', capacity=8.0):
+    """Return hours and utilization per employee and period as NumPy arrays.
+
+    The result is ``(employees, periods, hours, available, utilization)``:
+    employee names in order, period keys in order, the employees × periods
+    matrix of hours, the hours available in each period (``capacity`` per
+    workday from Monday to Friday within the range) and hours divided by
+    availability. Open ends of the range stop at the oldest and newest
+    entry. One grouped query per database feeds a NumPy pivot. The hours
+    are cached per range, period and capacity and are read-only; only the
+    ratios are recomputed on each call.
+
+    Raises ValueError for an unknown period or a malformed date and
+    RuntimeError when numpy is not installed.
+    """
+    np = _require_numpy()
+    employees, periods, hours, available = _utilization_hours(start, end, period, capacity)
+    utilization = np.divide(hours, available, out=np.zeros_like(hours),
+                            where=available > 0)
+    return employees, periods, hours, available, utilization
+
+
+def utilization_csv(matrix, values='utilization'):
+    """Yield CSV lines of a :func:`utilization_matrix` result.
+
+    The header names the periods and each row starts with the employee;
+    ``values`` selects ``utilization`` ratios or ``hours``.
+    """
+    import csv
+    import io
+    np = _require_numpy()
+    employees, periods, hours, _, utilization = matrix
+    data = utilization if values == 'utilization' else hours
+    cells = np.char.mod('%.3f' if values == 'utilization' else '%g', data)
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(['employee', *periods])
+    for name, row in zip(employees, cells):
+        writer.writerow([name, *row.tolist()])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    if not employees:
+        yield buf.getvalue()
+
+
+def utilization_npy(matrix, fh, values='utilization'):
+    """Save the ``values`` matrix of a :func:`utilization_matrix` result as NPY.
+
+    Rows and columns follow the employee and period order of the CSV.
+    """
+    data = matrix[4] if values == 'utilization' else matrix[2]
+    _require_numpy().save(fh, data)
+    return data.shape
+
+
+def utilization_cmd(args):
+    """Write the utilization matrix as CSV or as a NumPy ``.npy`` file."""
+    try:
+        matrix = utilization_matrix(args.start, args.end, args.period, args.capacity)
+    except RuntimeError as e:
+        print(e)
+        sys.exit(1)
+    except ValueError:
+        print('Dates must be in YYYY-MM-DD format')
+        sys.exit(1)
+    if args.format == 'npy':
+        if not args.output:
+            print('--format npy needs --output FILE')
+            sys.exit(1)
+        with open(args.output, 'wb') as fh:
+            rows, columns = utilization_npy(matrix, fh, args.values)
+        print(f'Saved a {rows} x {columns} matrix to {args.output}')
         return
+    if args.output:
+        with open(args.output, 'w', newline='') as fh:
+            fh.writelines(utilization_csv(matrix, args.values))
+    else:
+        sys.stdout.writelines(utilization_csv(matrix, args.values))
 
-    # Validate date format and ensure it's not in the future
+
+def _missing_rows(cur, first_day, last_day, min_hours, department, under):
+    params = [first_day, last_day, min_hours]
+    query = (
+        'WITH RECURSIVE days(d) AS (SELECT ? UNION ALL SELECT d + 1 FROM days WHERE d < ?) '
+        'SELECT u.full_name, days.d FROM users u '
+        'CROSS JOIN days '
+        'LEFT JOIN employees e ON e.name = u.full_name '
+        "WHERE u.status = 'Active' AND days.d % 7 NOT IN (0, 6) "
+        "AND (COALESCE(u.date_of_joining, '') = '' "
+        f'OR u.date_of_joining <= date(days.d + {_ORDINAL_EPOCH})) '
+        'AND NOT EXISTS (SELECT 1 FROM daily_totals t WHERE t.employee_id = e.id '
+        'AND t.day_ordinal = days.d AND t.hours >= ?)'
+    )
+    if department:
+        query += ' AND u.department = ?'
+        params.append(department)
+    if under is not None:
+        query += (' AND u.id IN (SELECT descendant FROM user_hierarchy '
+                  'WHERE ancestor = ? AND depth > 0)')
+        params.append(under)
+    cur.execute(query + ' ORDER BY u.full_name, days.d', params)
+    return cur.fetchall()
+
+
+def missing_timesheets(start=None, end=None, min_hours=0, department=None, under=None):
+    """Return ``(user, ISO date)`` pairs of workdays without enough hours.
+
+    Every Monday to Friday from ``start`` (default: this week's Monday) to
+    ``end`` (default: today) is paired with each active user and anti-joined
+    against ``daily_totals`` in one query per database. A day counts as
+    logged once the user's hours reach ``min_hours``. Raises ValueError for
+    malformed dates.
+    """
+    today = date.today()
+    first = (datetime.strptime(start, '%Y-%m-%d').date() if start
+             else today - timedelta(days=today.weekday()))
+    last = datetime.strptime(end, '%Y-%m-%d').date() if end else today
+    results = fan_out(_missing_rows, first.toordinal(), last.toordinal(),
+                      min_hours, department, under)
+    # Each user's entries live in one shard, so a pair is missing overall
+    # only if every shard reports it missing.
+    rows = results[0] if len(results) == 1 else sorted(set(results[0]).intersection(*results[1:]))
+    return [(name, date.fromordinal(day).isoformat()) for name, day in rows]
+
+
+def compliance_report(args):
+    """Print the workdays each active user has not logged time for."""
     try:
-        entry_date = datetime.strptime(args.date, '%Y-%m-%d').date()
+        rows = missing_timesheets(args.start, args.end, args.min_hours,
+                                  args.department, args.under)
     except ValueError:
-        print('Date must be in YYYY-MM-DD format.')
+        print('Dates must be in YYYY-MM-DD format')
+        sys.exit(1)
+    if not rows:
+        print('No missing timesheets')
         return
-    if entry_date > date.today():
-        print('Date cannot be in the future.')
+    missing = {}
+    for name, day in rows:
+        missing.setdefault(name, []).append(day)
+    for name, days in missing.items():
+        print(f"{name} | {len(days)} missing | {', '.join(days)}")
+
+
+@cached_report(ttl=600)
+def overworked_employees(start=None, end=None, threshold=OVERWORK_THRESHOLD,
+                         days=OVERWORK_DAYS, jobs=1, under=None):
+    """Return list of employees with at least ``days`` entries over threshold.
+
+    ``under`` limits the check to the org below that user id. The default
+    threshold is answered from ``overwork_alerts``; other thresholds scan
+    the entries in range.
+    """
+    if threshold == OVERWORK_THRESHOLD:
+        # overwork_alerts ranks by alert count; this list is ordered by name.
+        return sorted(row[0] for row in overwork_alerts(start, end, days, under))
+    results = partitioned(_overworked_rows, start, end, jobs, threshold, under)
+    counts = {}
+    for name, _date, _hours in (row for rows in results for row in rows):
+        counts[name] = counts.get(name, 0) + 1
+    return [name for name, cnt in counts.items() if cnt >= days]
+
+
+def migrate_storage(args):
+    """Convert the timesheets table to the ``text`` or ``compact`` format."""
+    global COMPACT_STORAGE
+    compact = args.format == 'compact'
+    paths = [DB_FILE] + SHARDS
+    pending = []
+    for path in paths:
+        with connect_db(path) as conn:
+            if _is_compact(conn.cursor()) != compact:
+                pending.append(path)
+    if not pending:
+        print(f'Timesheets already use the {args.format} format')
         return
+    for path in pending:
+        with connect_db(path) as conn:
+            try:
+                _rebuild_timesheets(conn.cursor(), compact)
+                conn.commit()
+            except sqlite3.Error as e:
+                print(f"Failed to migrate storage: {e}")
+                sys.exit(1)
+    COMPACT_STORAGE = compact
+    print(f'Timesheets converted to the {args.format} format')
 
-    remarks = getattr(args, 'remarks', None)
 
-    with connect_db() as conn:
-        cur = conn.cursor()
-        emp_id, _ = get_or_create(cur, 'employees', args.employee)
-        proj_id, _ = get_or_create(cur, 'projects', args.project)
-        try:
-            cur.execute(
-                'INSERT INTO timesheets(employee_id, project_id, entry_date, hours, remarks) '
-                'VALUES (?, ?, ?, ?, ?)',
-                (emp_id, proj_id, entry_date.isoformat(), args.hours, remarks)
-            )
-            conn.commit()
-            print('Time entry recorded')
-        except sqlite3.Error as e:
-            print(f"Failed to log time: {e}")
-            sys.exit(1)
+class _BackupRestarted(Exception):
+    pass
 
 
-def report(args):
-    with connect_db() as conn:
-        cur = conn.cursor()
-        summary = getattr(args, 'summary', None)
-        params = [args.project]
-        if summary == 'employee':
-            query = '''SELECT e.name, SUM(t.hours)
-                       FROM timesheets t
-                       JOIN employees e ON e.id = t.employee_id
-                       JOIN projects p ON p.id = t.project_id
-                       WHERE p.name = ?'''
-        elif summary == 'date':
-            query = '''SELECT t.entry_date, SUM(t.hours)
-                       FROM timesheets t
-                       JOIN employees e ON e.id = t.employee_id
-                       JOIN projects p ON p.id = t.project_id
-                       WHERE p.name = ?'''
-        else:
-            query = '''SELECT p.name, e.name, t.entry_date, t.hours
-                       FROM timesheets t
-                       JOIN employees e ON e.id = t.employee_id
-                       JOIN projects p ON p.id = t.project_id
-                       WHERE p.name = ?'''
-        if args.start:
-            query += ' AND t.entry_date >= ?'
-            params.append(args.start)
-        if args.end:
-            query += ' AND t.entry_date <= ?'
-            params.append(args.end)
-        if summary == 'employee':
-            query += ' GROUP BY e.name ORDER BY e.name'
-        elif summary == 'date':
-            query += ' GROUP BY t.entry_date ORDER BY t.entry_date'
-        else:
-            query += ' ORDER BY t.entry_date, e.name'
+def backup_database(path, dest, pages=MAINTAIN_PAGES, pause=MAINTAIN_PAUSE):
+    """Copy the live database ``path`` to ``dest`` with the backup API.
+
+    ``pages`` pages are copied per step and the source is only read-locked
+    during a step, so writers carry on during the ``pause`` between steps.
+    A write from another connection restarts the copy; after
+    ``BACKUP_RESTARTS`` restarts the rest is copied in a single step.  The
+    copy is written beside ``dest`` and renamed over it once complete.
+    """
+    restarts, last = 0, None
+
+    def progress(status, remaining, total):
+        nonlocal restarts, last
+        if last is not None and remaining > last:
+            restarts += 1
+            if restarts > BACKUP_RESTARTS:
+                raise _BackupRestarted
+        last = remaining
+        if remaining:
+            time.sleep(pause)
+
+    partial = dest + '.part'
+    source = sqlite3.connect(_read_only_uri(path), uri=True)
+    target = sqlite3.connect(partial)
+    try:
         try:
-            cur.execute(query, params)
-            rows = cur.fetchall()
-        except sqlite3.Error as e:
-            print(f"Failed to run report: {e}")
-            sys.exit(1)
-        if not rows:
-            print('No entries found')
-            return
-        total = 0
-        if summary == 'employee':
-            for employee, hours in rows:
-                print(f"{employee} | {hours}h")
-                total += hours
-        elif summary == 'date':
-            for entry_date, hours in rows:
-                print(f"{entry_date} | {hours}h")
-                total += hours
-        else:
-            for project, employee, entry_date, hours in rows:
-                print(f"{entry_date} | {employee} | {hours}h")
-                total += hours
-        print(f"Total hours for {args.project}: {total}")
+            source.backup(target, pages=pages, progress=progress)
+        except _BackupRestarted:
+            source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    os.replace(partial, dest)
 
 
-def _find_entry(cur, entry_id=None, employee=None, project=None, entry_date=None):
-    """Return the id of the entry matching the given criteria."""
-    if entry_id:
-        cur.execute('SELECT id FROM timesheets WHERE id = ?', (entry_id,))
-        row = cur.fetchone()
-        return row[0] if row else None
-    if employee and project and entry_date:
-        cur.execute(
-            '''SELECT t.id FROM timesheets t
-               JOIN employees e ON e.id = t.employee_id
-               JOIN projects p ON p.id = t.project_id
-               WHERE e.name = ? AND p.name = ? AND t.entry_date = ?''',
-            (employee, project, entry_date),
-        )
-        row = cur.fetchone()
-        return row[0] if row else None
-    return None
+def load_database(source, path=None):
+    """Replace database ``path`` (``DB_FILE`` by default) with ``source``.
 
+    Either may be a file or an in-memory database; pages are copied with
+    the backup API.
+    """
+    source_conn = sqlite3.connect(_read_only_uri(source), uri=True)
+    target = _open(path or DB_FILE)
+    try:
+        source_conn.backup(target)
+    finally:
+        target.close()
+        source_conn.close()
+    _reset_caches()
 
-def update_time(args):
-    with connect_db() as conn:
-        cur = conn.cursor()
-        entry_id = _find_entry(
-            cur, args.id, args.employee, args.project, args.entry_date
-        )
-        if not entry_id:
-            print('Entry not found')
-            return
-        updates = []
-        params = []
-        if args.new_hours is not None:
-            updates.append('hours = ?')
-            params.append(args.new_hours)
-        if args.new_date:
-            updates.append('entry_date = ?')
-            params.append(args.new_date)
-        if not updates:
-            print('No updates specified')
-            return
-        params.append(entry_id)
-        cur.execute(
-            f'UPDATE timesheets SET {", ".join(updates)} WHERE id = ?', params
-        )
-        conn.commit()
-        print(f'Entry {entry_id} updated')
 
+def snapshot_database(dest, path=None):
+    """Write database ``path`` (``DB_FILE`` by default) to the file ``dest``."""
+    backup_database(path or DB_FILE, dest, pause=0)
 
-def delete_time(args):
-    with connect_db() as conn:
-        cur = conn.cursor()
-        entry_id = _find_entry(
-            cur, args.id, args.employee, args.project, args.entry_date
-        )
-        if not entry_id:
-            print('Entry not found')
-            return
-        cur.execute('DELETE FROM timesheets WHERE id = ?', (entry_id,))
-        conn.commit()
-        print(f'Entry {entry_id} deleted')
 
+def init_cmd(args):
+    # main() has already run init_db for the selected files.
+    print(f"Database {', '.join([DB_FILE] + SHARDS)} is ready")
 
-def summary(args):
-    """Print aggregated hours grouped by project or employee."""
-    with connect_db() as conn:
-        cur = conn.cursor()
 
-        group_fields = []
-        selects = []
+def snapshot_cmd(args):
+    try:
+        snapshot_database(args.file)
+    except sqlite3.Error as e:
+        print(f"Failed to write snapshot: {e}")
+        sys.exit(1)
+    print(f'Database written to {args.file}')
 
-        if args.by == 'project':
-            group_fields.append('p.name')
-            selects.append('p.name')
-        else:
-            group_fields.append('e.name')
-            selects.append('e.name')
-
-        if args.period == 'daily':
-            group_fields.append('t.entry_date')
-            selects.append('t.entry_date')
-        elif args.period == 'weekly':
-            group_fields.append("strftime('%Y-%W', t.entry_date)")
-            selects.append("strftime('%Y-%W', t.entry_date)")
-        elif args.period == 'monthly':
-            group_fields.append("strftime('%Y-%m', t.entry_date)")
-            selects.append("strftime('%Y-%m', t.entry_date)")
-
-        query = f"SELECT {', '.join(selects)}, SUM(t.hours) "
-        query += "FROM timesheets t JOIN employees e ON e.id = t.employee_id "
-        query += "JOIN projects p ON p.id = t.project_id WHERE 1=1"
 
-        params = []
-        if args.start:
-            query += ' AND t.entry_date >= ?'
-            params.append(args.start)
-        if args.end:
-            query += ' AND t.entry_date <= ?'
-            params.append(args.end)
+def _database_size(cur):
+    cur.execute('PRAGMA page_count')
+    pages = cur.fetchone()[0]
+    cur.execute('PRAGMA page_size')
+    return pages * cur.fetchone()[0]
 
-        if group_fields:
-            query += ' GROUP BY ' + ', '.join(group_fields)
-            query += ' ORDER BY ' + ', '.join(group_fields)
 
-        try:
-            cur.execute(query, params)
-            rows = cur.fetchall()
-        except sqlite3.Error as e:
-            print(f"Failed to run summary: {e}")
-            sys.exit(1)
+def _format_size(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f'{size:.0f} {unit}' if unit == 'B' else f'{size:.1f} {unit}'
+        size /= 1024
 
-        if not rows:
-            print('No entries found')
-            return
 
-        for row in rows:
-            *labels, hours = row
-            print(' | '.join(labels) + f' | {hours}h')
+def _analyze(cur, limit=ANALYSIS_LIMIT):
+    cur.execute(f'PRAGMA analysis_limit = {int(limit)}')
+    cur.execute('ANALYZE')
+    cur.execute('PRAGMA optimize')
 
 
-def employee_work_distribution(employee, start=None, end=None):
-    """Return list of (project, hours) tuples for the given employee."""
-    with connect_db() as conn:
-        cur = conn.cursor()
-        query = (
-            'SELECT p.name, SUM(t.hours) FROM timesheets t '
-            'JOIN employees e ON e.id = t.employee_id '
-            'JOIN projects p ON p.id = t.project_id '
-            'WHERE e.name = ?'
-        )
-        params = [employee]
-        if start:
-            query += ' AND t.entry_date >= ?'
-            params.append(start)
-        if end:
-            query += ' AND t.entry_date <= ?'
-            params.append(end)
-        query += ' GROUP BY p.name ORDER BY p.name'
-        cur.execute(query, params)
-        return cur.fetchall()
+def analyze_databases(limit=ANALYSIS_LIMIT):
+    """Refresh the planner statistics of every database.
 
+    ANALYZE samples up to ``limit`` rows per index, so it stays quick on a
+    live database.
+    """
+    for path in [DB_FILE] + SHARDS:
+        with connect_db(path) as conn:
+            cur = conn.cursor()
+            current = _schema_current(cur)
+            _analyze(cur, limit)
+            conn.commit()
+            # The first ANALYZE creates sqlite_stat1 and so moves the cookie.
+            if current and not _schema_current(cur):
+                _stamp_schema(cur)
 
-def top_employees(project=None, start=None, end=None, limit=10):
-    """Return top employees by hours for the given project."""
-    with connect_db() as conn:
-        cur = conn.cursor()
-        query = (
-            'SELECT e.name, SUM(t.hours) as total FROM timesheets t '
-            'JOIN employees e ON e.id = t.employee_id '
-            'JOIN projects p ON p.id = t.project_id WHERE 1=1'
-        )
-        params = []
-        if project:
-            query += ' AND p.name = ?'
-            params.append(project)
-        if start:
-            query += ' AND t.entry_date >= ?'
-            params.append(start)
-        if end:
-            query += ' AND t.entry_date <= ?'
-            params.append(end)
-        query += ' GROUP BY e.name ORDER BY total DESC LIMIT ?'
-        params.append(limit)
-        cur.execute(query, params)
-        return cur.fetchall()
 
+def _vacuum_step(cur, pages, pause, full):
+    """Free unused pages of one database and return a description."""
+    cur.execute('PRAGMA freelist_count')
+    free = cur.fetchone()[0]
+    cur.execute('PRAGMA auto_vacuum')
+    if full:
+        before = _database_size(cur)
+        cur.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        cur.execute('VACUUM')
+        return f'rebuilt, was {_format_size(before)}'
+    if cur.fetchone()[0] != 2:
+        return f'skipped, {free} free pages (auto_vacuum is off; run --full-vacuum once)'
+    left = free
+    while left:
+        # executescript steps the pragma to completion; execute() frees one page.
+        cur.executescript(f'PRAGMA incremental_vacuum({pages})')
+        cur.execute('PRAGMA freelist_count')
+        left = cur.fetchone()[0]
+        if left:
+            time.sleep(pause)
+    return f'freed {free} pages'
 
-def overworked_employees(start=None, end=None, threshold=9, days=3):
-    """Return list of employees with at least ``days`` entries over threshold."""
-    with connect_db() as conn:
-        cur = conn.cursor()
-        query = (
-            'SELECT e.name, t.entry_date, SUM(t.hours) FROM timesheets t '
-            'JOIN employees e ON e.id = t.employee_id WHERE 1=1'
-        )
-        params = []
-        if start:
-            query += ' AND t.entry_date >= ?'
-            params.append(start)
-        if end:
-            query += ' AND t.entry_date <= ?'
-            params.append(end)
-        query += ' GROUP BY e.name, t.entry_date HAVING SUM(t.hours) > ?'
-        params.append(threshold)
-        cur.execute(query, params)
-        rows = cur.fetchall()
 
-    counts = {}
-    for name, _date, _hours in rows:
-        counts[name] = counts.get(name, 0) + 1
-    return [name for name, cnt in counts.items() if cnt >= days]
+def maintain(args):
+    """Back up, analyze, vacuum and check every database while it is in use.
+
+    Each step commits on its own and the backup and incremental vacuum are
+    done ``--pages`` at a time with ``--sleep`` between steps, so writers
+    are only held up briefly.  With ``--backup`` the integrity check reads
+    the fresh copy instead of the live file.  Exits with status 1 if a
+    check fails.
+    """
+    pages = args.pages
+    pause = args.sleep
+    if args.backup:
+        os.makedirs(args.backup, exist_ok=True)
+    failed = False
+    for path in [DB_FILE] + SHARDS:
+        with connect_db(path) as conn:
+            cur = conn.cursor()
+            # ANALYZE creates sqlite_stat1 and VACUUM rewrites the schema
+            # cookie; restamp so the next start keeps the fast path.
+            current = _schema_current(cur)
+            steps = []
+            if args.backup:
+                steps.append('backup')
+            if not args.no_analyze:
+                steps.append('analyze')
+            if not args.no_vacuum:
+                steps.append('vacuum')
+            if not args.no_check:
+                steps.append('check')
+            checked = path
+            for step in steps:
+                started = time.perf_counter()
+                try:
+                    if step == 'backup':
+                        checked = os.path.join(args.backup, os.path.basename(path))
+                        backup_database(path, checked, pages, pause)
+                        note = f'-> {checked}'
+                        size = os.path.getsize(checked)
+                    elif step == 'analyze':
+                        _analyze(cur, args.analysis_limit)
+                        conn.commit()
+                        note = ''
+                        size = _database_size(cur)
+                    elif step == 'vacuum':
+                        note = _vacuum_step(cur, pages, pause, args.full_vacuum)
+                        size = _database_size(cur)
+                    else:
+                        with sqlite3.connect(_read_only_uri(checked), uri=True) as check:
+                            problems = [row[0] for row in check.execute('PRAGMA quick_check')]
+                        failed = failed or problems != ['ok']
+                        note = f"{checked}: {'; '.join(problems)}"
+                        size = _database_size(cur) if checked == path else os.path.getsize(checked)
+                except sqlite3.Error as e:
+                    print(f"Failed to {step} {path}: {e}")
+                    sys.exit(1)
+                elapsed = time.perf_counter() - started
+                print(f'{step:8} {path}  {elapsed:7.3f}s  {_format_size(size):>9}  '
+                      f'{note}'.rstrip())
+            if current and not _schema_current(cur):
+                _stamp_schema(cur)
+    if failed:
+        sys.exit(1)
+
+
+def run_batch(args):
+    """Run commands read one per line from ``args.file`` in this process.
+
+    Each line holds the arguments of one subcommand, shell quoted or as a
+    JSON array; global options apply to the whole batch.  Commands share
+    one connection and are committed ``args.group`` at a time, each inside
+    a savepoint so a failing command is rolled back on its own.  Timesheet
+    writes routed to shards commit per command.
+    """
+    global _BATCH_CONNECTION
+    import json
+    import shlex
+
+    parser = build_parser()
+    stream = sys.stdin if args.file == '-' else open(args.file)
+    conn = _open(DB_FILE, factory=_BatchConnection, isolation_level=None)
+    _BATCH_CONNECTION = conn
+    count = failed = pending = 0
+    started = time.perf_counter()
+    try:
+        for line in stream:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            if not pending:
+                conn.execute('BEGIN')
+            conn.execute('SAVEPOINT batch_command')
+            try:
+                argv = json.loads(line) if line.startswith('[') else shlex.split(line)
+                command = parser.parse_args(argv)
+                if getattr(command, 'func', run_batch) in (run_batch, maintain, snapshot_cmd):
+                    # These read the database through their own connections,
+                    # which would not see the batch's uncommitted work.
+                    raise ValueError('expected a command other than batch, maintain '
+                                     'or snapshot')
+                command.func(command)
+                ok = True
+            except SystemExit as e:
+                ok = e.code in (None, 0)
+            except (ValueError, sqlite3.Error) as e:
+                print(f'Invalid batch line {line!r}: {e}', file=sys.stderr)
+                ok = False
+            if not ok:
+                conn.execute('ROLLBACK TO batch_command')
+                failed += 1
+            conn.execute('RELEASE batch_command')
+            count += 1
+            pending += 1
+            if pending >= args.group:
+                conn.execute('COMMIT')
+                pending = 0
+        if pending:
+            conn.execute('COMMIT')
+    finally:
+        _BATCH_CONNECTION = None
+        sqlite3.Connection.close(conn)
+        if stream is not sys.stdin:
+            stream.close()
+    elapsed = time.perf_counter() - started
+    per_command = elapsed / count * 1000 if count else 0
+    print(f'{count} commands, {failed} failed in {elapsed:.2f}s '
+          f'({per_command:.2f} ms per command)', file=sys.stderr)
+    if failed:
+        sys.exit(1)
+
 
+def build_parser():
+    # Imported here so the web app, which never parses arguments, skips it.
+    import argparse
 
-def parse_args():
     parser = argparse.ArgumentParser(description='Simple timesheet tool')
     parser.add_argument('--db', default=DB_FILE,
-                        help='Path to the SQLite database file')
+                        help='Path to the SQLite database file, or :memory: for an '
+                             'in-memory database')
+    parser.add_argument('--shards', default=','.join(SHARDS),
+                        help='Comma separated timesheet shard database files')
+    parser.add_argument('--shard-by', choices=['department', 'hash'], default=SHARD_BY,
+                        help='Route employees to shards by department or hashed id')
     sub = parser.add_subparsers(dest='cmd')
 
     sub_add_emp = sub.add_parser('add-employee', help='Add a new employee')
@@ -476,36 +3125,67 @@ def parse_args():
     sub_rep.add_argument('--end')
     sub_rep.add_argument('--summary', choices=['employee', 'date'],
                          help='Show totals grouped by employee or date')
+    sub_rep.add_argument('--format', choices=OUTPUT_FORMATS, default='text',
+                         help='Write rows as text, csv, tsv or jsonl')
     sub_rep.set_defaults(func=report)
 
     sub_sum = sub.add_parser('summary', help='Show aggregated hours')
     sub_sum.add_argument('--by', choices=['project', 'employee'], default='project',
                          help='Group totals by project or employee')
-    sub_sum.add_argument('--period', choices=['daily', 'weekly', 'monthly'],
+    sub_sum.add_argument('--period', choices=list(PERIOD_COLUMNS),
                          help='Break down results by time period')
     sub_sum.add_argument('--start')
     sub_sum.add_argument('--end')
+    sub_sum.add_argument('--format', choices=OUTPUT_FORMATS, default='text',
+                         help='Write rows as text, csv, tsv or jsonl')
     sub_sum.set_defaults(func=summary)
 
     sub_dist = sub.add_parser('emp-distribution', help='Employee work distribution')
     sub_dist.add_argument('employee')
     sub_dist.add_argument('--start')
     sub_dist.add_argument('--end')
-    sub_dist.set_defaults(func=lambda a: print('\n'.join(f"{p} | {h}h" for p, h in employee_work_distribution(a.employee, a.start, a.end))))
+    sub_dist.set_defaults(func=lambda a: print('\n'.join(f"{p} | {h}h" for p, h in employee_work_distribution(a.employee, a.start, a.end, a.jobs))))
 
     sub_top = sub.add_parser('top-employees', help='Top employees by hours')
     sub_top.add_argument('--project')
     sub_top.add_argument('--start')
     sub_top.add_argument('--end')
     sub_top.add_argument('--limit', type=int, default=10)
-    sub_top.set_defaults(func=lambda a: print('\n'.join(f"{n} | {h}h" for n, h in top_employees(a.project, a.start, a.end, a.limit))))
+    sub_top.set_defaults(func=lambda a: print('\n'.join(f"{n} | {h}h" for n, h in top_employees(a.project, a.start, a.end, a.limit, a.jobs, a.under))))
 
     sub_over = sub.add_parser('overworked', help='List employees consistently over threshold hours/day')
     sub_over.add_argument('--start')
     sub_over.add_argument('--end')
-    sub_over.add_argument('--threshold', type=float, default=9)
-    sub_over.add_argument('--days', type=int, default=3)
-    sub_over.set_defaults(func=lambda a: print('\n'.join(overworked_employees(a.start, a.end, a.threshold, a.days))))
+    sub_over.add_argument('--threshold', type=float, default=OVERWORK_THRESHOLD)
+    sub_over.add_argument('--days', type=int, default=OVERWORK_DAYS)
+    sub_over.set_defaults(func=lambda a: print('\n'.join(overworked_employees(a.start, a.end, a.threshold, a.days, a.jobs, a.under))))
+
+    sub_alerts = sub.add_parser('alerts', help='List employees with days over the overwork threshold')
+    sub_alerts.add_argument('--start')
+    sub_alerts.add_argument('--end')
+    sub_alerts.add_argument('--days', type=int, default=1,
+                            help='Only employees with at least this many alert days')
+    sub_alerts.set_defaults(func=show_alerts)
+
+    sub_util = sub.add_parser('utilization',
+                              help='Employee x period matrix of hours against capacity')
+    sub_util.add_argument('--start')
+    sub_util.add_argument('--end')
+    sub_util.add_argument('--period', choices=list(PERIOD_COLUMNS), default='isoweekly')
+    sub_util.add_argument('--capacity', type=float, default=8.0,
+                          help='Available hours per workday (default 8)')
+    sub_util.add_argument('--values', choices=['utilization', 'hours'], default='utilization')
+    sub_util.add_argument('--format', choices=['csv', 'npy'], default='csv')
+    sub_util.add_argument('--output', help='File to write (default: stdout for CSV)')
+    sub_util.set_defaults(func=utilization_cmd)
+
+    sub_comp = sub.add_parser('compliance', help='List workdays users have not logged time for')
+    sub_comp.add_argument('--start', help="First day (default: this week's Monday)")
+    sub_comp.add_argument('--end', help='Last day (default: today)')
+    sub_comp.add_argument('--min-hours', type=float, default=0,
+                          help='Hours a day needs to count as logged')
+    sub_comp.add_argument('--department')
+    sub_comp.set_defaults(func=compliance_report)
 
     sub_upd = sub.add_parser('update', help='Update a time entry')
     sub_upd.add_argument('--id', type=int, help='Entry ID')
@@ -523,11 +3203,114 @@ def parse_args():
     sub_del.add_argument('--entry-date', help='Entry date')
     sub_del.set_defaults(func=delete_time)
 
-    return parser.parse_args()
+    for action, help_text in (
+        ('submit', 'Submit draft entries for approval'),
+        ('approve', 'Approve submitted entries for a team'),
+        ('lock', 'Lock approved entries for payroll'),
+    ):
+        sub_tr = sub.add_parser(action, help=help_text)
+        sub_tr.add_argument('--manager', type=int,
+                            help='User id of the manager whose direct reports to include')
+        sub_tr.add_argument('--department', help='Limit to users in this department')
+        sub_tr.add_argument('--start')
+        sub_tr.add_argument('--end')
+        sub_tr.set_defaults(func=bulk_transition, action=action)
+
+    for action, help_text in (
+        ('update', 'Update every entry matching the filters'),
+        ('delete', 'Delete every entry matching the filters'),
+    ):
+        sub_bulk = sub.add_parser(f'bulk-{action}', help=help_text)
+        sub_bulk.add_argument('--employee', help='Employee name')
+        sub_bulk.add_argument('--project', help='Project name')
+        sub_bulk.add_argument('--start')
+        sub_bulk.add_argument('--end')
+        sub_bulk.add_argument('--ids', type=lambda v: [int(i) for i in v.split(',')],
+                              help='Comma separated entry ids')
+        sub_bulk.add_argument('--dry-run', action='store_true',
+                              help='Only count the entries that would change')
+        if action == 'update':
+            sub_bulk.add_argument('--new-hours', type=float, help='Updated hours')
+            sub_bulk.add_argument('--new-date', help='Updated date')
+            sub_bulk.add_argument('--new-project', help='Move entries to this project')
+        sub_bulk.set_defaults(func=bulk_edit, action=action)
+
+    sub_close = sub.add_parser('close-period',
+                               help='Close a payroll month and freeze its totals')
+    sub_close.add_argument('month', help='Month to close (YYYY-MM)')
+    sub_close.set_defaults(func=close_period_cmd)
+
+    for sub_report in (sub_rep, sub_sum, sub_dist, sub_top, sub_over):
+        sub_report.add_argument('--jobs', type=int, default=1,
+                                help='Aggregate date partitions in this many processes')
+    for sub_report in (sub_sum, sub_top, sub_over, sub_alerts, sub_comp):
+        sub_report.add_argument('--under', type=int, metavar='USER_ID',
+                                help='Only include everyone reporting to this user, '
+                                     'directly or indirectly')
+
+    sub_uniq = sub.add_parser('unique-entries',
+                              help='Allow one entry per employee, project and date')
+    sub_uniq.add_argument('policy', choices=DUPLICATE_POLICIES,
+                          help='What a repeated entry does: reject it, replace the '
+                               'hours, add to them, or off to allow duplicates')
+    sub_uniq.set_defaults(func=unique_entries_cmd)
+
+    sub_restrict = sub.add_parser('restrict-projects',
+                                  help='Limit web timesheet entry to assigned projects')
+    sub_restrict.add_argument('mode', choices=['on', 'off'])
+    sub_restrict.set_defaults(func=restrict_projects_cmd)
+
+    sub_mig = sub.add_parser('migrate-storage',
+                             help='Convert timesheet rows to another storage format')
+    sub_mig.add_argument('format', choices=['text', 'compact'],
+                         help='compact stores day ordinals and half-hour units')
+    sub_mig.set_defaults(func=migrate_storage)
+
+    sub_maint = sub.add_parser('maintain',
+                               help='Back up, analyze, vacuum and check the live databases')
+    sub_maint.add_argument('--backup', metavar='DIR',
+                           help='Copy every database into this directory')
+    sub_maint.add_argument('--pages', type=int, default=MAINTAIN_PAGES,
+                           help='Pages copied or freed per step')
+    sub_maint.add_argument('--sleep', type=float, default=MAINTAIN_PAUSE,
+                           help='Seconds to pause between steps')
+    sub_maint.add_argument('--analysis-limit', type=int, default=ANALYSIS_LIMIT,
+                           help='Rows ANALYZE samples per index (0 for all)')
+    sub_maint.add_argument('--full-vacuum', action='store_true',
+                           help='Rebuild the file with VACUUM, enabling incremental '
+                                'vacuum on older databases; blocks writers')
+    sub_maint.add_argument('--no-analyze', action='store_true')
+    sub_maint.add_argument('--no-vacuum', action='store_true')
+    sub_maint.add_argument('--no-check', action='store_true')
+    sub_maint.set_defaults(func=maintain)
+
+    sub_init = sub.add_parser('init', help='Create or upgrade the database schema')
+    sub_init.set_defaults(func=init_cmd)
+
+    sub_snap = sub.add_parser('snapshot',
+                              help='Write a consistent copy of the database to a file')
+    sub_snap.add_argument('file')
+    sub_snap.set_defaults(func=snapshot_cmd)
+
+    sub_batch = sub.add_parser('batch', help='Run many commands in one process')
+    sub_batch.add_argument('file', nargs='?', default='-',
+                           help='File with one command per line (default: stdin)')
+    sub_batch.add_argument('--group', type=int, default=500,
+                           help='Commands committed per transaction')
+    sub_batch.set_defaults(func=run_batch)
+
+    return parser
+
+
+def parse_args(argv=None):
+    return build_parser().parse_args(argv)
 
 
 def main():
+    global SHARDS, SHARD_BY
     args = parse_args()
+    SHARDS = [p for p in args.shards.split(',') if p]
+    SHARD_BY = args.shard_by
     init_db(args.db)
     if hasattr(args, 'func'):
         args.func(args)
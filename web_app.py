@@ -1,12 +1,25 @@
+import hashlib
+import heapq
+import io
+import os
+import random
+import socket
+from bisect import bisect_left
 import sqlite3
-from functools import wraps
+import threading
+import time
+from collections import OrderedDict, deque
+from functools import partial, wraps
+from urllib.parse import urlencode
 from flask import (
     Flask,
+    make_response,
     render_template,
     request,
     redirect,
     url_for,
     flash,
+    g,
     session,
 )
 from datetime import date, datetime, timedelta
@@ -16,11 +29,41 @@ import timesheet
 app = Flask(__name__)
 app.secret_key = 'secret-key'
 
-# Initialize the database when the application starts.  Some minimal
-# Flask implementations used in this environment may not implement the
-# ``before_first_request`` decorator, so we invoke ``timesheet.init_db``
-# directly to ensure the database tables are created.
-timesheet.init_db()
+# The schema is checked on the first request rather than on import, so
+# workers boot and tests are collected without touching the database; run
+# ``python timesheet.py init`` to set a new database up ahead of traffic.
+_initialised_db = None
+_init_lock = threading.Lock()
+
+
+def ensure_db():
+    """Run ``timesheet.init_db`` once for the current database file."""
+    global _initialised_db
+    if _initialised_db == timesheet.DB_FILE:
+        return
+    with _init_lock:
+        if _initialised_db != timesheet.DB_FILE:
+            timesheet.init_db()
+            _initialised_db = timesheet.DB_FILE
+
+
+@app.before_request
+def init_database():
+    ensure_db()
+
+
+def create_app(db_file=None, init=False):
+    """Return the application, optionally for another database file.
+
+    Views are registered on the module level ``app``, which WSGI servers
+    may also load directly as ``web_app:app``.  With ``init`` the schema is
+    set up now instead of on the first request.
+    """
+    if db_file:
+        timesheet.DB_FILE = db_file
+    if init:
+        ensure_db()
+    return app
 
 
 def fetch_projects():
@@ -101,6 +144,93 @@ def fetch_project_filter_options():
         return [], []
 
 
+# Pickers embed at most this many options; longer lists are loaded on
+# demand from the /api/*/suggest endpoints.
+INLINE_OPTIONS_LIMIT = 200
+SUGGEST_LIMIT = 10
+SUGGEST_MAX_LIMIT = 100
+# Seconds a PrefixIndex answers from memory before checking for writes.
+SUGGEST_REFRESH_INTERVAL = 1.0
+
+
+class PrefixIndex:
+    """Sorted in-memory index answering case-insensitive prefix queries.
+
+    ``loader`` returns ``(value, label)`` rows. Every word of a label is
+    indexed, so ``smi`` finds ``Alice Smith``. The index is rebuilt when
+    ``timesheet.directory_generation()`` has moved since the last build, so
+    logging time never triggers a rebuild. Pages
+    always check; :meth:`suggest` checks at most every
+    ``SUGGEST_REFRESH_INTERVAL`` seconds, as probing the database costs far
+    more than a lookup.
+    """
+
+    def __init__(self, loader):
+        self.loader = loader
+        self._generation = None
+        self._checked = None
+        self._options = []
+        self._keys = []
+        self._positions = []
+        self._lock = threading.Lock()
+
+    def _refresh(self, max_age=0):
+        now = time.monotonic()
+        if self._checked is not None and now - self._checked < max_age:
+            return
+        generation = timesheet.directory_generation()
+        self._checked = now
+        if generation == self._generation:
+            return
+        with self._lock:
+            if generation == self._generation:
+                return
+            options = sorted(self.loader(), key=lambda row: (row[1].casefold(), row[1]))
+            entries = []
+            for pos, (_, label) in enumerate(options):
+                words = label.casefold().split()
+                entries.extend((' '.join(words[i:]), pos) for i in range(len(words)))
+            entries.sort()
+            self._options = options
+            self._keys = [key for key, _ in entries]
+            self._positions = [pos for _, pos in entries]
+            self._generation = generation
+
+    def __len__(self):
+        self._refresh()
+        return len(self._options)
+
+    def options(self):
+        """Return every ``(value, label)`` row ordered by label."""
+        self._refresh()
+        return list(self._options)
+
+    def suggest(self, prefix, limit=SUGGEST_LIMIT):
+        """Return up to ``limit`` rows with a word starting with ``prefix``."""
+        self._refresh(SUGGEST_REFRESH_INTERVAL)
+        options, keys, positions = self._options, self._keys, self._positions
+        prefix = ' '.join(prefix.casefold().split())
+        if not prefix:
+            return options[:limit]
+        seen = set()
+        i = bisect_left(keys, prefix)
+        while i < len(keys) and len(seen) < limit and keys[i].startswith(prefix):
+            seen.add(positions[i])
+            i += 1
+        return [options[pos] for pos in sorted(seen)]
+
+
+PROJECT_INDEX = PrefixIndex(lambda: [(name, name) for name in fetch_projects()])
+USER_INDEX = PrefixIndex(fetch_users)
+
+
+def inline_options(index):
+    """Return ``index``'s rows to embed in a page, or None to lazy-load them."""
+    if len(index) > INLINE_OPTIONS_LIMIT:
+        return None
+    return index.options()
+
+
 def add_project_master(data):
     """Insert a project_master record."""
     try:
@@ -225,41 +355,46 @@ def log_time_entry(employee, project, hours, entry_date, remarks=None):
         return False, 'Date must be in YYYY-MM-DD format.'
     if entry > date.today():
         return False, 'Date cannot be in the future.'
+    if timesheet.RESTRICT_PROJECTS and project not in timesheet.assigned_projects(employee):
+        return False, f'You are not assigned to project {project}'
     try:
         with timesheet.connect_db() as conn:
             cur = conn.cursor()
             emp_id, _ = timesheet.get_or_create(cur, 'employees', employee)
             proj_id, _ = timesheet.get_or_create(cur, 'projects', project)
-            cur.execute(
-                'INSERT INTO timesheets(employee_id, project_id, entry_date, hours, remarks) '
-                'VALUES (?, ?, ?, ?, ?)',
-                (emp_id, proj_id, entry.isoformat(), hours, remarks),
-            )
-            conn.commit()
+            with timesheet.entry_connection(conn, emp_id) as target:
+                written = timesheet.insert_entry(
+                    target, emp_id, proj_id, entry.isoformat(), hours, remarks
+                )
+                conn.commit()
+                target.commit()
+            if not written:
+                return False, 'The existing entry for that day is locked or would exceed 24 hours'
             return True, 'Time entry recorded'
     except sqlite3.Error as e:
+        if timesheet.is_duplicate_entry(e):
+            return False, 'An entry for that project and date already exists'
         return False, f'Failed to log time: {e}'
 
 
+@timesheet.cached_report(ttl=300)
 def project_summary(start=None, end=None):
     """Return list of (project, total_hours) tuples."""
-    with timesheet.connect_db() as conn:
-        cur = conn.cursor()
+    # Projects span shards, so only the merged totals can be cut to ten.
+    limit = '' if timesheet.SHARDS else ' LIMIT 10'
+
+    def run(cur):
+        totals, params = timesheet.totals_subquery(cur, 'project_id', start, end)
         query = (
-            'SELECT p.name, SUM(t.hours) AS total_hours FROM timesheets t '
-            'JOIN projects p ON p.id = t.project_id WHERE 1=1'
+            f'SELECT p.name, SUM(s.hours) AS total_hours FROM ({totals}) s '
+            'JOIN projects p ON p.id = s.project_id '
+            f'GROUP BY p.name ORDER BY total_hours DESC{limit}'
         )
-        params = []
-        if start:
-            query += ' AND t.entry_date >= ?'
-            params.append(start)
-        if end:
-            query += ' AND t.entry_date <= ?'
-            params.append(end)
-        query += ' GROUP BY p.name ORDER BY total_hours DESC LIMIT 10'
         cur.execute(query, params)
         return cur.fetchall()
 
+    return timesheet.merge_sums(timesheet.fan_out(run), key=lambda row: -row[1])[:10]
+
 
 def login_required(func):
     @wraps(func)
@@ -270,15 +405,449 @@ def login_required(func):
     return wrapper
 
 
+class ResponseCache:
+    """Thread-safe LRU cache of response bodies bounded by total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is not None:
+                self._items.move_to_end(key)
+            return item
+
+    def put(self, key, body, mimetype):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= len(old[0])
+            self._items[key] = (body, mimetype)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                _, (evicted, _) = self._items.popitem(last=False)
+                self.size -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def info(self):
+        with self._lock:
+            return dict(entries=len(self._items), bytes=self.size,
+                        max_bytes=self.max_bytes)
+
+
+RESPONSE_CACHE = ResponseCache(max_bytes=16 * 1024 * 1024)
+
+
+def conditional_get(view=None, *, dated_by=()):
+    """Serve ``view`` with an ETag derived from the data generation.
+
+    The ETag covers the path, query string, the session user and the
+    current ``timesheet.data_generation()``; a matching ``If-None-Match``
+    gets a 304 and a known ETag is served from ``RESPONSE_CACHE``, so the
+    view's own queries only run after data has changed. ``dated_by`` names
+    query parameters whose default depends on today's date; while any of
+    them is missing, the date is part of the ETag too.
+    """
+    if view is None:
+        return partial(conditional_get, dated_by=dated_by)
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Pending flash messages are rendered into the page once, so such
+        # responses must neither be served from nor stored in the cache.
+        if session.get('_flashes'):
+            return view(*args, **kwargs)
+        key = '|'.join([
+            request.path,
+            urlencode(sorted(request.args.items(multi=True))),
+            session.get('employee', ''),
+            session.get('role', ''),
+            str(timesheet.data_generation()),
+        ])
+        if any(not request.args.get(name) for name in dated_by):
+            key += '|' + date.today().isoformat()
+        etag = hashlib.sha1(key.encode()).hexdigest()
+        if etag in request.if_none_match:
+            response = app.response_class(status=304)
+        else:
+            cached = RESPONSE_CACHE.get(etag)
+            if cached is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                RESPONSE_CACHE.put(etag, response.get_data(), response.mimetype)
+            else:
+                response = app.response_class(cached[0], mimetype=cached[1])
+        response.set_etag(etag)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return wrapper
 
 
+class AdmissionLane:
+    """Semaphore-bounded lane of concurrent requests with a queue timeout.
+
+    A request waits up to ``timeout`` seconds for one of ``slots`` places
+    and is turned away with a 503 asking to retry after ``retry_after``
+    seconds otherwise. Queue waits are kept for the latest ``samples``
+    admissions.
+    """
+
+    def __init__(self, name, slots, timeout, retry_after, samples=1000):
+        self.name = name
+        self.slots = slots
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self._semaphore = threading.BoundedSemaphore(slots)
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=samples)
+        self.active = self.waiting = self.admitted = self.rejected = 0
+        self.max_wait = 0.0
+
+    def acquire(self):
+        """Wait for a slot and return True if one was taken."""
+        start = time.monotonic()
+        with self._lock:
+            self.waiting += 1
+        ok = self._semaphore.acquire(timeout=self.timeout)
+        wait = time.monotonic() - start
+        with self._lock:
+            self.waiting -= 1
+            if ok:
+                self.active += 1
+                self.admitted += 1
+                self.max_wait = max(self.max_wait, wait)
+                self._waits.append(wait)
+            else:
+                self.rejected += 1
+        return ok
+
+    def release(self):
+        with self._lock:
+            self.active -= 1
+        self._semaphore.release()
+
+    def info(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            stats = dict(slots=self.slots, active=self.active, waiting=self.waiting,
+                         admitted=self.admitted, rejected=self.rejected)
+            max_wait = self.max_wait
+
+        def ms(value):
+            return round(value * 1000, 3)
+
+        stats['wait_ms'] = dict(
+            mean=ms(sum(waits) / len(waits)) if waits else 0.0,
+            p50=ms(waits[len(waits) // 2]) if waits else 0.0,
+            p95=ms(waits[int(len(waits) * 0.95)]) if waits else 0.0,
+            max=ms(max_wait),
+        )
+        return stats
+
+
+# Heavy reports get few slots and fail fast so they cannot starve the
+# interactive lanes that employees' timesheet submissions go through.
+ADMISSION_LANES = {
+    'write': AdmissionLane('write', slots=8, timeout=10, retry_after=2),
+    'read': AdmissionLane('read', slots=8, timeout=5, retry_after=2),
+    'report': AdmissionLane('report', slots=2, timeout=0.5, retry_after=5),
+}
+REPORT_ENDPOINTS = {'manager_summary', 'productivity_reports', 'compliance_report',
+                    'payroll_api', 'utilization_api'}
+UNMETERED_ENDPOINTS = {'static', 'cache_stats_api', 'admission_stats_api',
+                       'scheduler_stats_api'}
+
+
+def request_lane():
+    """Return the admission lane name for the current request, or None."""
+    if request.endpoint is None or request.endpoint in UNMETERED_ENDPOINTS:
+        return None
+    if request.endpoint in REPORT_ENDPOINTS:
+        return 'report'
+    return 'read' if request.method in ('GET', 'HEAD') else 'write'
+
+
+@app.before_request
+def admit_request():
+    name = request_lane()
+    if name is None:
+        return None
+    lane = ADMISSION_LANES[name]
+    if not lane.acquire():
+        message = f'Too many concurrent {name} requests, please retry shortly'
+        if request.path.startswith('/api/'):
+            response = make_response({'error': message}, 503)
+        else:
+            response = make_response(message, 503)
+        response.headers['Retry-After'] = str(lane.retry_after)
+        return response
+    g.admission_lane = lane
+    return None
 
 
+@app.teardown_request
+def release_request(exc=None):
+    lane = g.pop('admission_lane', None)
+    if lane is not None:
+        lane.release()
+
+
+class CronSchedule:
+    """Five-field cron expression: minute, hour, day, month and weekday.
+
+    Fields take ``*``, numbers, ``a-b`` ranges, ``/step`` and comma lists.
+    Weekdays run from 0 (Sunday) to 6, 7 also meaning Sunday.  As in cron,
+    when both the day and weekday fields are restricted a day matching
+    either one is due.  Times are local.
+    """
+
+    FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 5:
+            raise ValueError(f'cron expression needs five fields: {expression!r}')
+        self.expression = expression
+        self.minutes, self.hours, self.days, self.months, weekdays = (
+            self._parse(part, lo, hi) for part, (lo, hi) in zip(parts, self.FIELDS))
+        self.weekdays = {day % 7 for day in weekdays}
+        self._either_day = not parts[2].startswith('*') and not parts[4].startswith('*')
+
+    @staticmethod
+    def _parse(field, lo, hi):
+        values = set()
+        for item in field.split(','):
+            spec, _, step = item.partition('/')
+            if spec == '*':
+                first, last = lo, hi
+            elif '-' in spec:
+                first, last = (int(v) for v in spec.split('-', 1))
+            else:
+                first = int(spec)
+                last = hi if step else first
+            step = int(step) if step else 1
+            if not lo <= first <= last <= hi or step < 1:
+                raise ValueError(f'invalid cron field: {field!r}')
+            values.update(range(first, last + 1, step))
+        return values
+
+    def _day_due(self, moment):
+        day = moment.day in self.days
+        weekday = (moment.weekday() + 1) % 7 in self.weekdays
+        return day or weekday if self._either_day else day and weekday
+
+    def next_after(self, moment):
+        """Return the first due minute after ``moment``."""
+        due = moment.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        # Long enough for a 29 February that must also be a given weekday.
+        limit = due + timedelta(days=366 * 28)
+        while due < limit:
+            if due.month not in self.months:
+                due = (due.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1)
+            elif not self._day_due(due):
+                due = due.replace(hour=0, minute=0) + timedelta(days=1)
+            elif due.hour not in self.hours:
+                due = due.replace(minute=0) + timedelta(hours=1)
+            elif due.minute not in self.minutes:
+                due += timedelta(minutes=1)
+            else:
+                return due
+        raise ValueError(f'cron expression never matches: {self.expression!r}')
+
+
+class ScheduledJob:
+    """A function the :class:`Scheduler` runs on a cron schedule.
+
+    Each run starts a random 0 to ``jitter`` seconds after the scheduled
+    minute, so jobs due together do not all hit the database at once.
+    A ``leased`` job runs only in the process holding the scheduler lease;
+    other jobs run in every process. Run counts and durations are kept for
+    :meth:`info`.
+    """
+
+    def __init__(self, name, schedule, func, jitter=0, leased=True):
+        self.name = name
+        self.schedule = CronSchedule(schedule)
+        self.func = func
+        self.jitter = jitter
+        self.leased = leased
+        self.next_run = None
+        self.runs = self.failures = 0
+        self.last_run = self.last_duration = self.last_error = None
+        self.total_duration = self.max_duration = 0.0
+        self._lock = threading.Lock()
+
+    def plan(self, now):
+        self.next_run = self.schedule.next_after(now) + timedelta(
+            seconds=random.uniform(0, self.jitter))
+
+    def run(self):
+        """Run the job once; return its start time, duration and error."""
+        started = time.time()
+        clock = time.perf_counter()
+        error = None
+        try:
+            self.func()
+        except Exception as e:  # noqa: BLE001 - one failing job must not stop the others
+            app.logger.exception('Scheduled job %s failed', self.name)
+            error = f'{type(e).__name__}: {e}'
+        duration = time.perf_counter() - clock
+        with self._lock:
+            self.runs += 1
+            self.failures += error is not None
+            self.last_run = datetime.fromtimestamp(started)
+            self.last_duration = duration
+            self.last_error = error
+            self.total_duration += duration
+            self.max_duration = max(self.max_duration, duration)
+        return started, duration, error
+
+    def info(self):
+        with self._lock:
+            return dict(
+                schedule=self.schedule.expression,
+                jitter=self.jitter,
+                leased=self.leased,
+                next_run=self.next_run.isoformat(timespec='seconds') if self.next_run else None,
+                last_run=self.last_run.isoformat(timespec='seconds') if self.last_run else None,
+                runs=self.runs,
+                failures=self.failures,
+                last_error=self.last_error,
+                duration_ms=dict(
+                    last=round(self.last_duration * 1000, 3) if self.runs else None,
+                    mean=round(self.total_duration / self.runs * 1000, 3) if self.runs else None,
+                    max=round(self.max_duration * 1000, 3),
+                ),
+            )
+
+
+class Scheduler:
+    """Run :class:`ScheduledJob` instances in a background thread.
+
+    Every web worker process may start one; they compete for the
+    ``scheduler`` row of the ``leases`` table and only the holder runs
+    leased jobs.  The lease is renewed every ``tick`` seconds and between
+    jobs, and taken over by another process once it has not been renewed
+    for ``lease_ttl`` seconds.  Jobs that are not leased run in every
+    process.  Runs are recorded in ``job_runs``.
+    """
+
+    LEASE = 'scheduler'
+
+    def __init__(self, jobs, tick=15, lease_ttl=120):
+        self.jobs = list(jobs)
+        self.tick = tick
+        self.lease_ttl = lease_ttl
+        self.owner = f'{socket.gethostname()}:{os.getpid()}:{os.urandom(3).hex()}'
+        self.leader = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    def run_pending(self, now=None):
+        """Run the due jobs, the leased ones only while holding the lease.
+
+        Returns the names of the jobs run.
+        """
+        now = now or datetime.now()
+        ran = []
+        for job in self.jobs:
+            if job.next_run is None:
+                job.plan(now)
+            if job.next_run > now:
+                continue
+            if job.leased:
+                self.leader = timesheet.acquire_lease(self.LEASE, self.owner, self.lease_ttl)
+                if not self.leader:
+                    # Followers keep planning, ready to take over on schedule.
+                    job.plan(now)
+                    continue
+            started, duration, error = job.run()
+            timesheet.record_job_run(job.name, self.owner, started, duration, error)
+            job.plan(max(now, datetime.now()))
+            ran.append(job.name)
+        return ran
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                ensure_db()
+                self.leader = timesheet.acquire_lease(self.LEASE, self.owner, self.lease_ttl)
+                self.run_pending()
+            except sqlite3.Error:
+                self.leader = False
+                app.logger.exception('Scheduler could not reach the database')
+            now = datetime.now()
+            delay = min([self.tick] + [(job.next_run - now).total_seconds()
+                                       for job in self.jobs if job.next_run])
+            self._stop.wait(max(delay, 0.05))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._loop, name='scheduler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stop.set()
+        self._thread.join()
+        self._thread = None
+        if self.leader:
+            timesheet.release_lease(self.LEASE, self.owner)
+            self.leader = False
+
+    def info(self):
+        return dict(owner=self.owner, leader=self.leader, running=self._thread is not None,
+                    jobs={job.name: job.info() for job in self.jobs})
+
+
+def warm_dashboard():
+    """Recompute the manager chart and reload the project and user pickers.
+
+    The report cache and pickers are per process, so this runs in every
+    worker rather than only in the lease holder. ``RESPONSE_CACHE`` is left
+    cold: its pages are keyed by the session user and role.
+    """
+    project_summary.refresh()
+    PROJECT_INDEX.options()
+    USER_INDEX.options()
+
+
+def warm_productivity():
+    """Recompute the unfiltered productivity report in this worker."""
+    timesheet.top_employees.refresh()
+    timesheet.overworked_employees.refresh()
+
+
+# Warm-ups start before the working day and repeat within the five minute
+# report cache TTL until it ends, in every worker as each has its own cache;
+# statistics are refreshed overnight by the lease holder alone.
+SCHEDULER = Scheduler([
+    ScheduledJob('warm-dashboard', '*/4 7-18 * * 1-5', warm_dashboard, jitter=30,
+                 leased=False),
+    ScheduledJob('warm-productivity', '*/4 7-18 * * 1-5', warm_productivity, jitter=30,
+                 leased=False),
+    ScheduledJob('analyze', '30 2 * * *', timesheet.analyze_databases, jitter=600),
+])
+
 
 @app.route('/project-master', methods=['GET', 'POST'])
 def project_master():
     managers = fetch_managers()
-    employees = fetch_users()
+    employees = inline_options(USER_INDEX)
     if request.method == 'POST':
         form = request.form
         data = {
@@ -316,14 +885,7 @@ def project_master():
             if ok:
                 project_id = result
                 assignees = request.form.getlist('assigned_employees')
-                with timesheet.connect_db() as conn:
-                    cur = conn.cursor()
-                    for uid in assignees:
-                        cur.execute(
-                            'INSERT OR IGNORE INTO project_assignments(project_id, user_id) VALUES (?, ?)',
-                            (project_id, uid),
-                        )
-                    conn.commit()
+                timesheet.assign_projects(project_id, assignees)
                 flash('Project created', 'success')
                 return redirect(url_for('project_master'))
             else:
@@ -363,7 +925,7 @@ def logout():
 @login_required
 def dashboard():
     role = session.get('role', 'Employee')
-    today = date.today().isoformat()
+    today = timesheet.to_storage_date(date.today().isoformat())
     with timesheet.connect_db() as conn:
         cur = conn.cursor()
 
@@ -374,8 +936,11 @@ def dashboard():
             employees = cur.fetchone()[0]
             cur.execute('SELECT COUNT(*) FROM timesheets WHERE entry_date = ?', (today,))
             today_entries = cur.fetchone()[0]
+            pending = timesheet.pending_approval_counts()
             totals = dict(projects=projects, employees=employees,
-                          today_entries=today_entries, pending_approvals=0)
+                          today_entries=today_entries,
+                          pending_approvals=pending.get('submitted', 0)
+                          + pending.get('manager_approved', 0))
             context = dict(totals=totals)
 
         elif role == 'Project Manager':
@@ -383,22 +948,26 @@ def dashboard():
             projects_managed = cur.fetchone()[0]
             cur.execute('SELECT COUNT(*) FROM timesheets WHERE entry_date = ?', (today,))
             employee_submissions = cur.fetchone()[0]
-            cur.execute('SELECT COUNT(*) FROM timesheets WHERE hours > 8 AND entry_date = ?', (today,))
+            cur.execute('SELECT COUNT(*) FROM timesheets WHERE hours > ? AND entry_date = ?',
+                        (timesheet.to_storage_hours(8), today))
             review_alerts = cur.fetchone()[0]
             chart_data = project_summary()
+            pending = timesheet.pending_approval_counts()
             context = dict(manager=dict(projects_managed=projects_managed,
                                        employee_submissions=employee_submissions,
                                        review_alerts=review_alerts,
+                                       pending_approvals=pending.get('submitted', 0),
                                        chart_data=chart_data))
         else:
-            cur.execute('SELECT name FROM projects ORDER BY name')
-            assigned_projects = [r[0] for r in cur.fetchall()]
+            assigned_projects = timesheet.assigned_projects(session['employee'])
             start_week = date.today() - timedelta(days=date.today().weekday())
-            cur.execute('''SELECT t.entry_date, SUM(t.hours)
-                           FROM timesheets t JOIN employees e ON e.id = t.employee_id
-                           WHERE e.name = ? AND t.entry_date >= ?
-                           GROUP BY t.entry_date ORDER BY t.entry_date''',
-                        (session['employee'], start_week.isoformat()))
+            cur.execute(f'''SELECT {timesheet.date_sql('t.entry_date')},
+                                   {timesheet.hours_sql('SUM(t.hours)')}
+                            FROM timesheets t JOIN employees e ON e.id = t.employee_id
+                            WHERE e.name = ? AND t.entry_date >= ?
+                            GROUP BY t.entry_date ORDER BY t.entry_date''',
+                        (session['employee'],
+                         timesheet.to_storage_date(start_week.isoformat())))
             week_entries = cur.fetchall()
             cur.execute('''SELECT 1 FROM timesheets t JOIN employees e ON e.id = t.employee_id
                            WHERE e.name = ? AND t.entry_date = ?''',
@@ -419,6 +988,7 @@ def reports_home():
 
 @app.route('/manager/summary')
 @app.route('/reports/summary')
+@conditional_get
 def manager_summary():
     start = request.args.get('start')
     end = request.args.get('end')
@@ -436,14 +1006,17 @@ def manager_summary():
 
 
 @app.route('/reports/productivity')
+@conditional_get
 def productivity_reports():
     start = request.args.get('start')
     end = request.args.get('end')
     employee = request.args.get('employee')
     project = request.args.get('project')
 
-    employees = fetch_users()
-    projects = fetch_projects()
+    employees = inline_options(USER_INDEX)
+    projects = inline_options(PROJECT_INDEX)
+    if projects is not None:
+        projects = [name for name, _ in projects]
 
     dist_labels, dist_hours = [], []
     if employee:
@@ -474,25 +1047,232 @@ def productivity_reports():
     )
 
 
+@app.route('/reports/compliance')
+@conditional_get(dated_by=('start', 'end'))
+def compliance_report():
+    """List active users with workdays missing from their timesheets."""
+    start = request.args.get('start') or None
+    end = request.args.get('end') or None
+    department = request.args.get('department') or None
+    min_hours = request.args.get('min_hours', 0, type=float)
+    missing = {}
+    try:
+        rows = timesheet.missing_timesheets(start, end, min_hours, department)
+    except ValueError:
+        flash('Dates must be in YYYY-MM-DD format', 'error')
+        rows = []
+    for name, day in rows:
+        missing.setdefault(name, []).append(day)
+    departments, _, _ = fetch_user_filter_options()
+    return render_template(
+        'compliance_report.html',
+        missing=missing,
+        departments=departments,
+        department_selected=department,
+        start=start,
+        end=end,
+        min_hours=min_hours,
+    )
+
+
 @app.route('/api/payroll')
+@conditional_get
 def payroll_api():
     """Return timesheet entries in JSON for payroll systems."""
-    with timesheet.connect_db() as conn:
-        cur = conn.cursor()
+    def run(cur):
         cur.execute(
-            'SELECT e.name, p.name, t.entry_date, t.hours, t.remarks '
+            f"SELECT e.name, p.name, {timesheet.date_sql('t.entry_date')}, "
+            f"{timesheet.hours_sql('t.hours')}, t.remarks "
             'FROM timesheets t '
             'JOIN employees e ON e.id = t.employee_id '
             'JOIN projects p ON p.id = t.project_id '
             'ORDER BY t.entry_date'
         )
-        rows = [
-            dict(employee=r[0], project=r[1], date=r[2], hours=r[3], remarks=r[4])
-            for r in cur.fetchall()
-        ]
+        return cur.fetchall()
+
+    merged = heapq.merge(*timesheet.fan_out(run), key=lambda r: r[2])
+    rows = [
+        dict(employee=r[0], project=r[1], date=r[2], hours=r[3], remarks=r[4])
+        for r in merged
+    ]
     return {'entries': rows}
 
 
+def _suggest_args():
+    limit = request.args.get('limit', SUGGEST_LIMIT, type=int)
+    return request.args.get('q', ''), max(1, min(limit, SUGGEST_MAX_LIMIT))
+
+
+@app.route('/api/projects/suggest')
+def project_suggest_api():
+    """Return the project names with a word starting with ``q``."""
+    prefix, limit = _suggest_args()
+    return {'projects': [name for name, _ in PROJECT_INDEX.suggest(prefix, limit)]}
+
+
+@app.route('/api/users/suggest')
+def user_suggest_api():
+    """Return the active users with a word of their name starting with ``q``."""
+    prefix, limit = _suggest_args()
+    return {'users': [dict(id=uid, name=name) for uid, name in USER_INDEX.suggest(prefix, limit)]}
+
+
+@app.route('/api/admission/stats')
+def admission_stats_api():
+    """Return slot usage and queue wait times for each admission lane."""
+    return {name: lane.info() for name, lane in ADMISSION_LANES.items()}
+
+
+@app.route('/api/scheduler/stats')
+def scheduler_stats_api():
+    """Return this process's scheduled jobs and the latest recorded runs."""
+    stats = SCHEDULER.info()
+    stats['history'] = [
+        dict(job=job, owner=owner, started_at=started_at,
+             duration_ms=round(duration * 1000, 3), error=error)
+        for job, owner, started_at, duration, error in timesheet.job_runs()
+    ]
+    return stats
+
+
+@app.route('/api/utilization')
+@conditional_get
+def utilization_api():
+    """Return the employee x period utilization matrix as JSON, CSV or NPY."""
+    fmt = request.args.get('format', 'json')
+    values = request.args.get('values', 'utilization')
+    if fmt not in ('json', 'csv', 'npy') or values not in ('utilization', 'hours'):
+        return {'error': 'format must be json, csv or npy and values utilization or hours'}, 400
+    try:
+        matrix = timesheet.utilization_matrix(
+            request.args.get('start') or None,
+            request.args.get('end') or None,
+            request.args.get('period', 'isoweekly'),
+            request.args.get('capacity', 8.0, type=float),
+        )
+    except RuntimeError as e:
+        return {'error': str(e)}, 501
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    employees, periods, hours, available, utilization = matrix
+    if fmt == 'csv':
+        return app.response_class(''.join(timesheet.utilization_csv(matrix, values)),
+                                  mimetype='text/csv')
+    if fmt == 'npy':
+        buf = io.BytesIO()
+        timesheet.utilization_npy(matrix, buf, values)
+        response = app.response_class(buf.getvalue(), mimetype='application/octet-stream')
+        response.headers['Content-Disposition'] = 'attachment; filename=utilization.npy'
+        return response
+    return {
+        'employees': list(employees),
+        'periods': list(periods),
+        'available': available.tolist(),
+        'hours': hours.tolist(),
+        'utilization': utilization.round(3).tolist(),
+    }
+
+
+@app.route('/api/cache/stats')
+def cache_stats_api():
+    """Return statistics for the report result and response caches."""
+    return {
+        'reports': timesheet.report_cache_stats(),
+        'responses': RESPONSE_CACHE.info(),
+    }
+
+
+def _session_user():
+    """Return ``(id, department)`` of the signed-in user, or None."""
+    with timesheet.connect_db() as conn:
+        cur = conn.cursor()
+        cur.execute(
+            'SELECT id, department FROM users WHERE full_name = ? AND role = ? '
+            'ORDER BY id LIMIT 1',
+            (session.get('employee'), session.get('role')),
+        )
+        return cur.fetchone()
+
+
+def _bulk_transition(action):
+    """Run an approval action for the team and range in the JSON body.
+
+    Administrators may name any manager or department.  Other users always
+    act on their own direct reports, optionally narrowed to their own
+    department.
+    """
+    data = request.get_json(silent=True) or {}
+    manager_id, department = data.get('manager_id'), data.get('department')
+    if session.get('role') != 'Admin':
+        user = _session_user()
+        if user is None or (department and department != user[1]):
+            return {'error': f'You can only {action} entries of your own team'}, 403
+        manager_id = user[0]
+    try:
+        count = timesheet.transition_entries(
+            action,
+            start=data.get('start'),
+            end=data.get('end'),
+            manager_id=manager_id,
+            department=department,
+        )
+    except ValueError as e:
+        return {'error': str(e)}, 400
+    except sqlite3.Error as e:
+        return {'error': f'Failed to {action} entries: {e}'}, 500
+    return {'action': action, 'status': timesheet.STATUS_TRANSITIONS[action][1],
+            'updated': count}
+
+
+@app.route('/api/timesheets/approve', methods=['POST'])
+@login_required
+def approve_timesheets_api():
+    """Approve all submitted entries for a team and date range."""
+    if session.get('role') not in ('Admin', 'Project Manager'):
+        return {'error': 'Only managers can approve timesheets'}, 403
+    return _bulk_transition('approve')
+
+
+@app.route('/api/timesheets/lock', methods=['POST'])
+@login_required
+def lock_timesheets_api():
+    """Lock all manager-approved entries for a team and date range."""
+    if session.get('role') != 'Admin':
+        return {'error': 'Only administrators can lock timesheets'}, 403
+    return _bulk_transition('lock')
+
+
+@app.route('/api/timesheets/bulk', methods=['POST'])
+@login_required
+def bulk_timesheets_api():
+    """Update or delete all unlocked entries matching a JSON filter."""
+    if session.get('role') != 'Admin':
+        return {'error': 'Only administrators can change entries in bulk'}, 403
+    data = request.get_json(silent=True) or {}
+    action = data.get('action')
+    if action not in ('update', 'delete'):
+        return {'error': "action must be 'update' or 'delete'"}, 400
+    dry_run = bool(data.get('dry_run'))
+    try:
+        affected, locked = timesheet.bulk_change(
+            action,
+            employee=data.get('employee'),
+            project=data.get('project'),
+            start=data.get('start'),
+            end=data.get('end'),
+            ids=data.get('ids'),
+            new_hours=data.get('new_hours'),
+            new_date=data.get('new_date'),
+            new_project=data.get('new_project'),
+            dry_run=dry_run,
+        )
+    except (TypeError, ValueError) as e:
+        return {'error': str(e)}, 400
+    except sqlite3.Error as e:
+        return {'error': f'Failed to {action} entries: {e}'}, 500
+    return {'action': action, 'dry_run': dry_run, 'affected': affected, 'locked': locked}
+
+
 @app.route('/user', methods=['GET', 'POST'])
 def user_master():
     managers = fetch_managers()
@@ -724,8 +1504,19 @@ def timesheet_entry():
                 ok_all = False
         if ok_all:
             return redirect(url_for('timesheet_entry'))
-    return render_template('timesheet_form.html', projects=fetch_projects(), today=date.today().isoformat())
+    if timesheet.RESTRICT_PROJECTS:
+        projects = timesheet.assigned_projects(session['employee'])
+    else:
+        projects = inline_options(PROJECT_INDEX)
+        if projects is not None:
+            projects = [name for name, _ in projects]
+    return render_template('timesheet_form.html', projects=projects, today=date.today().isoformat())
+
+
+# Off by default so imports by the CLI, tests and tools start no thread.
+if os.environ.get('TIMESHEET_SCHEDULER') == 'on':
+    SCHEDULER.start()
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app(init=True).run(debug=True)